@@ -1,58 +1,287 @@
 import asyncio
+import inspect
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from core.config import Config
 from core.db_manager import db
 from core.file_manager import file_manager
-from connectors.gmail_client import GmailClient
-from connectors.tg_bot import TGBotHandler
+from core.attachment_store import attachment_store
+from connectors.gmail_client import GmailClient, AdaptivePoller, IDLE_TIMEOUT, SYNC_FOLDER
+from connectors.tg_bot import TGBotHandler, DIGEST_MAX_ITEMS
 from skills.rfq_parser import RFQSkill
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-async def mail_polling_task(gmail_client, rfq_skill, tg_bot):
-    """背景巡邏 Gmail 並驅動 Agent 流程"""
-    temp_dir = "temp_rfq_attachments"
-    while True:
-        logging.info("掃描新 RFQ 郵件...")
-        emails = gmail_client.fetch_unprocessed_rfqs(base_save_dir=temp_dir)
+PIPELINE_QUEUE_SIZE = 20  # 各階段之間的佇列上限 (滿了即反壓上一階段)
+# notify 等到 Telegram 實際送達才完成；多個 worker 同時等待，積壓時 TGBotHandler 才能合併成彙整訊息
+STAGE_CONCURRENCY = {"parse": 4, "archive": 2, "persist": 1, "notify": DIGEST_MAX_ITEMS}
+LABEL_BATCH_MAX = 50  # 一次 UID STORE 最多合併的信件數
+LABEL_BATCH_WAIT = 0.5  # 收到第一封後再等多久湊成同一批 (秒)
+JOB_MAX_ATTEMPTS = 5  # 同一階段連續失敗此次數後放棄 (stage=failed)
+JOB_RETRY_BASE_SECONDS = 60  # 重試間隔：60s, 120s, 240s...
 
-        for mail in emails:
-            rfq_id = f"RFQ-{mail['uid']}"
-            logging.info(f"處理 {rfq_id}")
+def approval_summary(item_name, parsed):
+    """Telegram 審核訊息中的解析摘要"""
+    items = parsed.get('items', [])
+    return f"料號: {item_name}\n數量: {items[0].get('quantity', 'N/A') if items else 'N/A'}"
+
+def load_pending_approval(rfq_id, store=db):
+    """供 TGBotHandler 在重啟後取回待審核草稿：(summary, draft) 或 None (已處理 / 不存在)"""
+    record = store.get_rfq_record(rfq_id)
+    if record is None or record["status"] != "PENDING":
+        return None
+    parsed = record["parsed_data"]
+    items = parsed.get('items', [])
+    item_name = items[0].get('item_name', 'UnknownItem') if items else 'UnknownItem'
+    return approval_summary(item_name, parsed), parsed.get('draft', '')
+
+async def wait_for_mail(gmail_client, poller, found_mail, retry_in=None):
+    """
+    等到可能有新信為止：剛處理完一批時以最短間隔再掃 (處理期間可能又有新信)；
+    否則以 IMAP IDLE 等候推播，伺服器不支援或連線失敗時退回 AdaptivePoller 的間隔輪詢。
+    retry_in: 下一個待重試工作的秒數，等待不超過此時間。
+    """
+    if found_mail:
+        await asyncio.sleep(poller.next_interval(True))
+        return
+    timeout = IDLE_TIMEOUT if retry_in is None else max(1, min(IDLE_TIMEOUT, retry_in))
+    try:
+        pushed = await asyncio.to_thread(gmail_client.wait_for_new_mail, timeout)
+    except Exception as e:
+        logging.warning(f"IMAP IDLE 失敗，改為輪詢: {e}")
+        pushed = None
+    if pushed is None:
+        interval = poller.next_interval(False)
+        await asyncio.sleep(interval if retry_in is None else max(1, min(interval, retry_in)))
+
+class RFQPipeline:
+    """
+    分段式處理管線：fetch → parse → archive → persist → notify → label。
+    各階段以有界 asyncio.Queue 串接；會阻塞的階段在執行緒池中執行，並以 worker 數限制各階段並行度，
+    Telegram Bot 所在的 event loop 不會被 Gmail / Gemini / SQLite 呼叫卡住。
+    每封信是 RFQ_Jobs 中的一筆工作，每完成一個階段即寫回結果；當機重啟後從中斷的階段接續，
+    已完成的 Gemini 解析不會重跑。失敗的階段依指數退避重試，用盡次數後標記為 failed。
+    """
+    STAGES = ("parse", "archive", "persist", "notify", "label")
+
+    def __init__(self, gmail_client, rfq_skill, tg_bot, temp_dir="temp_rfq_attachments",
+                 store=db, files=file_manager, concurrency=None, poller=None,
+                 max_attempts=JOB_MAX_ATTEMPTS, retry_base=JOB_RETRY_BASE_SECONDS):
+        self.gmail_client = gmail_client
+        self.rfq_skill = rfq_skill
+        self.tg_bot = tg_bot
+        self.temp_dir = temp_dir
+        self.db = store
+        self.files = files
+        self.concurrency = dict(STAGE_CONCURRENCY, **(concurrency or {}))
+        self.poller = poller or AdaptivePoller()
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.executor = ThreadPoolExecutor(
+            max_workers=sum(self.concurrency[s] for s in ("parse", "archive", "persist")) + 2,
+            thread_name_prefix="rfq-pipeline"
+        )
+        self.queues = {}
+        self.inflight = set()  # 已放進佇列、尚未完成或失敗的 UID，避免同一工作被派送兩次
+        self.drained = None
+
+    async def _blocking(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    # --- 階段處理 (參數與回傳皆為工作 payload；重跑同一階段須得到相同結果) ---
+
+    def _parse(self, ctx):
+        mail = ctx["mail"]
+        parsed = self.rfq_skill.parse_and_draft(mail['text'], mail.get('attachments', []))
+        # Gemini 失敗 / 回傳非 JSON 時不推送空草稿，留待重試
+        if "error" in parsed or "raw" in parsed:
+            raise RuntimeError(parsed.get("error") or "Gemini 回應不是有效的 JSON")
+        ctx["parsed"] = parsed
+        return ctx
+
+    def _archive(self, ctx):
+        items = ctx["parsed"].get('items', [])
+        ctx["item_name"] = items[0].get('item_name', 'UnknownItem') if items else 'UnknownItem'
+        # 沿用上次建立的目錄 (隔天重試時不會以新日期再建一份)
+        paths = ctx.get("paths") or self.files.create_rfq_tree(ctx["rfq_id"], ctx["item_name"])
+        if '原始需求' not in paths:
+            raise OSError(f"無法建立 {ctx['rfq_id']} 的歸檔目錄")
+        ctx["paths"] = paths
+        # 搬移附件至「1_原始需求」(暫存檔為附件倉庫的硬連結，搬移不複製內容；已搬過的略過)
+        for att in ctx["mail"].get('attachments', []):
+            if os.path.exists(att):
+                os.replace(att, os.path.join(paths['原始需求'], os.path.basename(att)))
+        return ctx
 
-            # 1. 呼叫大腦解析
-            pdf_paths = mail.get('attachments', [])
-            parsed_result = rfq_skill.parse_and_draft(mail['text'], pdf_paths)
+    def _persist(self, ctx):
+        if not self.db.save_rfq_record(ctx["rfq_id"], ctx["mail"]['text'], ctx["parsed"], status="PENDING"):
+            raise RuntimeError(f"無法儲存 {ctx['rfq_id']}")
+        return ctx
 
-            # 2. 建立本地枝狀目錄
-            items = parsed_result.get('items', [])
-            item_name = items[0].get('item_name', 'UnknownItem') if items else 'UnknownItem'
-            paths = file_manager.create_rfq_tree(rfq_id, item_name)
+    async def _notify(self, ctx):
+        # 等到實際送達：送出失敗會拋出例外，此階段依退避重試，通知至少送達一次
+        summary = approval_summary(ctx["item_name"], ctx["parsed"])
+        await self.tg_bot.send_draft_for_approval(ctx["rfq_id"], summary, ctx["parsed"].get('draft', ''), wait=True)
+        return ctx
 
-            # 搬移附件至「1_原始需求」
-            if '1_原始需求' in paths:
-                for att in pdf_paths:
-                    if os.path.exists(att):
-                        os.rename(att, os.path.join(paths['1_原始需求'], os.path.basename(att)))
+    # --- 管線 ---
 
-            # 3. 寫入資料庫
-            db.save_rfq_record(rfq_id, mail['text'], parsed_result, status="PENDING")
+    def _next_stage(self, name):
+        i = self.STAGES.index(name)
+        return self.STAGES[i + 1] if i + 1 < len(self.STAGES) else "done"
 
-            # 4. 推播至 Telegram 等待指令
-            summary = f"料號: {item_name}\n數量: {items[0].get('quantity', 'N/A') if items else 'N/A'}"
-            await tg_bot.send_draft_for_approval(rfq_id, summary, parsed_result.get('draft', '草稿生成失敗'))
+    async def _stage_worker(self, name, handler):
+        in_queue = self.queues[name]
+        next_stage = self._next_stage(name)
+        while True:
+            ctx = await in_queue.get()
+            try:
+                if inspect.iscoroutinefunction(handler):
+                    ctx = await handler(ctx)
+                else:
+                    ctx = await self._blocking(handler, ctx)
+                await self._advance(ctx, next_stage)
+            except Exception as e:
+                await self._retry(ctx, name, e)
+            else:
+                await self.queues[next_stage].put(ctx)
+            finally:
+                in_queue.task_done()
 
-            # 5. 更新 Gmail 狀態
-            gmail_client.mark_as_read(mail['uid'])
-            gmail_client.update_label(mail['uid'], "RFQ-進行中")
+    async def _label_worker(self):
+        """收集已通知的信件，合併成一次 UID STORE (已讀 + 標籤)"""
+        queue = self.queues["label"]
+        while True:
+            batch = [await queue.get()]
+            deadline = asyncio.get_running_loop().time() + LABEL_BATCH_WAIT
+            while len(batch) < LABEL_BATCH_MAX:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            uids = [ctx["mail"]['uid'] for ctx in batch]
+            try:
+                await self._blocking(self.gmail_client.mark_processed, uids, "RFQ-進行中")
+            except Exception as e:
+                for ctx in batch:
+                    await self._retry(ctx, "label", e)
+            else:
+                for ctx in batch:
+                    try:
+                        await self._advance(ctx, "done")
+                    except Exception as e:
+                        await self._retry(ctx, "label", e)
+                    else:
+                        self._release(ctx["mail"]['uid'])
+            finally:
+                for _ in batch:
+                    queue.task_done()
 
-        await asyncio.sleep(60)
+    async def _advance(self, ctx, stage):
+        # 寫回失敗時不可繼續往下游送 (重啟後會從舊階段重跑、重複推送)，改走重試
+        if not await self._blocking(self.db.advance_rfq_job, ctx["mail"]['uid'], stage, ctx):
+            raise RuntimeError(f"無法將 {ctx['rfq_id']} 的工作推進到 {stage}")
+
+    async def _retry(self, ctx, stage, error):
+        """記錄失敗並排定重試；本身出錯時只記 log (工作留在原階段，下一輪再派送)，不讓 worker 中止"""
+        uid = ctx["mail"]['uid']
+        try:
+            job = await self._blocking(self.db.get_rfq_job, uid)
+            delay = self.retry_base * 2 ** (job["attempts"] if job else 0)
+            job = await self._blocking(self.db.fail_rfq_job, uid, str(error), delay, self.max_attempts)
+            if job and job["stage"] == "failed":
+                logging.error(f"{ctx['rfq_id']} 於 {stage} 階段失敗 {job['attempts']} 次，放棄處理 (信件保持未讀): {error}")
+            else:
+                logging.warning(f"{ctx['rfq_id']} 於 {stage} 階段失敗，{delay} 秒後重試: {error}")
+        except Exception as e:
+            logging.error(f"{ctx.get('rfq_id', uid)} 於 {stage} 階段失敗 ({error})，且無法記錄重試: {e}")
+        finally:
+            self._release(uid)
+
+    def _release(self, uid):
+        self.inflight.discard(str(uid))
+        if not self.inflight:
+            self.drained.set()
+
+    async def _fetch(self):
+        """增量同步新信並寫入工作佇列；工作已持久化，UID 高水位可直接推進到本次掃描位置"""
+        logging.info("掃描新 RFQ 郵件...")
+        try:
+            state = await self._blocking(self.db.get_mail_sync_state, SYNC_FOLDER)
+            # 增量同步：只看 UID 高於 DB 中高水位的信件，舊的未讀 RFQ 不會每輪重新下載
+            emails, (uidvalidity, scanned_uid) = await self._blocking(self.gmail_client.sync_new_rfqs, self.temp_dir, state)
+        except Exception as e:
+            logging.error(f"同步 Gmail 失敗: {e}")
+            return 0
+        new = 0
+        for mail in emails:
+            queued = await self._blocking(self.db.enqueue_rfq_job, mail['uid'], {"mail": mail, "rfq_id": f"RFQ-{mail['uid']}"})
+            if queued is None:
+                # 寫入失敗：高水位停在這封之前，下一輪同步會再抓到它
+                scanned_uid = min(scanned_uid, int(mail['uid']) - 1)
+                logging.error(f"無法將 RFQ-{mail['uid']} 寫入工作佇列，下一輪同步重試")
+                continue
+            new += queued
+        await self._blocking(self.db.save_mail_sync_state, SYNC_FOLDER, uidvalidity, scanned_uid)
+        return new
+
+    async def _dispatch(self):
+        """把到期的工作 (新信、待重試、上次中斷的) 送進各自所在階段的佇列"""
+        jobs = await self._blocking(self.db.get_due_rfq_jobs)
+        jobs = [job for job in jobs if job["uid"] not in self.inflight]
+        self.inflight.update(job["uid"] for job in jobs)
+        if self.inflight:
+            self.drained.clear()
+        for job in jobs:
+            if job["attempts"]:
+                logging.info(f"重試 {job['payload'].get('rfq_id')} ({job['stage']}，第 {job['attempts'] + 1} 次)")
+            await self.queues[job["stage"]].put(job["payload"])
+        return len(jobs)
+
+    def start(self):
+        """建立佇列並啟動各階段 worker；回傳 task 清單"""
+        self.queues = {name: asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE) for name in self.STAGES}
+        self.drained = asyncio.Event()
+        self.drained.set()
+        handlers = {"parse": self._parse, "archive": self._archive, "persist": self._persist, "notify": self._notify}
+        tasks = []
+        for name, handler in handlers.items():
+            tasks += [asyncio.create_task(self._stage_worker(name, handler)) for _ in range(self.concurrency[name])]
+        tasks.append(asyncio.create_task(self._label_worker()))
+        return tasks
+
+    async def run_once(self):
+        """同步一次、派送所有到期工作並等本批處理完畢；回傳本批工作數"""
+        await self._fetch()
+        count = await self._dispatch()
+        await self.drained.wait()
+        return count
+
+    async def run(self):
+        tasks = self.start()
+        try:
+            while True:
+                # 本批處理完才進入 IDLE：IDLE 會佔用 IMAP 連線，且下一輪同步不應重抓處理中的信
+                found = await self.run_once()
+                retry_in = await self._blocking(self.db.next_rfq_job_delay)
+                await wait_for_mail(self.gmail_client, self.poller, bool(found), retry_in)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.executor.shutdown(wait=False)
+
+async def mail_polling_task(gmail_client, rfq_skill, tg_bot):
+    """背景監聽 Gmail (IDLE 推播 / 輪詢) 並以分段管線處理新 RFQ"""
+    await RFQPipeline(gmail_client, rfq_skill, tg_bot).run()
 
 async def main():
     Config.validate()
-    gmail_client = GmailClient(Config.GMAIL_USER, Config.GMAIL_PWD)
-    tg_bot = TGBotHandler(Config.TG_TOKEN, Config.TG_CHAT_ID)
+    gmail_client = GmailClient(Config.GMAIL_USER, Config.GMAIL_PWD, attachment_store=attachment_store)
+    tg_bot = TGBotHandler(Config.TG_TOKEN, Config.TG_CHAT_ID, loader=load_pending_approval)
     rfq_skill = RFQSkill(Config.GEMINI_API_KEY)
 
     # 啟動背景任務
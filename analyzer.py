@@ -1,19 +1,178 @@
 import os
+import re
 import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+import unicodedata
+from contextlib import closing
 import openai
-from jsonschema import validate, ValidationError
 from config import OPTIONS, OPTION_TRANSLATIONS
 from rfq_schema import RFQ_SCHEMA
+from rfq_validator import iter_rfq_errors, validate_rfq, RFQValidationError
+import database
+import rfq_rules
+from core.llm_gateway import gateway, LLMResponse, parse_retry_after
+
+# 修改 analyze_rfq 的 prompt 文字時請將此版本 +1，舊的解析快取會自動失效
+PROMPT_VERSION = 2
+
+# 批次解析預設值 (依 OpenAI 帳號等級調整)
+BATCH_MAX_CONCURRENCY = 8
+BATCH_REQUESTS_PER_MIN = 500
+BATCH_TOKENS_PER_MIN = 30000
+BATCH_MAX_BACKOFF = 30.0  # 秒: 單次重試等待上限 (Retry-After 亦以此為上限)
+
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0}
+_cache_checked_version = None
+
+# --- 解析快取 (Parse Cache) ---
+
+def prompt_fingerprint():
+    """Prompt 版本 + 規則版本 + RFQ_SCHEMA + OPTIONS 的雜湊；任何一項改變即視為新版本"""
+    payload = json.dumps(
+        {"prompt": PROMPT_VERSION, "rules": rfq_rules.RULES_VERSION, "schema": RFQ_SCHEMA, "options": OPTIONS, "translations": OPTION_TRANSLATIONS.get("zh", {})},
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+def normalize_rfq_text(text):
+    """NFKC 正規化 + 壓縮空白 + 移除空行，讓重複貼上的同一封 RFQ 得到相同的 key"""
+    text = unicodedata.normalize("NFKC", text or "")
+    lines = [re.sub(r"\s+", " ", line).strip() for line in text.splitlines()]
+    return "\n".join(line for line in lines if line)
+
+def parse_cache_key(text, prompt_version=None):
+    prompt_version = prompt_version or prompt_fingerprint()
+    return hashlib.sha256(f"{prompt_version}\0{normalize_rfq_text(text)}".encode("utf-8")).hexdigest()
+
+def invalidate_parse_cache(all_versions=False):
+    """清除其他 prompt 版本的快取 (all_versions=True 則全部清除)，回傳刪除筆數"""
+    return database.purge_parse_cache(None if all_versions else prompt_fingerprint())
+
+def get_cache_stats():
+    with _cache_lock:
+        stats = dict(_cache_stats)
+    stats["entries"] = database.count_parse_cache()
+    return stats
+
+def _cache_lookup(cache_key, prompt_version):
+    global _cache_checked_version
+    try:
+        if _cache_checked_version != prompt_version:
+            # 每個行程第一次使用時清掉舊 prompt 版本的快取
+            invalidate_parse_cache()
+            _cache_checked_version = prompt_version
+        cached = database.get_cached_parse(cache_key)
+    except sqlite3.Error as e:
+        print(f"[AI 快取] 讀取失敗，略過快取: {e}")
+        cached = None
+    with _cache_lock:
+        _cache_stats["hits" if cached is not None else "misses"] += 1
+    return json.loads(cached) if cached is not None else None
+
+def _cache_store(cache_key, prompt_version, result):
+    try:
+        database.put_cached_parse(cache_key, prompt_version, json.dumps(result, ensure_ascii=False))
+    except sqlite3.Error as e:
+        print(f"[AI 快取] 寫入失敗: {e}")
+
+def _plan_analysis(text, report, use_cache=True, use_rules=True):
+    """
+    快取 / 規則前置步驟 (同步與批次共用)。
+    回傳 (已完成的結果 或 None, plan)；結果為 None 時需以 plan["llm_text"] 呼叫 LLM。
+    """
+    plan = {"rule_items": [], "rule_lines": [], "llm_lines": [], "llm_text": text, "cache_key": None, "prompt_version": None}
+
+    if use_cache:
+        plan["prompt_version"] = prompt_fingerprint()
+        plan["cache_key"] = parse_cache_key(text, plan["prompt_version"])
+        cached = _cache_lookup(plan["cache_key"], plan["prompt_version"])
+        if cached is not None:
+            report("[AI] 命中解析快取。")
+            return cached, plan
+
+    if use_rules:
+        rule_result = rfq_rules.parse_rfq(text)
+        try:
+            if rule_result["items"]:
+                validate_rfq({"items": rule_result["items"]})
+                plan["rule_items"] = rule_result["items"]
+                plan["rule_lines"] = rule_result["item_lines"]
+        except RFQValidationError as ve:
+            print(f"[規則] 輸出未通過 Schema，改由 LLM 解析全文: {ve.message}")
+        rule_items = plan["rule_items"]
+        if rule_items and not rule_result["unparsed"]:
+            report(f"[規則] 本機解析完成 {len(rule_items)} 項，未呼叫 API。")
+            return {"items": rule_items}, plan
+        if rule_items:
+            report(f"[規則] 本機解析 {len(rule_items)} 項，剩餘 {len(rule_result['unparsed'])} 行交給 LLM。")
+            plan["llm_text"] = "\n".join(rule_result["context"] + rule_result["unparsed"])
+            plan["llm_lines"] = rule_result["unparsed_lines"]
+
+    return None, plan
+
+def _merge_by_line(plan, llm_items):
+    """
+    依原文行序合併規則與 LLM 的 items (item_index 與 RFQ 的列順序一致)。
+    LLM items 視為依序對應送出的未解析行；數量多出時排在最後一個未解析行之後。
+    """
+    rule_items, llm_lines = plan["rule_items"], plan["llm_lines"]
+    if not rule_items or not llm_lines:
+        return rule_items + llm_items
+    keyed = [(line, 0, i, item) for i, (line, item) in enumerate(zip(plan["rule_lines"], rule_items))]
+    keyed += [(llm_lines[min(i, len(llm_lines) - 1)], 1, i, item) for i, item in enumerate(llm_items)]
+    return [item for *_, item in sorted(keyed, key=lambda k: k[:3])]
+
+def _finish_analysis(plan, llm_result):
+    """合併規則與 LLM 的結果，成功時寫入快取"""
+    if llm_result.get("cancelled"):
+        return llm_result
+    if not llm_result["items"]:
+        return {"items": plan["rule_items"]}
+    result = {"items": _merge_by_line(plan, llm_result["items"])}
+    if plan["cache_key"]:
+        _cache_store(plan["cache_key"], plan["prompt_version"], result)
+    return result
+
+def analyze_rfq(text, on_progress=None, cancel_event=None, use_cache=True, use_rules=True, on_item=None):
+    """
+    on_progress(message): 每個階段回報進度 (由背景工作執行緒呼叫)。
+    cancel_event: threading.Event，設定後於下一次嘗試前中止並回傳 {"items": [], "cancelled": True}。
+    use_cache: 先查詢解析快取；命中時直接回傳已驗證的結果，不呼叫 API。
+    use_rules: 先以 rfq_rules 本機解析，只有規則無法確定的行才送 LLM。
+    on_item(item): 串流模式。每個 item 一通過驗證即呼叫 (規則 item 立即送出，LLM item 於其 JSON 物件閉合時送出)。
+        快取命中時不會呼叫；回傳值仍是完整且權威的結果，呼叫端應以其補齊或校正已顯示的 items。
+    """
+    def report(message):
+        print(message)
+        if on_progress:
+            on_progress(message)
 
-def analyze_rfq(text):
     print(f"\n[AI] 收到解析請求，長度: {len(text)}")
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        print("[AI 錯誤] 找不到 OPENAI_API_KEY")
-        return {"items": []}
 
-    client = openai.OpenAI(api_key=api_key)
-    
+    done, plan = _plan_analysis(text, report, use_cache, use_rules)
+    if done is not None:
+        return done
+    if on_item is not None:
+        for item in plan["rule_items"]:
+            on_item(item)
+    return _finish_analysis(plan, _analyze_with_llm(plan["llm_text"], report, cancel_event, on_item))
+
+_static_prompt = None
+
+def _static_system_prompt():
+    """
+    所有與單筆 RFQ 無關的指示 (規則、Enum、中英對照)。內容在行程內固定不變，
+    放在 messages 最前面作為可被 provider 快取的 prompt 前綴；修改時請將 PROMPT_VERSION +1。
+    """
+    global _static_prompt
+    if _static_prompt is not None:
+        return _static_prompt
+
     # 1. 準備純英文的 Enum 清單 (給 Schema 驗證用)
     pure_mat_opts = ", ".join(OPTIONS["material_types"])
     pure_form_opts = ", ".join(OPTIONS["form_types"])
@@ -22,10 +181,8 @@ def analyze_rfq(text):
     trans_map = OPTION_TRANSLATIONS.get("zh", {})
     context_hint = "Reference Map (For understanding only): " + ", ".join([f"{m}={trans_map.get(m, m)}" for m in OPTIONS["material_types"]])
 
-    system_prompt = "You are a senior procurement analyst. Normalize RFQ text into strict JSON validated by schema."
-
-    user_prompt = (
-        f"Analyze this RFQ text:\n\"\"\"{text}\"\"\"\n\n"
+    _static_prompt = (
+        f"You are a senior procurement analyst. Normalize RFQ text into strict JSON validated by schema.\n\n"
         f"*** STRICT RULES ***\n"
         f"1. **ROOT OBJECT**: Output MUST be {{ 'items': [...] }}.\n"
         f"2. **MANDATORY FIELDS**: 'material_type', 'material_spec', 'form', 'dimensions', 'quantity', 'notes'.\n"
@@ -49,46 +206,231 @@ def analyze_rfq(text):
         f"   - **Automotive**: If text mentions '汽車', '車用', 'IATF 16949', or 'IATF'.\n"
         f"   - **Aerospace**: If text mentions '航太', '航空', 'Aerospace', 'AS9100', or 'NADCAP'.\n"
     )
+    return _static_prompt
+
+def _build_messages(text):
+    # 靜態前綴在前 (可快取)，每筆 RFQ 的內容放最後
+    return [
+        {"role": "system", "content": _static_system_prompt()},
+        {"role": "user", "content": f"Analyze this RFQ text:\n\"\"\"{text}\"\"\""}
+    ]
+
+def _load_response(content):
+    """解析模型回應的 JSON (不驗證)"""
+    raw_data = json.loads(content)
+
+    # [零成本修復] 自動補全根節點
+    if isinstance(raw_data, dict) and "items" not in raw_data:
+        if "material_type" in raw_data:
+            raw_data = {"items": [raw_data]}
+    return raw_data
+
+# --- 逐項修復 (Item-level Repair) ---
 
-    messages = [
-        {"role": "system", "content": system_prompt},
+_ITEM_PATH = re.compile(r"^items\[(\d+)\]")
+_ITEM_PROPERTIES = RFQ_SCHEMA["properties"]["items"]["items"]["properties"]
+
+def _validate_items(raw_data):
+    """
+    回傳 {item index: [錯誤訊息]}，全部通過時為 {}。
+    根層級錯誤 (沒有 items、items 為空等無法逐項修復的情況) 直接拋出 RFQValidationError。
+    """
+    pending, root_errors = {}, []
+    for path, message in iter_rfq_errors(raw_data):
+        m = _ITEM_PATH.match(path)
+        if m:
+            field = path[m.end():].lstrip(".") or "(item)"
+            pending.setdefault(int(m.group(1)), []).append(f"{field}: {message}")
+        else:
+            root_errors.append((path, message))
+    if root_errors:
+        raise RFQValidationError(root_errors)
+    return pending
+
+def _build_repair_messages(items, pending):
+    """只送出未通過驗證的 items 及其錯誤，請模型依相同順序回傳修正後的 items"""
+    lines = []
+    for n, index in enumerate(sorted(pending), 1):
+        lines.append(f"Item {n}: {json.dumps(items[index], ensure_ascii=False)}")
+        lines.extend(f"  - {error}" for error in pending[index])
+
+    user_prompt = (
+        f"These RFQ items failed JSON schema validation:\n" + "\n".join(lines) + "\n\n"
+        f"Fix ONLY the listed errors and keep every other value unchanged.\n"
+        f"Output {{ 'items': [...] }} with exactly {len(pending)} items, in the same order.\n"
+        + "".join(f"- {field} MUST be one of: [{', '.join(spec['enum'])}]\n" for field, spec in _ITEM_PROPERTIES.items() if "enum" in spec)
+        + f"- quantity MUST be a string with unit (e.g. '10 pcs').\n"
+        f"- All fields are strings: {', '.join(_ITEM_PROPERTIES)}.\n"
+    )
+    return [
+        {"role": "system", "content": _static_system_prompt()},
         {"role": "user", "content": user_prompt}
     ]
 
+def _apply_response(content, items, pending):
+    """
+    處理一次模型回應，回傳 (items, pending)。
+    pending 為空時 content 是完整解析結果；否則 content 為修復回應，依序合併回 items 的原位置。
+    修復回應格式錯誤或數量不符時保留原 items，讓下一輪再試。
+    """
+    if not pending:
+        raw_data = _load_response(content)
+        pending = _validate_items(raw_data)
+        return raw_data["items"], pending
+
+    indices = sorted(pending)
+    try:
+        repaired = _load_response(content).get("items")
+    except (ValueError, AttributeError):
+        repaired = None
+    if isinstance(repaired, list) and len(repaired) == len(indices):
+        for index, item in zip(indices, repaired):
+            items[index] = item
+    else:
+        print(f"[AI 修復] 回應數量不符 (預期 {len(indices)} 項)，保留原 items")
+    return items, _validate_items({"items": items})
+
+# --- 串流解析 (Streaming) ---
+
+class ItemStreamParser:
+    """
+    增量解析串流中的 {"items": [{...}, {...}]}：feed(chunk) 回傳本次閉合的 [(index, item)]。
+    只追蹤字串 / 跳脫字元與括號深度；整份回應最後仍由 _apply_response 完整驗證。
+    """
+    def __init__(self):
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.token = []
+        self.last_key = None
+        self.in_items = False
+        self.current = None
+        self.count = 0
+
+    def feed(self, chunk):
+        closed = []
+        for ch in chunk:
+            if self.current is not None:
+                self.current.append(ch)
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if len(self.stack) == 1:
+                        self.last_key = "".join(self.token)
+                elif len(self.stack) == 1:
+                    self.token.append(ch)
+                continue
+
+            if ch == '"':
+                self.in_string = True
+                self.token = []
+            elif ch in "{[":
+                if ch == "[" and self.stack == ["{"] and self.last_key == "items":
+                    self.in_items = True
+                elif ch == "{" and self.in_items and len(self.stack) == 2:
+                    self.current = [ch]
+                self.stack.append(ch)
+            elif ch in "}]":
+                if self.stack:
+                    self.stack.pop()
+                if ch == "}" and self.current is not None and len(self.stack) == 2:
+                    try:
+                        item = json.loads("".join(self.current))
+                    except ValueError:
+                        item = None
+                    if isinstance(item, dict):
+                        closed.append((self.count, item))
+                    self.count += 1
+                    self.current = None
+                elif ch == "]" and self.in_items and len(self.stack) == 1:
+                    self.in_items = False
+        return closed
+
+def _chat_request(api_key, messages):
+    return {
+        "api_key": api_key,
+        "model": "gpt-4o",
+        "messages": messages,
+        "temperature": 0,
+        "response_format": {"type": "json_object"},
+    }
+
+def _stream_completion(request, on_object, cancel_event=None):
+    """經 gateway 串流呼叫模型，每個 item 物件閉合時呼叫 on_object(index, item)；回傳完整內容，取消時回傳 None"""
+    parser = ItemStreamParser()
+    chunks = []
+    with closing(gateway.stream("analyzer.stream", "openai", request)) as stream:
+        for delta in stream:
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            chunks.append(delta)
+            for index, item in parser.feed(delta):
+                on_object(index, item)
+    return "".join(chunks).strip()
+
+def _analyze_with_llm(text, report, cancel_event=None, on_item=None):
+    """
+    GPT-4o 解析 + Schema 驗證重試迴圈。失敗時回傳 {"items": []}。
+    驗證失敗的 item 以 _build_repair_messages 單獨修復，不重送整段對話。
+    on_item 不為 None 時以串流方式取得完整解析，每個 item 通過驗證即送出 (修復後的 item 於修復完成時送出)。
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        print("[AI 錯誤] 找不到 OPENAI_API_KEY")
+        return {"items": []}
+
+    messages = _build_messages(text)
     max_retries = 5
+    items, pending = None, {}
+    emitted = set()
+
+    def emit(index, item):
+        if on_item is not None and index not in emitted and not iter_rfq_errors({"items": [item]}):
+            emitted.add(index)
+            on_item(item)
     
     for attempt in range(max_retries):
+        if cancel_event is not None and cancel_event.is_set():
+            report("[AI] 已取消解析。")
+            return {"items": [], "cancelled": True}
+
         try:
-            print(f"[AI] 第 {attempt + 1} 次嘗試解析...")
+            if pending:
+                report(f"[AI] 第 {attempt + 1} 次嘗試：只修復 {len(pending)} 個未通過驗證的項目...")
+                request = _build_repair_messages(items, pending)
+            else:
+                report(f"[AI] 第 {attempt + 1} 次嘗試解析...")
+                request = messages
             
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                temperature=0,
-                response_format={"type": "json_object"}
-            )
-            
-            content = response.choices[0].message.content.strip()
-            raw_data = json.loads(content)
+            if on_item is not None and not pending:
+                content = _stream_completion(_chat_request(api_key, request), emit, cancel_event)
+                if content is None:
+                    report("[AI] 已取消解析。")
+                    return {"items": [], "cancelled": True}
+            else:
+                response = gateway.call("analyzer.repair" if pending else "analyzer", "openai", _chat_request(api_key, request))
+                print(f"[AI] input tokens: {response.prompt_tokens} (cached {response.cached_tokens})")
+                content = response.text
 
-            # [零成本修復] 自動補全根節點
-            if isinstance(raw_data, dict) and "items" not in raw_data:
-                if "material_type" in raw_data:
-                    raw_data = {"items": [raw_data]}
+            items, pending = _apply_response(content, items, pending)
+            for index, item in enumerate(items):
+                if index not in pending:
+                    emit(index, item)
+            if not pending:
+                report("[AI] 驗證通過，資料結構完美。")
+                return {"items": items}
 
-            # Schema 驗證
-            validate(instance=raw_data, schema=RFQ_SCHEMA)
-            print("[AI] 驗證通過，資料結構完美。")
-            return raw_data
+            report(f"[Schema 違規 - 第 {attempt + 1} 次] {len(pending)} 個項目未通過: "
+                   + "; ".join(f"#{i + 1} {', '.join(errs)}" for i, errs in sorted(pending.items())))
 
-        except ValidationError as ve:
-            # 將具體的錯誤回傳給 AI，讓它修正
+        except RFQValidationError as ve:
+            # 根層級錯誤無法逐項修復：將具體的錯誤回傳給 AI，讓它重新輸出
             error_msg = f"JSON Validation Error: {ve.message}. Please fix the value to match the Schema requirements."
-            print(f"[Schema 違規 - 第 {attempt + 1} 次] {ve.message}")
-            
-            if attempt == max_retries - 1:
-                print("[AI] 重試次數耗盡，解析失敗。")
-                return {"items": []}
+            report(f"[Schema 違規 - 第 {attempt + 1} 次] {ve.message}")
             
             messages.append({"role": "assistant", "content": content})
             messages.append({"role": "user", "content": error_msg})
@@ -97,4 +439,144 @@ def analyze_rfq(text):
             print(f"[AI 系統錯誤] {e}")
             return {"items": []}
 
+    print("[AI] 重試次數耗盡，解析失敗。")
     return {"items": []}
+
+# --- 批次解析 (Async) ---
+
+class TokenBucketLimiter:
+    """
+    requests/min 與 tokens/min 雙桶限流 (asyncio)。
+    acquire() 以預估 token 數扣額度，回應後用 adjust() 依實際 usage 補差額。
+    """
+    def __init__(self, requests_per_min, tokens_per_min):
+        self.capacity = {"requests": float(requests_per_min), "tokens": float(tokens_per_min)}
+        self.levels = dict(self.capacity)
+        self.rates = {k: v / 60.0 for k, v in self.capacity.items()}
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        for k in self.levels:
+            self.levels[k] = min(self.capacity[k], self.levels[k] + elapsed * self.rates[k])
+
+    async def acquire(self, tokens):
+        tokens = min(float(tokens), self.capacity["tokens"])
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.levels["requests"] >= 1 and self.levels["tokens"] >= tokens:
+                    self.levels["requests"] -= 1
+                    self.levels["tokens"] -= tokens
+                    return
+                wait = max(
+                    (1 - self.levels["requests"]) / self.rates["requests"],
+                    (tokens - self.levels["tokens"]) / self.rates["tokens"],
+                    0.01
+                )
+                await asyncio.sleep(wait)
+
+    def adjust(self, tokens_delta):
+        self.levels["tokens"] -= tokens_delta
+
+def _estimate_tokens(messages, completion_budget=1500):
+    # 粗估: 約 3 字元 / token (中英混合)，再加上預期輸出
+    return sum(len(m["content"]) for m in messages) // 3 + completion_budget
+
+async def _analyze_with_llm_async(client, limiter, text, label, max_retries=3):
+    """批次用的單筆 LLM 解析：逐項 Schema 修復 + 暫時性錯誤 (429 / 連線 / 逾時) 退避重試"""
+    messages = _build_messages(text)
+    schema_retries = 5
+    transient_failures = 0
+    attempt = 0
+    items, pending = None, {}
+
+    while attempt < schema_retries:
+        request = _build_repair_messages(items, pending) if pending else messages
+        estimate = _estimate_tokens(request)
+        await limiter.acquire(estimate)
+        started = time.perf_counter()
+        try:
+            response = await client.chat.completions.create(
+                model="gpt-4o",
+                messages=request,
+                temperature=0,
+                response_format={"type": "json_object"}
+            )
+        except (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError) as e:
+            # 請求未被處理：退還預扣的 token 額度
+            limiter.adjust(-estimate)
+            transient_failures += 1
+            if transient_failures > max_retries:
+                print(f"[AI 批次] {label} 重試次數耗盡: {e}")
+                return {"items": []}
+            # 429 依伺服器的 retry-after-ms / Retry-After 等待，其餘指數退避
+            retry_after = None
+            if isinstance(e, openai.RateLimitError):
+                retry_after = parse_retry_after(getattr(getattr(e, "response", None), "headers", None))
+            await asyncio.sleep(min(retry_after if retry_after is not None else 2 ** transient_failures, BATCH_MAX_BACKOFF))
+            continue
+        except Exception as e:
+            print(f"[AI 批次] {label} 系統錯誤: {e}")
+            return {"items": []}
+
+        if response.usage is not None:
+            limiter.adjust(response.usage.total_tokens - estimate)
+            details = getattr(response.usage, "prompt_tokens_details", None)
+            gateway.record("analyzer.batch", time.perf_counter() - started, LLMResponse(
+                text="",
+                prompt_tokens=response.usage.prompt_tokens,
+                completion_tokens=response.usage.completion_tokens,
+                cached_tokens=(getattr(details, "cached_tokens", 0) or 0) if details else 0
+            ))
+
+        attempt += 1
+        content = response.choices[0].message.content.strip()
+        try:
+            items, pending = _apply_response(content, items, pending)
+            if not pending:
+                return {"items": items}
+            print(f"[AI 批次] {label} {len(pending)} 個項目未通過 Schema (第 {attempt} 次)，僅修復這些項目")
+        except RFQValidationError as ve:
+            print(f"[AI 批次] {label} Schema 違規 (第 {attempt} 次): {ve.message}")
+            messages.append({"role": "assistant", "content": content})
+            messages.append({"role": "user", "content": f"JSON Validation Error: {ve.message}. Please fix the value to match the Schema requirements."})
+        except Exception as e:
+            print(f"[AI 批次] {label} 回應格式錯誤: {e}")
+            return {"items": []}
+
+    return {"items": []}
+
+async def analyze_rfq_batch_async(texts, max_concurrency=BATCH_MAX_CONCURRENCY, requests_per_min=BATCH_REQUESTS_PER_MIN,
+                                  tokens_per_min=BATCH_TOKENS_PER_MIN, max_retries=3, use_cache=True, use_rules=True):
+    """併發解析多筆 RFQ，回傳結果順序與 texts 相同"""
+    api_key = os.getenv("OPENAI_API_KEY")
+    # 重試由 _analyze_with_llm_async 自行處理 (含 Retry-After)；關閉 SDK 內建重試以免次數相乘
+    client = openai.AsyncOpenAI(api_key=api_key, max_retries=0) if api_key else None
+    limiter = TokenBucketLimiter(requests_per_min, tokens_per_min)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_one(index, text):
+        label = f"#{index}"
+        done, plan = _plan_analysis(text, lambda m: print(f"{label} {m}"), use_cache, use_rules)
+        if done is not None:
+            return done
+        if client is None:
+            print("[AI 錯誤] 找不到 OPENAI_API_KEY")
+            return _finish_analysis(plan, {"items": []})
+        async with semaphore:
+            llm_result = await _analyze_with_llm_async(client, limiter, plan["llm_text"], label, max_retries)
+        return _finish_analysis(plan, llm_result)
+
+    try:
+        return list(await asyncio.gather(*(run_one(i, t) for i, t in enumerate(texts))))
+    finally:
+        if client is not None:
+            await client.close()
+
+def analyze_rfq_batch(texts, max_concurrency=BATCH_MAX_CONCURRENCY, **kwargs):
+    """analyze_rfq_batch_async 的同步包裝 (供 CLI / 腳本使用)"""
+    return asyncio.run(analyze_rfq_batch_async(texts, max_concurrency=max_concurrency, **kwargs))
@@ -0,0 +1,73 @@
+# batch_analyze.py
+# 無介面批次解析：將資料夾內的 .txt / .eml 詢價信一次解析成 JSON。
+# 用法: python batch_analyze.py <資料夾> [-o results.json] [--concurrency 8] [--rpm 500] [--tpm 30000]
+
+import argparse
+import html
+import json
+import os
+import re
+import sys
+from email import policy
+from email.parser import BytesParser
+
+import analyzer
+import database
+
+
+def read_rfq_file(path):
+    """讀取 .txt 或 .eml；.eml 取主旨 + 純文字內文 (無純文字時退回去除標籤的 HTML)"""
+    if path.lower().endswith(".eml"):
+        with open(path, "rb") as f:
+            msg = BytesParser(policy=policy.default).parse(f)
+        body = msg.get_body(preferencelist=("plain", "html"))
+        content = body.get_content() if body is not None else ""
+        if body is not None and body.get_content_type() == "text/html":
+            content = html.unescape(re.sub(r"<[^>]+>", " ", content))
+        subject = msg.get("Subject", "")
+        return f"Subject: {subject}\n\n{content}" if subject else content
+    with open(path, "r", encoding="utf-8-sig", errors="replace") as f:
+        return f.read()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="批次解析 RFQ 詢價信 (.txt / .eml) 並輸出 JSON")
+    parser.add_argument("directory")
+    parser.add_argument("-o", "--output", help="輸出 JSON 檔 (預設輸出到 stdout)")
+    parser.add_argument("--concurrency", type=int, default=analyzer.BATCH_MAX_CONCURRENCY)
+    parser.add_argument("--rpm", type=int, default=analyzer.BATCH_REQUESTS_PER_MIN, help="requests / min 上限")
+    parser.add_argument("--tpm", type=int, default=analyzer.BATCH_TOKENS_PER_MIN, help="tokens / min 上限")
+    parser.add_argument("--no-cache", action="store_true", help="不使用解析快取")
+    args = parser.parse_args(argv)
+
+    files = sorted(
+        os.path.join(args.directory, name) for name in os.listdir(args.directory)
+        if name.lower().endswith((".txt", ".eml"))
+    )
+    if not files:
+        print(f"錯誤：{args.directory} 內沒有 .txt / .eml 檔案", file=sys.stderr)
+        return 1
+
+    database.init_db()
+    texts = [read_rfq_file(path) for path in files]
+    results = analyzer.analyze_rfq_batch(
+        texts,
+        max_concurrency=args.concurrency,
+        requests_per_min=args.rpm,
+        tokens_per_min=args.tpm,
+        use_cache=not args.no_cache
+    )
+
+    output = [{"file": os.path.basename(path), "items": result.get("items", [])} for path, result in zip(files, results)]
+    payload = json.dumps(output, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(payload)
+        print(f"完成：{len(files)} 封 RFQ，共 {sum(len(o['items']) for o in output)} 項，已寫入 {args.output}", file=sys.stderr)
+    else:
+        print(payload)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+# bench_database.py
+# 比較「每次呼叫都重新連線」(舊版 database.py 行為) 與 ConnectionManager 常駐連線的單次延遲。
+# 常駐連線另外設定 synchronous=NORMAL；為了分開兩種效果，重新連線的版本各以預設 (FULL) 與
+# NORMAL 量一次：durability 欄是 FULL→NORMAL 的差異，pooling 欄是相同 PRAGMA 下常駐連線的差異。
+# (journal_mode=WAL 寫在資料庫檔內，三種量法都是 WAL。)
+# 用法: python bench_database.py [呼叫次數]
+
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+import database
+
+
+def _time_per_call(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n * 1e6
+
+
+def _connect(synchronous):
+    conn = sqlite3.connect(database.DB_NAME)
+    if synchronous:
+        conn.execute(f"PRAGMA synchronous = {synchronous}")
+    return conn
+
+
+def _reconnect_get_templates(synchronous=None):
+    conn = _connect(synchronous)
+    cursor = conn.cursor()
+    cursor.execute('SELECT * FROM templates')
+    cursor.fetchall()
+    conn.close()
+
+
+def _reconnect_add_template(synchronous=None):
+    conn = _connect(synchronous)
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT INTO templates (name, subject_format, preamble_html, closing_html, cc_recipients, use_default_subject)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', ("bench", "", "", "", "", 0))
+    conn.commit()
+    conn.close()
+
+
+def main(n=2000):
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, "bench.db")
+        database.init_db()
+        for i in range(200):
+            database.add_supplier(f"S{i}", "", "", "", "", json.dumps(["Aluminum"]), json.dumps(["Bar"]), json.dumps(["ISO"]))
+        database.add_template("bench", "", "", "")
+
+        cases = [
+            ("get_templates", _reconnect_get_templates, database.get_templates),
+            ("add_template", _reconnect_add_template, lambda: database.add_template("bench", "", "", "")),
+        ]
+        print(f"{'call':<16}{'reconnect (us)':>16}{'+NORMAL (us)':>14}{'pooled (us)':>14}{'durability':>12}{'pooling':>10}")
+        for name, before, after in cases:
+            t_full = _time_per_call(before, n)
+            t_normal = _time_per_call(lambda: before("NORMAL"), n)
+            t_pooled = _time_per_call(after, n)
+            print(f"{name:<16}{t_full:>16.1f}{t_normal:>14.1f}{t_pooled:>14.1f}"
+                  f"{t_full / t_normal:>11.1f}x{t_normal / t_pooled:>9.1f}x")
+
+        database.close_connections()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
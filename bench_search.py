@@ -0,0 +1,66 @@
+# bench_search.py
+# 建立 N 筆 RFQ (每筆 3 個品項) 後量測 search_rfq_history / search_suppliers_text / 詢價紀錄分頁的單次延遲。
+# 用法: python bench_search.py [RFQ 筆數]
+
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import database
+
+_GRADES = ["SUS316L", "SUS304", "6061-T6", "7075-T651", "C3604", "SKD11", "S45C", "Ti-6Al-4V", "Inconel 718", "POM"]
+_WORDS = ["請報價", "急件", "交期", "IATF 16949", "AS9100", "附圖", "表面處理", "陽極", "研磨", "熱處理", "please quote", "urgent"]
+
+
+def _populate(n):
+    rng = random.Random(0)
+    with database.transaction() as cursor:
+        for i in range(n):
+            grades = rng.sample(_GRADES, 3)
+            text = f"RFQ-{i:06d} " + " ".join(rng.sample(_WORDS, 4)) + "\n" + "\n".join(f"{g} Ø{rng.randint(5, 200)} x {rng.randint(50, 3000)} {rng.randint(1, 500)} pcs" for g in grades)
+            cursor.execute("INSERT INTO rfq_requests (raw_text, parsed_items, created_by, status) VALUES (?, '[]', 'bench', 'Analyzed')", (text,))
+            req_id = cursor.lastrowid
+            cursor.executemany(
+                "INSERT INTO rfq_items (request_id, item_index, material_type, form_type, spec, matched_suppliers, status) VALUES (?, ?, 'Other', 'Bar', ?, '[]', 'Pending')",
+                [(req_id, idx, json.dumps({"material_spec": g, "dimensions": "Ø50 x 1000", "notes": ""})) for idx, g in enumerate(grades)]
+            )
+        for i in range(2000):
+            cursor.execute("INSERT INTO suppliers (name, contact_person, email, address) VALUES (?, ?, ?, ?)",
+                           (f"供應商 {i} 金屬材料有限公司", f"王{i}", f"sales{i}@example.com", f"新北市 {i} 號"))
+
+
+def _time_per_call(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n * 1000
+
+
+def main(n=100000, calls=50):
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_NAME = os.path.join(tmp, "bench.db")
+        database.init_db()
+        started = time.perf_counter()
+        _populate(n)
+        print(f"建立 {n} 筆 RFQ: {time.perf_counter() - started:.1f}s")
+
+        cases = [
+            ("rfq: rare term", lambda: database.search_rfq_history("RFQ-012345")),
+            ("rfq: common term", lambda: database.search_rfq_history("SUS316L")),
+            ("rfq: two terms", lambda: database.search_rfq_history("Inconel 急件")),
+            ("supplier: name", lambda: database.search_suppliers_text("金屬材料 1234")),
+            ("history: newest page", lambda: database.get_rfq_history_page()),
+            ("history: deep page", lambda: database.get_rfq_history_page(before_id=n // 10)),
+            ("history: material", lambda: database.get_rfq_history_page(material_type="Other", before_id=n // 2)),
+            ("history: items", lambda: database.get_rfq_items(n // 2)),
+        ]
+        for name, fn in cases:
+            print(f"{name:<20}{_time_per_call(fn, calls):>10.2f} ms")
+        database.close_connections()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
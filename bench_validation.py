@@ -0,0 +1,58 @@
+# bench_validation.py
+# 比較 jsonschema.validate (每次重新檢查/建立 validator)、預編譯 jsonschema validator 與 rfq_validator 的單次延遲。
+# 用法: python bench_validation.py [呼叫次數]
+
+import sys
+import time
+
+from rfq_schema import RFQ_SCHEMA
+from rfq_validator import iter_rfq_errors
+
+try:
+    import jsonschema
+    from jsonschema.validators import validator_for
+except ImportError:
+    jsonschema = None
+
+
+def _payload(n):
+    item = {
+        "material_type": "Stainless Steel",
+        "material_spec": "316L",
+        "form": "Bar",
+        "dimensions": "Ø50 x 1000",
+        "quantity": "10 pcs",
+        "qualification": "ISO",
+        "notes": "",
+    }
+    return {"items": [dict(item) for _ in range(n)]}
+
+
+def _time_per_call(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n * 1e6
+
+
+def main(calls=200):
+    if jsonschema is not None:
+        compiled = validator_for(RFQ_SCHEMA)(RFQ_SCHEMA)
+    else:
+        print("(未安裝 jsonschema，只量測 rfq_validator)")
+
+    print(f"{'items':>6}{'validate (us)':>16}{'precompiled (us)':>18}{'fast path (us)':>16}")
+    for size in (1, 100, 1000):
+        payload = _payload(size)
+        runs = max(1, calls // size) if size > 1 else calls
+        t_fast = _time_per_call(lambda: iter_rfq_errors(payload), runs)
+        if jsonschema is not None:
+            t_validate = _time_per_call(lambda: jsonschema.validate(payload, RFQ_SCHEMA), runs)
+            t_compiled = _time_per_call(lambda: list(compiled.iter_errors(payload)), runs)
+            print(f"{size:>6}{t_validate:>16.1f}{t_compiled:>18.1f}{t_fast:>16.1f}")
+        else:
+            print(f"{size:>6}{'-':>16}{'-':>18}{t_fast:>16.1f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
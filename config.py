@@ -71,7 +71,10 @@ TRANSLATIONS = {
         "actions": "Actions",
         "confirm_delete": "Confirm Delete",
         "delete_message": "Are you sure you want to delete this supplier?",
-        "select_options": "Select Options"
+        "select_options": "Select Options",
+        "search_hint": "Search name / contact / email / address",
+        "search_results": "Search \"{query}\": {count} results (by relevance)",
+        "page_info": "Page {page} · {total} suppliers"
     },
     "zh": {
         "app_title": "詢價系統",
@@ -96,6 +99,9 @@ TRANSLATIONS = {
         "actions": "操作",
         "confirm_delete": "確認刪除",
         "delete_message": "確定要刪除此供應商嗎？",
-        "select_options": "選擇選項"
+        "select_options": "選擇選項",
+        "search_hint": "搜尋名稱 / 聯絡人 / Email / 地址",
+        "search_results": "搜尋「{query}」: {count} 筆 (依相關度)",
+        "page_info": "第 {page} 頁 · 共 {total} 家"
     }
 }
@@ -1,56 +1,347 @@
+import email
+import imaplib
+import itertools
 import os
+import re
 import smtplib
+import threading
+import time
 from email.message import EmailMessage
 import ssl
-from imap_tools import MailBox, AND
+from imap_tools import MailBox, MailBoxUnencrypted, MailMessage, AND
+from imap_tools.imap_utf7 import utf7_encode
+from core.attachment_store import AttachmentTooLarge, iter_chunks
+
+IMAP_TIMEOUT = 30  # 秒: 單一 IMAP 指令的 socket 逾時
+IDLE_TIMEOUT = 5 * 60  # 秒: 每次 IDLE 最長等待 (rfc2177 要求 29 分鐘內重發；較短亦可補救 IDLE 開始前到達而漏接的信)
+POLL_MIN_INTERVAL = 5    # 秒: 不支援 IDLE 時，有新信後的輪詢間隔
+POLL_MAX_INTERVAL = 120  # 秒: 連續無新信時輪詢間隔的上限
+SYNC_FOLDER = "INBOX"
+HEADER_FETCH_BATCH = 200  # 增量同步時每個 UID FETCH 指令抓取的標頭數
+SMTP_TIMEOUT = 30  # 秒: 單一 SMTP 指令的 socket 逾時
+SEND_RATE_PER_MIN = 20  # send_bulk 預設每分鐘寄送上限 (Gmail 短時間大量寄送會回 421 4.7.0 暫時拒收)
+SEND_RETRIES = 1  # 連線中斷時同一封信重連後重送的次數
+
+def uid_set(uids):
+    """[1, 2, 3, 7] -> '1:3,7'：多個 UID 壓成一個 IMAP UID set，一次 UID STORE 即可"""
+    if isinstance(uids, (str, int)):
+        uids = [uids]
+    numbers = sorted({int(u) for u in uids})
+    ranges = []
+    for n in numbers:
+        if ranges and n == ranges[-1][1] + 1:
+            ranges[-1][1] = n
+        else:
+            ranges.append([n, n])
+    return ",".join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+
+_IMAP_TOKEN = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|\{\d+\}|[^\s()"]+')
+_OPEN, _CLOSE = object(), object()
+
+
+def _imap_tokens(data):
+    """imaplib 回應 (bytes 與 (前綴, literal) tuple 混合) 拆成 token；NIL 為 None"""
+    for item in data:
+        head, literal = item if isinstance(item, tuple) else (item, None)
+        for token in _IMAP_TOKEN.findall(head or b""):
+            if token == b"(":
+                yield _OPEN
+            elif token == b")":
+                yield _CLOSE
+            elif token.startswith(b'"'):
+                yield re.sub(rb'\\(.)', rb'\1', token[1:-1]).decode(errors="replace")
+            elif not token.startswith(b"{"):  # {n} 為 literal 長度，內容在 tuple 第二項
+                yield None if token.upper() == b"NIL" else token.decode(errors="replace")
+        if literal is not None:
+            yield literal.decode(errors="replace")
+
+
+def _imap_lists(data):
+    """FETCH 回應解析成巢狀 list，每封信一個，如 ['UID', '5', 'BODYSTRUCTURE', [...]]"""
+    stack, responses = [[]], []
+    for token in _imap_tokens(data):
+        if token is _OPEN:
+            stack.append([])
+        elif token is _CLOSE and len(stack) > 1:
+            done = stack.pop()
+            stack[-1].append(done)
+            if len(stack) == 1:
+                responses.append(done)
+        elif token is not _CLOSE:
+            stack[-1].append(token)
+    return responses
+
+
+def _part_filename(part):
+    # body-fld-param ("NAME" "a.pdf") 或 body-fld-dsp ("ATTACHMENT" ("FILENAME" "a.pdf"))
+    for field in part[2:]:
+        if not isinstance(field, list):
+            continue
+        params = field[1] if len(field) == 2 and isinstance(field[1], list) else field
+        for key, value in zip(params[::2], params[1::2]):
+            if isinstance(key, str) and key.upper() in ("FILENAME", "NAME") and isinstance(value, str):
+                return value
+    return ""
+
+
+def body_parts(structure, section=""):
+    """走訪 BODYSTRUCTURE 的葉節點，產生 (section, 解碼後估計大小, 檔名)；附帶的 .eml (message/rfc822) 視為單一部分"""
+    if isinstance(structure[0], list):
+        children = itertools.takewhile(lambda child: isinstance(child, list), structure)
+        for i, child in enumerate(children, 1):
+            yield from body_parts(child, f"{section}.{i}" if section else str(i))
+        return
+    size = int(structure[6] or 0)
+    if (structure[5] or "").upper() == "BASE64":
+        size = size * 3 // 4
+    yield section or "1", size, _part_filename(structure)
+
+class AdaptivePoller:
+    """伺服器不支援 IDLE 時的輪詢間隔：有新信立即回到最短間隔，連續空輪詢則倍增至上限"""
+    def __init__(self, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+
+    def next_interval(self, found_mail):
+        if found_mail:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * 2)
+        return self.interval
 
 class GmailClient:
-    def __init__(self, user, pwd):
+    def __init__(self, user, pwd, imap_server="imap.gmail.com", imap_port=993, imap_ssl=True, attachment_store=None,
+                 smtp_server="smtp.gmail.com", smtp_port=465, smtp_ssl=True):
         self.user = user
         self.pwd = pwd
-        self.imap_server = "imap.gmail.com"
-        self.smtp_server = "smtp.gmail.com"
-        self.smtp_port = 465
+        self.imap_server = imap_server
+        self.imap_port = imap_port
+        self.imap_ssl = imap_ssl
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.smtp_ssl = smtp_ssl
+        # 長駐 SMTP 連線：send_bulk 整批 (及之後的批次) 共用，只做一次 TLS 交握與登入
+        self._smtp = None
+        self._smtp_lock = threading.Lock()
+        self._next_send_at = 0.0
+        self.smtp_login_count = 0
+        # 長駐 IMAP 連線：所有操作共用，斷線時自動重新登入
+        self._mailbox = None
+        self._lock = threading.RLock()
+        self.login_count = 0
+        # 指定 AttachmentStore 時，附件依內容雜湊去重，base_save_dir 內只放硬連結
+        self.attachment_store = attachment_store
+
+    def _connect(self):
+        mailbox_class = MailBox if self.imap_ssl else MailBoxUnencrypted
+        mailbox = mailbox_class(self.imap_server, self.imap_port, timeout=IMAP_TIMEOUT)
+        mailbox.login(self.user, self.pwd)
+        self.login_count += 1
+        return mailbox
+
+    def _drop(self):
+        mailbox, self._mailbox = self._mailbox, None
+        if mailbox is not None:
+            try:
+                mailbox.logout()
+            except Exception:
+                pass
+
+    def _with_mailbox(self, action):
+        """
+        在長駐連線上執行 action(mailbox)。
+        連線已被伺服器關閉 (閒置逾時、網路中斷) 時重新登入並重試一次；action 必須可安全重做。
+        """
+        with self._lock:
+            for attempt in range(2):
+                if self._mailbox is None:
+                    self._mailbox = self._connect()
+                try:
+                    return action(self._mailbox)
+                except (imaplib.IMAP4.abort, OSError):
+                    self._drop()
+                    if attempt:
+                        raise
+
+    def close(self):
+        with self._lock:
+            self._drop()
+        with self._smtp_lock:
+            self._smtp_drop()
+
+    def supports_idle(self):
+        return self._with_mailbox(lambda mailbox: "IDLE" in mailbox.client.capabilities)
+
+    def wait_for_new_mail(self, timeout=IDLE_TIMEOUT):
+        """
+        以 IMAP IDLE 等待伺服器推播，有新信 (EXISTS) 立即返回 True；逾時回傳 False。
+        伺服器不支援 IDLE 時回傳 None，由呼叫端改用 AdaptivePoller 輪詢。
+        IDLE 期間會佔用長駐連線，其他操作需等待本次 IDLE 結束。
+        """
+        def _idle(mailbox):
+            if "IDLE" not in mailbox.client.capabilities:
+                return None
+            responses = mailbox.idle.wait(timeout=timeout)
+            return any(b"EXISTS" in r for r in responses)
+        return self._with_mailbox(_idle)
+
+    @staticmethod
+    def _store(mailbox, msg_uids, *args):
+        typ, data = mailbox.client.uid('STORE', uid_set(msg_uids), *args)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"UID STORE failed: {data}")
+
+    def _save_messages(self, messages, base_save_dir, store=None):
+        """下載內文與附件 (.pdf / .eml)，轉成 Agent 使用的 dict"""
+        rfq_emails = []
+        for msg in messages:
+            attachments_info = []
+            digests = []
+
+            for att in msg.attachments:
+                if att.filename.lower().endswith((".pdf", ".eml")):
+                    # 強制加入 uid 避免不同信件的同名附件覆蓋
+                    safe_filename = f"{msg.uid}_{att.filename}"
+                    file_path = os.path.join(base_save_dir, safe_filename)
+
+                    if store is None:
+                        with open(file_path, "wb") as f:
+                            f.write(att.payload)
+                    else:
+                        try:
+                            # 邊寫邊計算雜湊，以 memoryview 分段寫入不另外複製 payload
+                            digest, blob = store.put_stream(iter_chunks(att.payload))
+                        except AttachmentTooLarge as e:
+                            print(f"[Gmail Warning] Skipped attachment {att.filename} (UID {msg.uid}): {e}")
+                            continue
+                        store.link(blob, file_path)
+                        digests.append(digest)
+                    attachments_info.append(file_path)
+
+            # 優先使用純文字，避免 HTML 標籤消耗 Token
+            clean_text = msg.text if msg.text else msg.html
+
+            rfq_emails.append({
+                "uid": msg.uid,
+                "subject": msg.subject,
+                "from": msg.from_,
+                "text": clean_text,
+                "attachments": attachments_info,
+                "attachment_digests": digests,
+                "date": msg.date
+            })
+        return rfq_emails
+
+    @staticmethod
+    def _fetch_structures(mailbox, uids):
+        """一個 UID FETCH 取得各信件的 BODYSTRUCTURE：{uid: [(section, 大小, 檔名), ...]}"""
+        typ, data = mailbox.client.uid('FETCH', uid_set(uids), '(UID BODYSTRUCTURE)')
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"UID FETCH BODYSTRUCTURE failed: {data}")
+        structures = {}
+        for response in _imap_lists(data):
+            fields = {str(k).upper(): v for k, v in zip(response[::2], response[1::2])}
+            if "UID" in fields and isinstance(fields.get("BODYSTRUCTURE"), list):
+                structures[fields["UID"]] = list(body_parts(fields["BODYSTRUCTURE"]))
+        return structures
+
+    @staticmethod
+    def _fetch_without_parts(mailbox, uid, parts, max_bytes):
+        """只下載標頭與未超過上限的部分，重組成不含大附件的信件 (大附件不會經過網路與記憶體)"""
+        kept = []
+        for section, size, filename in parts:
+            if size > max_bytes:
+                print(f"[Gmail Warning] Skipped attachment {filename or section} (UID {uid}): 約 {size} bytes 超過上限 {max_bytes} bytes")
+            else:
+                kept.append(section)
+        items = "BODY.PEEK[HEADER]" + "".join(f" BODY.PEEK[{s}.MIME] BODY.PEEK[{s}]" for s in kept)
+        typ, data = mailbox.client.uid('FETCH', str(uid), f"(UID {items})")
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"UID FETCH failed: {data}")
+        sections = {}
+        for item in data:
+            if isinstance(item, tuple):
+                names = re.findall(rb'BODY\[([^\]]*)\]', item[0])
+                if names:
+                    sections[names[-1].decode().upper()] = item[1]
+        header = sections.get("HEADER", b"")
+        boundary = email.message_from_bytes(header).get_boundary()
+        if boundary and kept:
+            # 各部分攤平放在最外層 boundary 之下 (text / html / 附件的判斷只看各部分自己的標頭)
+            delimiter = b"--" + boundary.encode()
+            raw = header.rstrip(b"\r\n") + b"\r\n\r\n" + b"".join(
+                delimiter + b"\r\n" + sections.get(f"{s}.MIME", b"") + sections.get(s, b"") + b"\r\n" for s in kept
+            ) + delimiter + b"--\r\n"
+        else:
+            # 唯一的部分就是大附件：只留寄件者、主旨等標頭
+            msg = email.message_from_bytes(header)
+            for name in ("Content-Type", "Content-Disposition", "Content-Transfer-Encoding"):
+                del msg[name]
+            raw = msg.as_bytes()
+        return MailMessage([(f"UID {uid} BODY[] {{{len(raw)}}}".encode(), raw)])
+
+    def _fetch_bodies(self, mailbox, uids):
+        """逐封下載內文與附件；有附件倉庫時先以 BODYSTRUCTURE 檢查大小，超過上限的部分不下載"""
+        if self.attachment_store is None:
+            yield from mailbox.fetch(uid_list=uids, mark_seen=False)
+            return
+        max_bytes = self.attachment_store.max_bytes
+        structures = self._fetch_structures(mailbox, uids)
+        for uid in uids:
+            parts = structures.get(str(uid), [])
+            if any(size > max_bytes for _, size, _ in parts):
+                yield self._fetch_without_parts(mailbox, uid, parts, max_bytes)
+            else:
+                yield from mailbox.fetch(uid_list=[uid], mark_seen=False)
 
     def fetch_unprocessed_rfqs(self, base_save_dir):
         """
-        抓取未讀且標題含 RFQ 的信件。
+        抓取未讀且標題含 RFQ 的信件 (完整掃描；Agent 改用 sync_new_rfqs 增量同步)。
         附件將依據 UID 建立獨立資料夾或命名。
         """
-        rfq_emails = []
         os.makedirs(base_save_dir, exist_ok=True)
-
         try:
-            with MailBox(self.imap_server).login(self.user, self.pwd) as mailbox:
-                # mark_seen=False: 確保系統處理完畢前，信件保持未讀，避免漏單
-                for msg in mailbox.fetch(AND(seen=False, subject="RFQ"), mark_seen=False):
-                    attachments_info = []
-
-                    for att in msg.attachments:
-                        if att.filename.lower().endswith((".pdf", ".eml")):
-                            # 強制加入 uid 避免不同信件的同名附件覆蓋
-                            safe_filename = f"{msg.uid}_{att.filename}"
-                            file_path = os.path.join(base_save_dir, safe_filename)
-
-                            with open(file_path, "wb") as f:
-                                f.write(att.payload)
-                            attachments_info.append(file_path)
-
-                    # 優先使用純文字，避免 HTML 標籤消耗 Token
-                    clean_text = msg.text if msg.text else msg.html
-
-                    rfq_emails.append({
-                        "uid": msg.uid,
-                        "subject": msg.subject,
-                        "from": msg.from_,
-                        "text": clean_text,
-                        "attachments": attachments_info,
-                        "date": msg.date
-                    })
+            # mark_seen=False: 確保系統處理完畢前，信件保持未讀，避免漏單
+            return self._with_mailbox(lambda mailbox: self._save_messages(
+                mailbox.fetch(AND(seen=False, subject="RFQ"), mark_seen=False), base_save_dir))
         except Exception as e:
             print(f"[Gmail Error] Fetching emails failed: {e}")
+            return []
 
-        return rfq_emails
+    def sync_new_rfqs(self, base_save_dir, state=None):
+        """
+        增量同步：只處理 UID 高於上次高水位的未讀信。
+        1) STATUS 取得 UIDVALIDITY / UIDNEXT，沒有新 UID 即返回 (一個指令)
+        2) 只抓新 UID 的標頭，篩出主旨含 RFQ 的信
+        3) 只對符合的信下載內文與附件
+        state 為上次的 (uidvalidity, last_uid)；UIDVALIDITY 改變代表 UID 已重新編號，從頭掃描。
+        回傳 (emails, (uidvalidity, 已掃描到的 UID))；呼叫端處理完畢後再將高水位寫回 DB。
+        """
+        os.makedirs(base_save_dir, exist_ok=True)
+
+        def _sync(mailbox):
+            status = mailbox.folder.status(SYNC_FOLDER, ["UIDVALIDITY", "UIDNEXT"])
+            uidvalidity = status["UIDVALIDITY"]
+            last_uid = state[1] if state and state[0] == uidvalidity else 0
+            if "UIDNEXT" in status and status["UIDNEXT"] - 1 <= last_uid:
+                return [], (uidvalidity, last_uid)
+
+            # "n:*" 在沒有更大的 UID 時仍會回傳最後一封，需再過濾一次
+            uids = [u for u in mailbox.uids(AND(uid=f"{last_uid + 1}:*", seen=False)) if int(u) > last_uid]
+            scanned = max([status.get("UIDNEXT", 1) - 1, last_uid] + [int(u) for u in uids])
+            if not uids:
+                return [], (uidvalidity, scanned)
+            headers = mailbox.fetch(uid_list=uids, headers_only=True, mark_seen=False, bulk=HEADER_FETCH_BATCH)
+            matching = [msg.uid for msg in headers if "rfq" in msg.subject.lower()]
+            if not matching:
+                return [], (uidvalidity, scanned)
+            # 內文逐封抓取，避免一次載入多封大附件
+            bodies = self._fetch_bodies(mailbox, matching)
+            return self._save_messages(bodies, base_save_dir, self.attachment_store), (uidvalidity, scanned)
+
+        return self._with_mailbox(_sync)
 
     def send_mail(self, to_addr, subject, body, bcc_self=True):
         msg = EmailMessage()
@@ -71,21 +362,116 @@ class GmailClient:
         except Exception as e:
             print(f"[Gmail Error] Failed to send email: {e}")
 
-    def update_label(self, msg_uid, new_label):
+    def _smtp_connect(self):
+        if self.smtp_ssl:
+            server = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port, context=ssl.create_default_context(), timeout=SMTP_TIMEOUT)
+        else:
+            server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=SMTP_TIMEOUT)
+            server.ehlo()
+            if server.has_extn("starttls"):
+                server.starttls(context=ssl.create_default_context())
+        try:
+            server.login(self.user, self.pwd)
+        except Exception:
+            server.close()
+            raise
+        self.smtp_login_count += 1
+        return server
+
+    def _smtp_drop(self):
+        server, self._smtp = self._smtp, None
+        if server is not None:
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+
+    def _throttle(self, interval):
+        """兩封信之間至少間隔 interval 秒 (跨 send_bulk 呼叫亦同)"""
+        now = time.monotonic()
+        if self._next_send_at > now:
+            time.sleep(self._next_send_at - now)
+            now = self._next_send_at
+        self._next_send_at = now + interval
+
+    def _send_one(self, msg):
+        result = {"to": msg['To'], "subject": msg['Subject'], "ok": False, "error": None, "refused": {}}
+        for attempt in range(SEND_RETRIES + 1):
+            try:
+                if self._smtp is None:
+                    self._smtp = self._smtp_connect()
+                refused = self._smtp.send_message(msg)
+                result.update(ok=True, error=None, refused={
+                    rcpt: f"{code} {reply.decode(errors='replace')}" for rcpt, (code, reply) in refused.items()
+                })
+                return result
+            except smtplib.SMTPAuthenticationError:
+                raise
+            except smtplib.SMTPRecipientsRefused as e:
+                result["error"] = f"所有收件人皆被拒收: {', '.join(e.recipients)}"
+                return result
+            except smtplib.SMTPResponseException as e:
+                result["error"] = f"{e.smtp_code} {e.smtp_error.decode(errors='replace') if isinstance(e.smtp_error, bytes) else e.smtp_error}"
+                if e.smtp_code != 421:  # 421: 伺服器即將關閉連線，重連後重送；其餘為此封信本身的錯誤
+                    return result
+                self._smtp_drop()
+            except (smtplib.SMTPServerDisconnected, OSError) as e:
+                # 閒置逾時或網路中斷：下一輪重新連線登入
+                result["error"] = str(e) or e.__class__.__name__
+                server, self._smtp = self._smtp, None
+                if server is not None:
+                    server.close()
+        return result
+
+    def send_bulk(self, messages, rate_per_min=SEND_RATE_PER_MIN):
+        """
+        以同一條已登入的 SMTP 連線依序寄出多封 EmailMessage (未設 From 時以本帳號寄出)。
+        依 rate_per_min 節流；伺服器中途斷線或回 421 時自動重連並重送該封，單封被拒不影響其他封。
+        回傳與 messages 同順序的結果 [{"to", "subject", "ok", "error", "refused"}]。
         """
+        messages = list(messages)
+        interval = 60.0 / rate_per_min if rate_per_min else 0.0
+        results = []
+        with self._smtp_lock:
+            for i, msg in enumerate(messages):
+                if msg['From'] is None:
+                    msg['From'] = self.user
+                self._throttle(interval)
+                try:
+                    results.append(self._send_one(msg))
+                except smtplib.SMTPAuthenticationError as e:
+                    # 帳密錯誤重試也無用：其餘信件直接回報失敗
+                    error = f"SMTP 登入失敗: {e.smtp_code}"
+                    results += [{"to": m['To'], "subject": m['Subject'], "ok": False, "error": error, "refused": {}}
+                                for m in messages[i:]]
+                    break
+        sent = sum(r["ok"] for r in results)
+        print(f"[Gmail Info] Bulk send finished: {sent}/{len(results)} sent")
+        return results
+
+    def update_label(self, msg_uids, new_label):
+        """
+        為一或多封信件加上標籤 (單一 UID STORE 指令)。
         注意：使用此功能前，必須先在 Gmail 網頁端手動建立對應名稱的標籤
         """
+        # 標籤名稱須以 modified UTF-7 傳送 (imaplib 只接受 ASCII 字串)
+        label = b'"' + utf7_encode(new_label) + b'"'
         try:
-            with MailBox(self.imap_server).login(self.user, self.pwd) as mailbox:
-                mailbox.client.uid('STORE', str(msg_uid), '+X-GM-LABELS', f'"{new_label}"')
-                print(f"[Gmail Info] Label '{new_label}' added to message UID {msg_uid}")
+            self._with_mailbox(lambda mailbox: self._store(mailbox, msg_uids, '+X-GM-LABELS', label))
+            print(f"[Gmail Info] Label '{new_label}' added to message UID {uid_set(msg_uids)}")
         except Exception as e:
             print(f"[Gmail Error] Error updating label: {e}")
 
-    def mark_as_read(self, msg_uid):
-        """將信件標記為已讀，於生成草稿後呼叫"""
+    def mark_as_read(self, msg_uids):
+        """將一或多封信件標記為已讀 (單一 UID STORE 指令)，於生成草稿後呼叫"""
         try:
-            with MailBox(self.imap_server).login(self.user, self.pwd) as mailbox:
-                mailbox.flag(str(msg_uid), '\\Seen', True)
+            self._with_mailbox(lambda mailbox: self._store(mailbox, msg_uids, '+FLAGS', '(\\Seen)'))
         except Exception as e:
             print(f"[Gmail Error] Failed to mark as read: {e}")
+
+    def mark_processed(self, msg_uids, label):
+        """整批處理完畢的信件：標為已讀並加上標籤，共兩個 UID STORE 指令、不重新登入"""
+        if not msg_uids:
+            return
+        self.mark_as_read(msg_uids)
+        self.update_label(msg_uids, label)
@@ -1,9 +1,70 @@
 import re
+import asyncio
 import logging
 import os
+from collections import OrderedDict
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.helpers import escape_markdown
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
 
+TG_RATE_PER_MIN = 20  # 群組每分鐘約 20 則的洪水限制
+TG_BURST = 3  # 閒置後可連續送出的則數
+DIGEST_THRESHOLD = 3  # 待送通知超過此數量時合併成彙整訊息
+DIGEST_MAX_ITEMS = 10  # 每則彙整訊息最多列出的 RFQ 數
+TG_MAX_MESSAGE_LENGTH = 4096  # Telegram 單則訊息字數上限
+DIGEST_HEADER = "[RFQ 審核彙整]"
+PENDING_MAX = 500  # 記憶體中保留的待審核草稿數 (供「📄 完整草稿」按鈕)；超過的由 loader 從 DB 重新載入
+
+
+class TokenBucket:
+    """權杖桶限流：每分鐘補充 rate_per_min 個，最多累積 capacity 個；acquire 取不到時等待補充"""
+    def __init__(self, rate_per_min=TG_RATE_PER_MIN, capacity=TG_BURST):
+        self.rate = rate_per_min / 60.0
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = None
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self.updated is not None:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def split_message(text, limit=TG_MAX_MESSAGE_LENGTH):
+    """
+    依行切分超過 limit 的訊息；切點落在 ``` 區塊內時於段尾補上結束符號、下一段重新開啟，
+    每段仍是合法的 Markdown。單行超長時硬切。
+    """
+    if len(text) <= limit:
+        return [text]
+    budget = limit - len("\n```")  # 保留段尾補上結束符號的空間
+    parts, current, fence = [], [], None
+
+    def close():
+        parts.append("\n".join(current + (["```"] if fence else [])))
+
+    for line in text.split("\n"):
+        room = budget - len(fence or "") - 1  # 新段開頭可能需重開 ```
+        for chunk in [line[i:i + room] for i in range(0, len(line), room)] or [""]:
+            if current and len("\n".join(current)) + 1 + len(chunk) > budget:
+                close()
+                current = [fence] if fence else []
+            current.append(chunk)
+        if line.startswith("```"):
+            fence = None if fence else line
+    if current:
+        parts.append("\n".join(current))
+    return parts
+
+
 class TGBotHandler:
     """
     優化建議實作清單：
@@ -11,14 +72,25 @@ class TGBotHandler:
     2. 穩定提取 ID (Regex): 透過正則表達式精準抓取 ID: `RFQ_ID` 格式，避免手動解析錯誤。
     3. 就地更新狀態 (query.edit_message_text): 點擊按鈕後直接更新原訊息，保持視窗整潔，減少冗餘通知。
     4. 異步對接預留: handle_text_reply 已預留介面供 Jules 接入 AI 重新擬稿邏輯。
+    5. 通知佇列 (outbox): 權杖桶限流、積壓時合併為彙整訊息、超長訊息自動切段。
     """
 
-    def __init__(self, token: str, allowed_chat_id: str):
+    def __init__(self, token: str, allowed_chat_id: str, loader=None):
         self.token = token
         # 轉換為 int 確保比對效能與正確性
         self.allowed_chat_id = int(allowed_chat_id)
         self.application = Application.builder().token(self.token).build()
 
+        # 對外通知佇列：send_draft_for_approval 只排入佇列，由背景 sender 依權杖桶送出，
+        # 積壓時合併成彙整訊息；呼叫端 (郵件管線) 不會因 Telegram 限流而被卡住
+        self.outbox = asyncio.Queue()  # (rfq_id, summary, draft_text, waiter)
+        self.limiter = TokenBucket()
+        # rfq_id -> (summary, draft_text)，供彙整訊息的「📄 完整草稿」按鈕展開；只保留最近 PENDING_MAX 筆
+        self.pending = OrderedDict()
+        # loader(rfq_id) -> (summary, draft_text) 或 None：pending 中沒有時 (重啟或已移出) 從 DB 取回
+        self.loader = loader
+        self._sender_task = None
+
         # [建議 1] 權限過濾器：統一管理進入 Handler 的權限
         self.auth_filter = filters.Chat(chat_id=self.allowed_chat_id)
 
@@ -30,12 +102,45 @@ class TGBotHandler:
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("🟢 SMMC RFQ 數位採購助理已上線。")
 
-    async def send_draft_for_approval(self, rfq_id: str, summary: str, draft_text: str):
+    async def send_draft_for_approval(self, rfq_id: str, summary: str, draft_text: str, wait: bool = False):
         """
-        發送解析結果與草稿。
-        使用 Markdown 區塊 (```) 方便手機端一鍵點擊複製。
+        排入待審核通知；實際送出由 _sender 依限流與積壓量決定單則或彙整。
+        wait=False 立即返回；wait=True 等到訊息實際送達才返回，送出失敗時拋出例外 (郵件管線據此重試，至少送達一次)。
         """
-        keyboard = [
+        self._remember(rfq_id, summary, draft_text)
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future() if wait else None
+        self.outbox.put_nowait((rfq_id, summary, draft_text, waiter))
+        if self._sender_task is None or self._sender_task.done():
+            self._sender_task = loop.create_task(self._sender())
+        if waiter is not None:
+            await waiter
+
+    def _remember(self, rfq_id, summary, draft_text):
+        self.pending[rfq_id] = (summary, draft_text)
+        self.pending.move_to_end(rfq_id)
+        while len(self.pending) > PENDING_MAX:
+            self.pending.popitem(last=False)
+
+    async def _lookup(self, rfq_id):
+        """取得待審核內容：先查 pending，沒有時以 loader 從 DB 載入"""
+        entry = self.pending.get(rfq_id)
+        if entry is None and self.loader is not None:
+            try:
+                entry = await asyncio.to_thread(self.loader, rfq_id)
+            except Exception as e:
+                logging.error(f"無法載入 {rfq_id} 的草稿: {e}")
+            if entry is not None:
+                self._remember(rfq_id, *entry)
+        return entry
+
+    async def flush(self):
+        """等待佇列中的通知全部送出"""
+        await self.outbox.join()
+
+    @staticmethod
+    def _approval_keyboard(rfq_id):
+        return [
             [
                 InlineKeyboardButton("✅ 確認發送", callback_data=f"send_{rfq_id}"),
                 InlineKeyboardButton("💾 存為草稿", callback_data=f"draft_{rfq_id}")
@@ -45,22 +150,124 @@ class TGBotHandler:
             ]
         ]
 
+    def _render_approval(self, rfq_id, summary, draft_text):
+        """
+        單筆審核訊息，回傳 (內文, 按鈕, 續段標頭)。
+        使用 Markdown 區塊 (```) 方便手機端一鍵點擊複製。
+        """
+        header = f"📥 **[RFQ 審核]**\nID: `{rfq_id}`"
         message_text = (
-            f"📥 **[RFQ 審核]**\n"
-            f"ID: `{rfq_id}`\n"
+            f"{header}\n"
             f"━━━━━━━━━━━━━━━━━━\n"
-            f"📋 **解析摘要**:\n{summary}\n\n"
+            f"📋 **解析摘要**:\n{escape_markdown(summary)}\n\n"
             f"📧 **預計發送草稿**:\n```text\n{draft_text}\n```\n"
             f"━━━━━━━━━━━━━━━━━━\n"
             f"💡 *若需修正，請直接「回覆」此訊息輸入指令*"
         )
+        return message_text, self._approval_keyboard(rfq_id), header
 
-        await self.application.bot.send_message(
-            chat_id=self.allowed_chat_id,
-            text=message_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode="Markdown"
-        )
+    def _render_digest(self, entries):
+        """多筆合併為一則：只列摘要，每筆一列按鈕 (📄 展開完整草稿供回覆修正)。entries: rfq_id -> (summary, draft_text)"""
+        header = f"📥 **{DIGEST_HEADER}** 共 {len(entries)} 筆"
+        lines = [header, "━━━━━━━━━━━━━━━━━━"]
+        keyboard = []
+        for i, (rfq_id, (summary, _)) in enumerate(entries.items(), 1):
+            summary = escape_markdown(summary.replace("\n", "｜"))  # 料號中的 _ * 等不可破壞整則彙整
+            lines.append(f"{i}. `{rfq_id}` {summary}")
+            keyboard.append([
+                InlineKeyboardButton(f"📄 {rfq_id}", callback_data=f"view_{rfq_id}"),
+                InlineKeyboardButton("✅", callback_data=f"send_{rfq_id}"),
+                InlineKeyboardButton("💾", callback_data=f"draft_{rfq_id}"),
+                InlineKeyboardButton("❌", callback_data=f"discard_{rfq_id}")
+            ])
+        return "\n".join(lines), keyboard, header
+
+    async def _sender(self):
+        """
+        每取得一個權杖送出一則；積壓超過 DIGEST_THRESHOLD 時一次合併最多 DIGEST_MAX_ITEMS 筆。
+        送達後通知等待中的呼叫端；失敗時把例外交給等待者 (無人等待的只記 log)。
+        彙整訊息因 Markdown 無法解析被拒時改為逐筆送出，只有出問題的那筆失敗。
+        """
+        while True:
+            taken = [await self.outbox.get()]
+            failed = {}  # rfq_id -> 例外
+            try:
+                await self.limiter.acquire()
+                # 等權杖期間累積的通知一併處理
+                if 1 + self.outbox.qsize() > DIGEST_THRESHOLD:
+                    while len(taken) < DIGEST_MAX_ITEMS and not self.outbox.empty():
+                        taken.append(self.outbox.get_nowait())
+                # 同一 RFQ 重複排入時只送最新內容
+                entries = {rfq_id: (summary, draft_text) for rfq_id, summary, draft_text, _ in taken}
+                if len(entries) > 1:
+                    try:
+                        await self._send_rendered(*self._render_digest(entries), token_acquired=True)
+                    except BadRequest as e:
+                        if "parse" not in str(e).lower():
+                            raise
+                        logging.warning(f"彙整訊息無法解析，改為逐筆送出: {e}")
+                        failed = await self._send_each(entries)
+                else:
+                    [(rfq_id, (summary, draft_text))] = entries.items()
+                    await self._send_rendered(*self._render_approval(rfq_id, summary, draft_text), token_acquired=True)
+            except asyncio.CancelledError:
+                for *_, waiter in taken:
+                    if waiter is not None:
+                        waiter.cancel()
+                raise
+            except Exception as e:
+                logging.error(f"Telegram 通知失敗 ({', '.join(item[0] for item in taken)}): {e}")
+                failed = {item[0]: e for item in taken}
+            finally:
+                for rfq_id, _, _, waiter in taken:
+                    if waiter is not None and not waiter.done():
+                        if rfq_id in failed:
+                            waiter.set_exception(failed[rfq_id])
+                        else:
+                            waiter.set_result(None)
+                for _ in taken:
+                    self.outbox.task_done()
+
+    async def _send_each(self, entries):
+        """逐筆送出單筆審核訊息；回傳 {rfq_id: 例外} (只含失敗的)"""
+        failed = {}
+        for rfq_id, (summary, draft_text) in entries.items():
+            try:
+                await self._send_rendered(*self._render_approval(rfq_id, summary, draft_text))
+            except Exception as e:
+                logging.error(f"Telegram 通知失敗 ({rfq_id}): {e}")
+                failed[rfq_id] = e
+        return failed
+
+    async def _send_rendered(self, text, keyboard, header=None, token_acquired=False):
+        """
+        超長訊息自動切段，每段各取一個權杖；按鈕附在最後一段。
+        續段開頭重複 header (標題與 ID)，回覆任何一段都能取得 RFQ ID，彙整訊息的按鈕也仍能辨識。
+        """
+        limit = TG_MAX_MESSAGE_LENGTH - len(header) - 1 if header else TG_MAX_MESSAGE_LENGTH
+        parts = split_message(text, limit)
+        for i, part in enumerate(parts):
+            if i or not token_acquired:
+                await self.limiter.acquire()
+            if i and header:
+                part = f"{header}\n{part}"
+            await self._deliver(part, InlineKeyboardMarkup(keyboard) if i == len(parts) - 1 else None)
+
+    async def _deliver(self, text, reply_markup=None):
+        """送出一則訊息；遇到洪水限制 (RetryAfter) 依伺服器指示等待後重送"""
+        while True:
+            try:
+                return await self.application.bot.send_message(
+                    chat_id=self.allowed_chat_id,
+                    text=text,
+                    reply_markup=reply_markup,
+                    parse_mode="Markdown"
+                )
+            except RetryAfter as e:
+                delay = e.retry_after
+                delay = delay.total_seconds() if hasattr(delay, "total_seconds") else delay
+                logging.warning(f"Telegram 洪水限制，{delay} 秒後重送")
+                await asyncio.sleep(delay)
 
     async def handle_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """[建議 3] 處理按鈕點擊：更新原訊息狀態，防止重複點擊並節省空間"""
@@ -71,15 +278,32 @@ class TGBotHandler:
             await query.answer("Access Denied", show_alert=True)
             return
 
-        await query.answer()
         action, rfq_id = query.data.split("_", 1)
 
+        if action == "view":
+            # 彙整訊息中的單筆：另送完整審核訊息 (可直接回覆修正)
+            await query.answer()
+            entry = await self._lookup(rfq_id)
+            if entry is not None:
+                await self._send_rendered(*self._render_approval(rfq_id, *entry))
+            return
+
+        self.pending.pop(rfq_id, None)
         status_msg = {
             "send": f"✅ **RFQ `{rfq_id}`** 已進入發送排程。",
             "draft": f"💾 **RFQ `{rfq_id}`** 已存為草稿。",
             "discard": f"🗑️ **RFQ `{rfq_id}`** 已捨棄處理。"
         }.get(action, "未知操作")
 
+        if DIGEST_HEADER in (query.message.text or ""):
+            # 彙整訊息：只移除該筆的按鈕列，其餘 RFQ 仍可操作
+            await query.answer(status_msg.replace("*", "").replace("`", ""))
+            rows = [row for row in query.message.reply_markup.inline_keyboard
+                    if not any(button.callback_data.endswith(f"_{rfq_id}") for button in row)]
+            await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(rows) if rows else None)
+            return
+
+        await query.answer()
         # 就地修改訊息內容
         await query.edit_message_text(text=status_msg, parse_mode="Markdown")
 
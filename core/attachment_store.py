@@ -0,0 +1,123 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from typing import Iterable, Tuple
+
+from core.config import Config
+
+CHUNK_SIZE = 1024 * 1024  # 1 MiB: 串流寫入 / 計算雜湊的區塊大小
+
+
+class AttachmentTooLarge(ValueError):
+    pass
+
+
+def iter_chunks(data: bytes, size: int = CHUNK_SIZE):
+    """以 memoryview 切成固定大小的區塊 (不複製內容)，供 put_stream 寫入"""
+    view = memoryview(data)
+    return (view[i:i + size] for i in range(0, len(view), size))
+
+
+def file_digest(path: str) -> str:
+    """以固定大小區塊計算檔案 SHA-256，不一次載入整個檔案"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class AttachmentStore:
+    """
+    以 SHA-256 定址的附件倉庫：相同內容只存一份 (blobs/ab/abcdef...，不含副檔名，同內容不同副檔名也只存一份)，
+    各 RFQ 目錄以硬連結引用；檔案系統不支援硬連結時退回複製。
+    """
+    def __init__(self, base_path: str = os.path.join("rfq_archives", "_blobs"), max_bytes: int = None):
+        self.base_path = base_path
+        self.max_bytes = max_bytes if max_bytes is not None else int(Config.ATTACHMENT_MAX_MB * 1024 * 1024)
+        self.dedup_hits = 0
+        self._stats_lock = threading.Lock()  # 多個 worker 執行緒共用同一個 store
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.base_path, digest[:2], digest)
+
+    def _check_size(self, size: int):
+        if size > self.max_bytes:
+            raise AttachmentTooLarge(f"附件大小 {size} bytes 超過上限 {self.max_bytes} bytes")
+
+    def put(self, data: bytes) -> Tuple[str, str]:
+        """存入記憶體中的內容；已存在相同雜湊時不再寫入。回傳 (digest, blob 路徑)"""
+        self._check_size(len(data))
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        if os.path.exists(path):
+            self._count_dedup_hit()
+            return digest, path
+        return self._commit(digest, path, iter_chunks(data))
+
+    def put_stream(self, chunks: Iterable[bytes]) -> Tuple[str, str]:
+        """邊寫入暫存檔邊計算雜湊，超過上限立即中止；內容重複時丟棄暫存檔"""
+        os.makedirs(self.base_path, exist_ok=True)
+        h = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.base_path, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    self._check_size(size)
+                    h.update(chunk)
+                    f.write(chunk)
+            digest = h.hexdigest()
+            path = self.blob_path(digest)
+            if os.path.exists(path):
+                self._count_dedup_hit()
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            return digest, path
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _count_dedup_hit(self):
+        with self._stats_lock:
+            self.dedup_hits += 1
+
+    def _commit(self, digest: str, path: str, chunks) -> Tuple[str, str]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest, path
+
+    @staticmethod
+    def link(blob_path: str, dest_path: str) -> str:
+        """在 dest_path 建立指向 blob 的硬連結 (已存在同一檔案則略過)"""
+        os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+        if os.path.exists(dest_path):
+            if os.path.samefile(blob_path, dest_path):
+                return dest_path
+            os.remove(dest_path)
+        try:
+            os.link(blob_path, dest_path)
+        except OSError as e:
+            logging.warning(f"無法建立硬連結 ({e})，改為複製: {dest_path}")
+            shutil.copyfile(blob_path, dest_path)
+        return dest_path
+
+
+# 建立預設實例供外部直接匯入使用
+attachment_store = AttachmentStore()
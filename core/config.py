@@ -9,6 +9,7 @@ class Config:
     TG_TOKEN = os.getenv("TG_TOKEN")
     TG_CHAT_ID = os.getenv("TG_CHAT_ID")
     GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+    ATTACHMENT_MAX_MB = float(os.getenv("ATTACHMENT_MAX_MB", "50"))  # 單一附件大小上限，超過不下載儲存
 
     @classmethod
     def validate(cls):
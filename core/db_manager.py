@@ -1,7 +1,8 @@
 import sqlite3
 import json
 import logging
-from typing import List, Dict, Any, Optional
+import threading
+from typing import List, Dict, Any, Optional, Tuple
 
 DB_NAME = "database.db"
 
@@ -9,6 +10,12 @@ class DBManager:
     """
     資料庫封裝模組，負責管理 SQLite 連線與資料表操作。
     """
+    # FTS5 全文檢索涵蓋的欄位
+    SEARCH_COLUMNS = {
+        "Supplier_List": ["name", "materials", "forms", "contact_email"],
+        "RFQ_History": ["rfq_id", "raw_data", "parsed_data"],
+    }
+
     def __init__(self, db_path: str = DB_NAME):
         self.db_path = db_path
         self._init_db()
@@ -58,32 +65,143 @@ class DBManager:
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
                 ''')
+
+                # 建立 Mail_Sync_State 資料表 (各信箱資料夾的 UID 高水位，供增量同步)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS Mail_Sync_State (
+                        folder TEXT PRIMARY KEY,
+                        uidvalidity INTEGER NOT NULL,
+                        last_uid INTEGER NOT NULL,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+
+                # 建立 RFQ_Jobs 資料表 (以信件 UID 為 key 的持久化處理佇列；payload 保存各階段結果，重啟後從中斷的階段接續)
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS RFQ_Jobs (
+                        uid TEXT PRIMARY KEY,
+                        stage TEXT NOT NULL,
+                        payload TEXT,
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        next_run_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        last_error TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_rfq_jobs_due ON RFQ_Jobs(next_run_at) "
+                    "WHERE stage NOT IN ('done', 'failed')"
+                )
+                self._init_search_tables(cursor)
                 conn.commit()
                 logging.info("Database tables initialized successfully.")
         except sqlite3.Error as e:
             logging.error(f"Error initializing database: {e}")
 
-    def get_suppliers_for_item(self, item_spec: str) -> List[Dict[str, Any]]:
-        """模糊比對料號或規格，回傳建議供應商清單"""
+    def _init_search_tables(self, cursor: sqlite3.Cursor):
+        """建立 FTS5 全文檢索表與同步 trigger；首次建立時為既有資料建索引"""
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'Supplier_List_fts'")
+        if cursor.fetchone() is None:
+            tokenizer = self._fts_tokenizer(cursor)
+            cursor.execute(f"""
+                CREATE VIRTUAL TABLE Supplier_List_fts USING fts5(
+                    name, materials, forms, contact_email,
+                    content='Supplier_List', content_rowid='id', tokenize='{tokenizer}')
+            """)
+            cursor.execute(f"""
+                CREATE VIRTUAL TABLE RFQ_History_fts USING fts5(
+                    rfq_id, raw_data, parsed_data,
+                    content='RFQ_History', content_rowid='id', tokenize='{tokenizer}')
+            """)
+            cursor.execute("INSERT INTO Supplier_List_fts(Supplier_List_fts) VALUES ('rebuild')")
+            cursor.execute("INSERT INTO RFQ_History_fts(RFQ_History_fts) VALUES ('rebuild')")
+
+        for table, columns in self.SEARCH_COLUMNS.items():
+            cols = ", ".join(columns)
+            new_vals = ", ".join(f"new.{c}" for c in columns)
+            old_vals = ", ".join(f"old.{c}" for c in columns)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_fts_ai AFTER INSERT ON {table} BEGIN
+                    INSERT INTO {table}_fts(rowid, {cols}) VALUES (new.id, {new_vals});
+                END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_fts_ad AFTER DELETE ON {table} BEGIN
+                    INSERT INTO {table}_fts({table}_fts, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+                END
+            """)
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_fts_au AFTER UPDATE OF {cols} ON {table} BEGIN
+                    INSERT INTO {table}_fts({table}_fts, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+                    INSERT INTO {table}_fts(rowid, {cols}) VALUES (new.id, {new_vals});
+                END
+            """)
+
+    @staticmethod
+    def _fts_tokenizer(cursor: sqlite3.Cursor) -> str:
+        """trigram 支援中文與子字串比對 (SQLite >= 3.34)，舊版退回 unicode61"""
+        try:
+            cursor.execute("CREATE VIRTUAL TABLE temp._fts_probe USING fts5(x, tokenize='trigram')")
+            cursor.execute("DROP TABLE temp._fts_probe")
+            return "trigram"
+        except sqlite3.OperationalError:
+            return "unicode61"
+
+    @staticmethod
+    def _fts_query(text: str, columns: Optional[List[str]] = None):
+        """
+        將輸入轉為 (MATCH 運算式, LIKE 條件, LIKE 參數)。
+        每個字詞以雙引號包住避免 FTS 語法錯誤；少於 3 字元的字詞 trigram 無法索引，改用 LIKE。
+        """
+        terms = (text or "").split()
+        phrases = ['"' + t.replace('"', '""') + '"' for t in terms if len(t) >= 3]
+        match = ""
+        if phrases:
+            match = " ".join(phrases)
+            if columns:
+                match = "{" + " ".join(columns) + "} : (" + match + ")"
+        like_clauses, like_params = [], []
+        for term in (t for t in terms if len(t) < 3):
+            cols = columns or []
+            like_clauses.append("(" + " OR ".join(f"t.{c} LIKE ?" for c in cols) + ")")
+            like_params.extend([f"%{term}%"] * len(cols))
+        return match, " AND ".join(like_clauses), like_params
+
+    def _search(self, table: str, text: str, columns: List[str], limit: int) -> List[Dict[str, Any]]:
+        match, like, like_params = self._fts_query(text, columns)
+        if not match and not like:
+            return []
         try:
             with self._get_connection() as conn:
                 conn.row_factory = sqlite3.Row
                 cursor = conn.cursor()
-
-                # 使用簡單的 LIKE 進行模糊比對 (針對規格、材料或形狀)
-                query = '''
-                    SELECT * FROM Supplier_List
-                    WHERE materials LIKE ? OR forms LIKE ?
-                '''
-                search_term = f"%{item_spec}%"
-                cursor.execute(query, (search_term, search_term))
-                rows = cursor.fetchall()
-
-                return [dict(row) for row in rows]
+                if match:
+                    query = f"""
+                        SELECT t.* FROM {table}_fts JOIN {table} t ON t.id = {table}_fts.rowid
+                        WHERE {table}_fts MATCH ? {('AND ' + like) if like else ''}
+                        ORDER BY {table}_fts.rank LIMIT ?
+                    """
+                    cursor.execute(query, [match] + like_params + [limit])
+                else:
+                    cursor.execute(f"SELECT t.* FROM {table} t WHERE {like} ORDER BY t.id DESC LIMIT ?", like_params + [limit])
+                return [dict(row) for row in cursor.fetchall()]
         except sqlite3.Error as e:
-            logging.error(f"Error fetching suppliers for item '{item_spec}': {e}")
+            logging.error(f"Error searching {table} for '{text}': {e}")
             return []
 
+    def get_suppliers_for_item(self, item_spec: str) -> List[Dict[str, Any]]:
+        """以 FTS5 比對材料或形狀，依相關度回傳建議供應商清單"""
+        return self._search("Supplier_List", item_spec, ["materials", "forms"], limit=50)
+
+    def search_suppliers(self, text: str, limit: int = 50) -> List[Dict[str, Any]]:
+        """全文檢索供應商 (名稱、材料、形狀、Email)，依 bm25 排序"""
+        return self._search("Supplier_List", text, self.SEARCH_COLUMNS["Supplier_List"], limit)
+
+    def search_rfq_history(self, text: str, limit: int = 50) -> List[Dict[str, Any]]:
+        """全文檢索詢價歷程 (RFQ 編號、原始內容、解析結果)，依 bm25 排序"""
+        return self._search("RFQ_History", text, self.SEARCH_COLUMNS["RFQ_History"], limit)
+
     def save_rfq_record(self, rfq_id: str, raw_data: str, parsed_data: dict, status: str = "PENDING") -> bool:
         """儲存詢價歷程"""
         try:
@@ -104,6 +222,20 @@ class DBManager:
             logging.error(f"Error saving RFQ record '{rfq_id}': {e}")
             return False
 
+    def get_rfq_record(self, rfq_id: str) -> Optional[Dict[str, Any]]:
+        """讀取單筆詢價歷程 (parsed_data 已轉回 dict)；不存在回傳 None"""
+        try:
+            with self._get_connection() as conn:
+                row = conn.execute(
+                    'SELECT rfq_id, raw_data, parsed_data, status FROM RFQ_History WHERE rfq_id = ?', (rfq_id,)
+                ).fetchone()
+                if row is None:
+                    return None
+                return {"rfq_id": row[0], "raw_data": row[1], "parsed_data": json.loads(row[2] or "{}"), "status": row[3]}
+        except (sqlite3.Error, json.JSONDecodeError) as e:
+            logging.error(f"Error reading RFQ record '{rfq_id}': {e}")
+            return None
+
     def update_rfq_status(self, rfq_id: str, status: str) -> bool:
         """更新詢價歷程狀態 (如 PENDING, SENT, COMPLETED)"""
         try:
@@ -120,5 +252,143 @@ class DBManager:
             logging.error(f"Error updating RFQ status for '{rfq_id}': {e}")
             return False
 
+    def get_mail_sync_state(self, folder: str = "INBOX") -> Optional[Tuple[int, int]]:
+        """回傳 (uidvalidity, last_uid)；尚未同步過則回傳 None"""
+        try:
+            with self._get_connection() as conn:
+                row = conn.execute(
+                    'SELECT uidvalidity, last_uid FROM Mail_Sync_State WHERE folder = ?', (folder,)
+                ).fetchone()
+                return tuple(row) if row else None
+        except sqlite3.Error as e:
+            logging.error(f"Error reading mail sync state for '{folder}': {e}")
+            return None
+
+    def save_mail_sync_state(self, folder: str, uidvalidity: int, last_uid: int) -> bool:
+        """更新 UID 高水位 (處理完一封即可呼叫，當機重啟後從此處接續)"""
+        try:
+            with self._get_connection() as conn:
+                conn.execute('''
+                    INSERT INTO Mail_Sync_State (folder, uidvalidity, last_uid, updated_at)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(folder) DO UPDATE SET
+                        uidvalidity=excluded.uidvalidity,
+                        last_uid=excluded.last_uid,
+                        updated_at=excluded.updated_at
+                ''', (folder, uidvalidity, last_uid))
+                conn.commit()
+                return True
+        except sqlite3.Error as e:
+            logging.error(f"Error saving mail sync state for '{folder}': {e}")
+            return False
+
+    # --- RFQ 處理佇列 (stage: parse → archive → persist → notify → label → done；重試用盡為 failed) ---
+
+    @staticmethod
+    def _job_row(row) -> Dict[str, Any]:
+        uid, stage, payload, attempts, next_run_at, last_error = row
+        return {"uid": uid, "stage": stage, "payload": json.loads(payload) if payload else {},
+                "attempts": attempts, "next_run_at": next_run_at, "last_error": last_error}
+
+    def enqueue_rfq_job(self, uid: str, payload: dict, stage: str = "parse") -> Optional[bool]:
+        """
+        新增工作；同一 UID 已存在時不覆蓋 (重複同步同一封信不會重跑已完成的階段)。
+        回傳是否為新工作；DB 錯誤時回傳 None (與「已在佇列中」區分，呼叫端不可推進 UID 高水位)
+        """
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO RFQ_Jobs (uid, stage, payload) VALUES (?, ?, ?)',
+                    (str(uid), stage, json.dumps(payload, ensure_ascii=False, default=str))
+                )
+                conn.commit()
+                return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logging.error(f"Error enqueuing RFQ job '{uid}': {e}")
+            return None
+
+    def get_rfq_job(self, uid: str) -> Optional[Dict[str, Any]]:
+        try:
+            with self._get_connection() as conn:
+                row = conn.execute(
+                    'SELECT uid, stage, payload, attempts, next_run_at, last_error FROM RFQ_Jobs WHERE uid = ?', (str(uid),)
+                ).fetchone()
+                return self._job_row(row) if row else None
+        except sqlite3.Error as e:
+            logging.error(f"Error reading RFQ job '{uid}': {e}")
+            return None
+
+    def get_due_rfq_jobs(self, limit: int = 100) -> List[Dict[str, Any]]:
+        """取出已到執行時間、尚未完成的工作 (含上次中斷在半途的工作)"""
+        try:
+            with self._get_connection() as conn:
+                rows = conn.execute('''
+                    SELECT uid, stage, payload, attempts, next_run_at, last_error FROM RFQ_Jobs
+                    WHERE stage NOT IN ('done', 'failed') AND next_run_at <= CURRENT_TIMESTAMP
+                    ORDER BY next_run_at, CAST(uid AS INTEGER) LIMIT ?
+                ''', (limit,)).fetchall()
+                return [self._job_row(r) for r in rows]
+        except sqlite3.Error as e:
+            logging.error(f"Error reading due RFQ jobs: {e}")
+            return []
+
+    def next_rfq_job_delay(self) -> Optional[float]:
+        """距離下一個待重試工作的秒數 (已到期為 0)；沒有待處理工作回傳 None"""
+        try:
+            with self._get_connection() as conn:
+                row = conn.execute('''
+                    SELECT MAX(0, (julianday(MIN(next_run_at)) - julianday('now')) * 86400) FROM RFQ_Jobs
+                    WHERE stage NOT IN ('done', 'failed')
+                ''').fetchone()
+                return row[0] if row else None
+        except sqlite3.Error as e:
+            logging.error(f"Error reading RFQ job schedule: {e}")
+            return None
+
+    def advance_rfq_job(self, uid: str, stage: str, payload: dict) -> bool:
+        """階段完成：寫入結果並前進到下一階段 (重置重試次數)"""
+        try:
+            with self._get_connection() as conn:
+                cursor = conn.execute('''
+                    UPDATE RFQ_Jobs SET stage = ?, payload = ?, attempts = 0, last_error = NULL,
+                        next_run_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                    WHERE uid = ?
+                ''', (stage, json.dumps(payload, ensure_ascii=False, default=str), str(uid)))
+                conn.commit()
+                return cursor.rowcount > 0
+        except sqlite3.Error as e:
+            logging.error(f"Error advancing RFQ job '{uid}': {e}")
+            return False
+
+    def fail_rfq_job(self, uid: str, error: str, retry_in: float, max_attempts: int) -> Optional[Dict[str, Any]]:
+        """階段失敗：累計次數並延後重試；達到 max_attempts 後標記為 failed。回傳更新後的工作"""
+        try:
+            with self._get_connection() as conn:
+                conn.execute('''
+                    UPDATE RFQ_Jobs SET attempts = attempts + 1, last_error = ?,
+                        next_run_at = datetime('now', ?), updated_at = CURRENT_TIMESTAMP,
+                        stage = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE stage END
+                    WHERE uid = ?
+                ''', (error, f"+{int(retry_in)} seconds", max_attempts, str(uid)))
+                conn.commit()
+        except sqlite3.Error as e:
+            logging.error(f"Error recording failure for RFQ job '{uid}': {e}")
+            return None
+        return self.get_rfq_job(uid)
+
+class _LazyDBManager:
+    """第一次使用時才建立 DBManager (匯入本模組不會在工作目錄產生 database.db)"""
+    def __init__(self, db_path: str = DB_NAME):
+        self._db_path = db_path
+        self._instance = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = DBManager(self._db_path)
+        return getattr(self._instance, name)
+
 # 建立預設實例供外部直接匯入使用
-db = DBManager()
+db = _LazyDBManager()
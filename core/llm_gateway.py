@@ -0,0 +1,398 @@
+import bisect
+import email.utils
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# 延遲直方圖的桶上限 (秒)；最後一桶為 +Inf
+LATENCY_BUCKETS = [0.25, 0.5, 1, 2, 4, 8, 16, 32, 64]
+
+DEFAULT_CONCURRENCY = {"openai": 8, "gemini_rest": 4, "gemini_sdk": 4, "fake": 8}
+
+GEMINI_REST_URL = "https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
+
+
+class LLMGatewayError(Exception):
+    """重試耗盡或不可重試的錯誤"""
+
+
+class RetryableError(Exception):
+    """暫時性錯誤 (429 / 5xx / 連線 / 逾時)；retry_after 為伺服器建議的等待秒數 (可為 None)"""
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+@dataclass
+class LLMResponse:
+    text: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    raw: Any = None
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """解析 retry-after-ms / Retry-After (秒數或 HTTP 日期)；無法解析時回傳 None"""
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+# --- Providers ---
+
+class OpenAIProvider:
+    """openai.OpenAI 客戶端依 api_key 快取共用 (內含 httpx 連線池)；重試由 gateway 負責"""
+    name = "openai"
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _client(self, api_key):
+        import openai
+        with self._lock:
+            client = self._clients.get(api_key)
+            if client is None:
+                client = openai.OpenAI(api_key=api_key, max_retries=0)
+                self._clients[api_key] = client
+            return client
+
+    def _translate(self, e):
+        import openai
+        if isinstance(e, openai.RateLimitError):
+            return RetryableError(str(e), parse_retry_after(getattr(e.response, "headers", None)))
+        if isinstance(e, (openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)):
+            return RetryableError(str(e))
+        return None
+
+    def send(self, request: Dict[str, Any]) -> LLMResponse:
+        request = dict(request)
+        client = self._client(request.pop("api_key"))
+        try:
+            response = client.chat.completions.create(**request)
+        except Exception as e:
+            retryable = self._translate(e)
+            if retryable is not None:
+                raise retryable from e
+            raise
+        usage = response.usage
+        details = getattr(usage, "prompt_tokens_details", None) if usage else None
+        return LLMResponse(
+            text=(response.choices[0].message.content or "").strip(),
+            prompt_tokens=usage.prompt_tokens if usage else 0,
+            completion_tokens=usage.completion_tokens if usage else 0,
+            cached_tokens=(getattr(details, "cached_tokens", 0) or 0) if details else 0,
+            raw=response
+        )
+
+    def open_stream(self, request: Dict[str, Any], usage: LLMResponse) -> Iterator[str]:
+        request = dict(request)
+        client = self._client(request.pop("api_key"))
+        try:
+            stream = client.chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+        except Exception as e:
+            retryable = self._translate(e)
+            if retryable is not None:
+                raise retryable from e
+            raise
+
+        def deltas():
+            try:
+                for chunk in stream:
+                    if chunk.usage is not None:
+                        usage.prompt_tokens = chunk.usage.prompt_tokens
+                        usage.completion_tokens = chunk.usage.completion_tokens
+                        details = getattr(chunk.usage, "prompt_tokens_details", None)
+                        usage.cached_tokens = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        yield delta
+            finally:
+                stream.close()
+        return deltas()
+
+
+class GeminiRestProvider:
+    """Gemini REST (generateContent)：共用 requests.Session 連線池並保持 keep-alive"""
+    name = "gemini_rest"
+
+    def __init__(self, pool_size: int = DEFAULT_CONCURRENCY["gemini_rest"], timeout=(5, 60)):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+        with self._lock:
+            if self._session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.headers.update({"Content-Type": "application/json"})
+                self._session = session
+            return self._session
+
+    def send(self, request: Dict[str, Any]) -> LLMResponse:
+        import requests
+        url = GEMINI_REST_URL.format(model=request["model"])
+        try:
+            response = self._get_session().post(
+                url,
+                params={"key": request["api_key"]},
+                json=request["payload"],
+                timeout=request.get("timeout", self.timeout)
+            )
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            raise RetryableError(str(e)) from e
+
+        if response.status_code == 429 or response.status_code >= 500:
+            raise RetryableError(f"HTTP {response.status_code}", parse_retry_after(response.headers))
+        response.raise_for_status()
+
+        data = response.json()
+        if not data.get("candidates"):
+            raise LLMGatewayError(f"Unexpected Gemini API response format: {data}")
+        usage = data.get("usageMetadata", {})
+        return LLMResponse(
+            text=data["candidates"][0]["content"]["parts"][0]["text"],
+            prompt_tokens=usage.get("promptTokenCount", 0),
+            completion_tokens=usage.get("candidatesTokenCount", 0),
+            cached_tokens=usage.get("cachedContentTokenCount", 0),
+            raw=data
+        )
+
+    def close(self):
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+class GeminiSDKProvider:
+    """google.generativeai 的 GenerativeModel.generate_content；request["model"] 為呼叫端建立的 model 物件"""
+    name = "gemini_sdk"
+
+    def send(self, request: Dict[str, Any]) -> LLMResponse:
+        try:
+            from google.api_core import exceptions as gexc
+            retryable_types = (gexc.ResourceExhausted, gexc.ServiceUnavailable, gexc.DeadlineExceeded, gexc.InternalServerError)
+        except ImportError:
+            retryable_types = ()
+        try:
+            response = request["model"].generate_content(request["contents"], **request.get("options", {}))
+        except retryable_types as e:
+            raise RetryableError(str(e)) from e
+
+        usage = getattr(response, "usage_metadata", None)
+        return LLMResponse(
+            text=response.text.strip(),
+            prompt_tokens=_as_int(getattr(usage, "prompt_token_count", 0)),
+            completion_tokens=_as_int(getattr(usage, "candidates_token_count", 0)),
+            cached_tokens=_as_int(getattr(usage, "cached_content_token_count", 0)),
+            raw=response
+        )
+
+
+def _as_int(value) -> int:
+    return value if isinstance(value, int) else 0
+
+
+class FakeProvider:
+    """
+    測試用的本機後端。script 依序為: str (回應文字)、LLMResponse、Exception (直接拋出)
+    或 callable(request) (回傳上述任一種)。收到的 request 依序記錄於 requests。
+    """
+    name = "fake"
+
+    def __init__(self, script: Optional[List[Any]] = None, delay: float = 0.0):
+        self.script = list(script or [])
+        self.delay = delay
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def _next(self, request):
+        with self._lock:
+            self.requests.append(request)
+            step = self.script.pop(0) if self.script else ""
+        if self.delay:
+            time.sleep(self.delay)
+        if callable(step):
+            step = step(request)
+        if isinstance(step, BaseException):
+            raise step
+        if isinstance(step, LLMResponse):
+            return step
+        return LLMResponse(text=str(step), prompt_tokens=len(str(request)) // 4, completion_tokens=len(str(step)) // 4)
+
+    def send(self, request: Dict[str, Any]) -> LLMResponse:
+        return self._next(request)
+
+    def open_stream(self, request: Dict[str, Any], usage: LLMResponse) -> Iterator[str]:
+        response = self._next(request)
+        usage.prompt_tokens, usage.completion_tokens = response.prompt_tokens, response.completion_tokens
+        return iter([response.text[i:i + 16] for i in range(0, len(response.text), 16)])
+
+
+# --- 統計 ---
+
+@dataclass
+class CallSiteStats:
+    calls: int = 0
+    errors: int = 0
+    retries: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    latency_sum: float = 0.0
+    histogram: List[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+
+    def observe(self, seconds: float):
+        self.latency_sum += seconds
+        self.histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        labels = [f"<={b}s" for b in LATENCY_BUCKETS] + ["+Inf"]
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "uncached_prompt_tokens": self.prompt_tokens - self.cached_tokens,
+            "prompt_cache_ratio": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+            "avg_latency": self.latency_sum / self.calls if self.calls else 0.0,
+            "latency_histogram": dict(zip(labels, self.histogram)),
+        }
+
+
+class LLMGateway:
+    """
+    所有 LLM 呼叫的共用入口：
+    - 每個 provider 共用連線池 / 客戶端
+    - 每個 provider 的併發上限 (BoundedSemaphore)
+    - 429 時依 Retry-After 等待，否則指數退避 + jitter
+    - 依 call_site 記錄延遲直方圖與 token 數
+    """
+    def __init__(self, max_retries: int = 3, max_backoff: float = 30.0, sleep: Callable[[float], None] = time.sleep):
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self._providers = {}
+        self._limits = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        for provider in (OpenAIProvider(), GeminiRestProvider(), GeminiSDKProvider()):
+            self.register(provider.name, provider)
+
+    def register(self, name: str, provider, max_concurrency: Optional[int] = None):
+        """註冊或替換 provider (測試時可用 FakeProvider 取代真實後端)"""
+        with self._lock:
+            self._providers[name] = provider
+            self._limits[name] = threading.BoundedSemaphore(max_concurrency or DEFAULT_CONCURRENCY.get(name, 4))
+
+    def _site(self, call_site: str) -> CallSiteStats:
+        with self._lock:
+            return self._stats.setdefault(call_site, CallSiteStats())
+
+    def record(self, call_site: str, seconds: float, response: Optional[LLMResponse] = None, failed: bool = False):
+        """記錄一次呼叫的延遲與 token 數 (gateway 外自行呼叫 API 的路徑，例如 async 批次，也用此回報)"""
+        stats = self._site(call_site)
+        with self._lock:
+            stats.calls += 1
+            stats.observe(seconds)
+            if failed:
+                stats.errors += 1
+            if response is not None:
+                stats.prompt_tokens += response.prompt_tokens
+                stats.completion_tokens += response.completion_tokens
+                stats.cached_tokens += response.cached_tokens
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        return min(2 ** attempt, self.max_backoff) * (0.5 + random.random() / 2)
+
+    def _with_retry(self, call_site: str, provider: str, fn: Callable[[], Any], max_retries: Optional[int]):
+        max_retries = self.max_retries if max_retries is None else max_retries
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except RetryableError as e:
+                if attempt >= max_retries:
+                    raise LLMGatewayError(f"[{provider}] 重試次數耗盡: {e}") from e
+                attempt += 1
+                wait = self._backoff(attempt, e.retry_after)
+                stats = self._site(call_site)
+                with self._lock:
+                    stats.retries += 1
+                logging.warning(f"[LLM] {call_site} 暫時性錯誤 ({e})，{wait:.1f}s 後重試 ({attempt}/{max_retries})")
+                self.sleep(wait)
+
+    def call(self, call_site: str, provider: str, request: Dict[str, Any], max_retries: Optional[int] = None) -> LLMResponse:
+        """同步呼叫；失敗時拋出 LLMGatewayError 或 provider 的原始例外"""
+        backend = self._providers[provider]
+        start = time.perf_counter()
+        with self._limits[provider]:
+            try:
+                response = self._with_retry(call_site, provider, lambda: backend.send(request), max_retries)
+            except Exception:
+                self.record(call_site, time.perf_counter() - start, failed=True)
+                raise
+        self.record(call_site, time.perf_counter() - start, response)
+        return response
+
+    def stream(self, call_site: str, provider: str, request: Dict[str, Any], max_retries: Optional[int] = None) -> Iterator[str]:
+        """串流呼叫，逐段 yield 文字；只在取得串流前重試。呼叫端提前結束時請 close() 以釋放併發額度"""
+        backend = self._providers[provider]
+        usage = LLMResponse(text="")
+        start = time.perf_counter()
+        failed = True
+        with self._limits[provider]:
+            try:
+                deltas = self._with_retry(call_site, provider, lambda: backend.open_stream(request, usage), max_retries)
+                try:
+                    for delta in deltas:
+                        yield delta
+                    failed = False
+                finally:
+                    if hasattr(deltas, "close"):
+                        deltas.close()
+            except GeneratorExit:
+                failed = False
+                raise
+            finally:
+                self.record(call_site, time.perf_counter() - start, usage, failed)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {site: s.snapshot() for site, s in self._stats.items()}
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats.clear()
+
+
+gateway = LLMGateway()
@@ -3,23 +3,151 @@
 
 import sqlite3
 import json
+import threading
+import time
+from collections.abc import Mapping
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
 DB_NAME = "rfq_system.db"
-_connection = None
+BUSY_TIMEOUT = 5.0         # 秒: 資料庫被鎖定時等待的時間
+CACHED_STATEMENTS = 256    # 每條連線的 prepared statement 快取數量
+PARSE_CACHE_MAX_ENTRIES = 2000  # 解析快取上限 (超過即依 LRU 淘汰)
+SUPPLIER_PAGE_SIZE = 100  # 供應商表格每頁筆數 (keyset 分頁)
+SEARCH_CANDIDATES = 500   # 全文檢索: 命中數超過此值視為常見字詞，改取最新的 N 筆
+RFQ_HISTORY_PAGE_SIZE = 50  # 詢價紀錄每頁筆數 (keyset 分頁)
+_manager = None
+_manager_lock = threading.Lock()
+_capability_index = None
+_capability_lock = threading.RLock()
+
+# --- Connection Management ---
+
+class ConnectionManager:
+    """
+    Keeps one SQLite connection per thread open for the life of the process,
+    with WAL journaling, a busy timeout and a prepared statement cache.
+    ":memory:" shares a single connection, since every new in-memory
+    connection would otherwise see its own empty database.
+    """
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._shared = None
+        self._tx_lock = threading.Lock()  # ":memory:" 共用連線: 一次只允許一個執行緒的交易
+
+    def _open(self):
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=BUSY_TIMEOUT,
+            cached_statements=CACHED_STATEMENTS,
+            check_same_thread=False
+        )
+        conn.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}")
+        if self.db_name != ":memory:":
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def connection(self):
+        if self.db_name == ":memory:":
+            if self._shared is None:
+                self._shared = self._open()
+            return self._shared
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._open()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """
+        Yields a cursor inside BEGIN ... COMMIT, rolling back on error.
+        Nested calls on the same thread join the outer transaction; on the shared
+        ":memory:" connection other threads wait instead of joining it.
+        """
+        depth = getattr(self._local, "depth", 0)
+        if depth:
+            self._local.depth = depth + 1
+            try:
+                yield self.connection().cursor()
+            finally:
+                self._local.depth = depth
+            return
+        lock = self._tx_lock if self.db_name == ":memory:" else None
+        if lock is not None:
+            lock.acquire()
+        self._local.depth = 1
+        try:
+            conn = self.connection()
+            # 同一執行緒先前未提交的隱含交易：併入，沿用原本的行為
+            owns = not conn.in_transaction
+            if owns:
+                conn.execute("BEGIN")
+            try:
+                yield conn.cursor()
+            except BaseException:
+                if owns:
+                    conn.rollback()
+                raise
+            else:
+                if owns:
+                    conn.commit()
+        finally:
+            self._local.depth = 0
+            if lock is not None:
+                lock.release()
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._shared = None
+        self._local = threading.local()
+
+def get_manager():
+    """Returns the connection manager for the current DB_NAME (re-created if DB_NAME changes)."""
+    global _manager
+    if _manager is None or _manager.db_name != DB_NAME:
+        with _manager_lock:
+            if _manager is None or _manager.db_name != DB_NAME:
+                if _manager is not None:
+                    _manager.close_all()
+                _manager = ConnectionManager(DB_NAME)
+                invalidate_capability_index()
+    return _manager
 
 def get_connection():
-    global _connection
-    if DB_NAME == ":memory:":
-        if _connection is None:
-            _connection = sqlite3.connect(DB_NAME, check_same_thread=False)
-        return _connection
-    return sqlite3.connect(DB_NAME)
+    """Returns this thread's pooled connection. Callers must not close it."""
+    return get_manager().connection()
+
+def transaction():
+    """Context manager: `with transaction() as cursor:` commits once on exit."""
+    return get_manager().transaction()
+
+def _query(sql, params=()):
+    return get_connection().execute(sql, params).fetchall()
+
+def close_connections():
+    global _manager
+    with _manager_lock:
+        if _manager is not None:
+            _manager.close_all()
+        _manager = None
+    invalidate_capability_index()
 
 def init_db():
     """Initializes the database with schema."""
-    conn = get_connection()
-    cursor = conn.cursor()
+    with transaction() as cursor:
+        _create_schema(cursor)
+    invalidate_capability_index()
 
+def _create_schema(cursor):
     # Table: Suppliers (Section 4.1)
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS suppliers (
@@ -43,6 +171,11 @@ def init_db():
         except sqlite3.OperationalError:
             pass
 
+    # Supplier capability junction tables (replace the JSON-in-TEXT columns above,
+    # which are kept read-only for backward compatibility)
+    _create_capability_tables(cursor)
+    _migrate_capability_columns(cursor)
+
     # Table: RFQ Templates (Section 4.2)
     # Using TEXT for JSON/Array fields
     cursor.execute('''
@@ -110,168 +243,683 @@ def init_db():
     )
     ''')
 
-    if DB_NAME != ":memory:":
-        conn.close()
+    # 詢價紀錄瀏覽 (keyset 分頁 / 篩選) 用索引；rowid (= id) 會自動附在每個索引尾端
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_rfq_requests_created ON rfq_requests (created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_rfq_requests_status ON rfq_requests (status)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_rfq_items_request ON rfq_items (request_id, item_index)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_rfq_items_material ON rfq_items (material_type, request_id)')
+
+    # Table: Parse Cache (analyzer.analyze_rfq 結果快取, key = sha256(正規化文字 + prompt 版本))
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS parse_cache (
+        cache_key TEXT PRIMARY KEY,
+        prompt_version TEXT NOT NULL,
+        result TEXT NOT NULL,
+        hit_count INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_used_at REAL NOT NULL
+    )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_parse_cache_last_used ON parse_cache (last_used_at)')
+
+    # 全文檢索 (FTS5)，由 trigger 與原表同步
+    _create_search_tables(cursor)
+
+# --- Supplier Capability Tables ---
+
+# option group -> (junction table, value column)
+CAPABILITY_TABLES = {
+    "materials": ("supplier_materials", "material"),
+    "forms": ("supplier_forms", "form"),
+    "qualifications": ("supplier_qualifications", "qualification"),
+}
+
+# Same column order as `SELECT * FROM suppliers`; the three option columns are
+# rebuilt as JSON arrays from the junction tables (insertion order preserved).
+SUPPLIER_SELECT = '''
+    SELECT s.id, s.name, s.contact_person, s.email, s.phone, s.address,
+        (SELECT json_group_array(material) FROM (SELECT material FROM supplier_materials WHERE supplier_id = s.id ORDER BY rowid)),
+        (SELECT json_group_array(form) FROM (SELECT form FROM supplier_forms WHERE supplier_id = s.id ORDER BY rowid)),
+        (SELECT json_group_array(qualification) FROM (SELECT qualification FROM supplier_qualifications WHERE supplier_id = s.id ORDER BY rowid)),
+        s.created_at
+    FROM suppliers s
+'''
+
+def _decode_options(value):
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    try:
+        values = json.loads(value) if value else []
+    except (json.JSONDecodeError, TypeError):
+        return []
+    return values if isinstance(values, list) else []
+
+def write_supplier_capabilities(cursor, supplier_id, materials, forms, qualifications):
+    """Replaces a supplier's junction rows. Each option accepts a list or a JSON array string."""
+    for group, values in (("materials", materials), ("forms", forms), ("qualifications", qualifications)):
+        table, column = CAPABILITY_TABLES[group]
+        cursor.execute(f'DELETE FROM {table} WHERE supplier_id = ?', (supplier_id,))
+        cursor.executemany(
+            f'INSERT OR IGNORE INTO {table} (supplier_id, {column}) VALUES (?, ?)',
+            [(supplier_id, v) for v in _decode_options(values)]
+        )
+
+def _create_capability_tables(cursor):
+    for table, column in CAPABILITY_TABLES.values():
+        cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table} (
+            supplier_id INTEGER NOT NULL,
+            {column} TEXT NOT NULL,
+            PRIMARY KEY (supplier_id, {column}),
+            FOREIGN KEY (supplier_id) REFERENCES suppliers(id)
+        )
+        ''')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table} ({column}, supplier_id)')
+
+def _migrate_capability_columns(cursor):
+    """One-time copy of the legacy JSON columns into the junction tables (PRAGMA user_version 0 -> 1)."""
+    cursor.execute('PRAGMA user_version')
+    if cursor.fetchone()[0] >= 1:
+        return
+    cursor.execute('SELECT id, materials, forms, qualifications FROM suppliers')
+    for supplier_id, materials, forms, qualifications in cursor.fetchall():
+        for group, values in (("materials", materials), ("forms", forms), ("qualifications", qualifications)):
+            table, column = CAPABILITY_TABLES[group]
+            cursor.executemany(
+                f'INSERT OR IGNORE INTO {table} (supplier_id, {column}) VALUES (?, ?)',
+                [(supplier_id, v) for v in _decode_options(values)]
+            )
+    cursor.execute('PRAGMA user_version = 1')
+
+# --- Full-text Search (FTS5) ---
+
+# rfq_items.spec 是 item 的 JSON，只索引有意義的欄位
+_ITEM_SEARCH_TEXT = """CASE WHEN json_valid({s}) THEN
+    coalesce(json_extract({s}, '$.material_type'), '') || ' ' || coalesce(json_extract({s}, '$.material_spec'), '') || ' ' ||
+    coalesce(json_extract({s}, '$.form'), '') || ' ' || coalesce(json_extract({s}, '$.dimensions'), '') || ' ' ||
+    coalesce(json_extract({s}, '$.notes'), '')
+ELSE coalesce({s}, '') END"""
+
+SUPPLIER_SEARCH_COLUMNS = ["name", "contact_person", "email", "address"]
+
+def _fts_tokenizer(cursor):
+    """trigram 可做中文 / 子字串比對 (SQLite >= 3.34)；舊版退回 unicode61"""
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE temp._fts_probe USING fts5(x, tokenize='trigram')")
+        cursor.execute('DROP TABLE temp._fts_probe')
+        return 'trigram'
+    except sqlite3.OperationalError:
+        return 'unicode61'
+
+def _create_search_tables(cursor):
+    cols = ", ".join(SUPPLIER_SEARCH_COLUMNS)
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'suppliers_fts'")
+    if cursor.fetchone() is None:
+        tokenizer = _fts_tokenizer(cursor)
+        cursor.execute(f"CREATE VIRTUAL TABLE suppliers_fts USING fts5({cols}, content='suppliers', content_rowid='id', tokenize='{tokenizer}')")
+        cursor.execute(f"CREATE VIRTUAL TABLE rfq_requests_fts USING fts5(raw_text, content='rfq_requests', content_rowid='id', tokenize='{tokenizer}')")
+        cursor.execute(f"CREATE VIRTUAL TABLE rfq_items_fts USING fts5(spec, tokenize='{tokenizer}')")
+
+    new_vals = ", ".join(f"new.{c}" for c in SUPPLIER_SEARCH_COLUMNS)
+    old_vals = ", ".join(f"old.{c}" for c in SUPPLIER_SEARCH_COLUMNS)
+    new_spec = _ITEM_SEARCH_TEXT.format(s="new.spec")
+    triggers = [
+        f"""CREATE TRIGGER IF NOT EXISTS suppliers_fts_ai AFTER INSERT ON suppliers BEGIN
+            INSERT INTO suppliers_fts(rowid, {cols}) VALUES (new.id, {new_vals}); END""",
+        f"""CREATE TRIGGER IF NOT EXISTS suppliers_fts_ad AFTER DELETE ON suppliers BEGIN
+            INSERT INTO suppliers_fts(suppliers_fts, rowid, {cols}) VALUES ('delete', old.id, {old_vals}); END""",
+        f"""CREATE TRIGGER IF NOT EXISTS suppliers_fts_au AFTER UPDATE OF {cols} ON suppliers BEGIN
+            INSERT INTO suppliers_fts(suppliers_fts, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+            INSERT INTO suppliers_fts(rowid, {cols}) VALUES (new.id, {new_vals}); END""",
+        """CREATE TRIGGER IF NOT EXISTS rfq_requests_fts_ai AFTER INSERT ON rfq_requests BEGIN
+            INSERT INTO rfq_requests_fts(rowid, raw_text) VALUES (new.id, new.raw_text); END""",
+        """CREATE TRIGGER IF NOT EXISTS rfq_requests_fts_ad AFTER DELETE ON rfq_requests BEGIN
+            INSERT INTO rfq_requests_fts(rfq_requests_fts, rowid, raw_text) VALUES ('delete', old.id, old.raw_text); END""",
+        """CREATE TRIGGER IF NOT EXISTS rfq_requests_fts_au AFTER UPDATE OF raw_text ON rfq_requests BEGIN
+            INSERT INTO rfq_requests_fts(rfq_requests_fts, rowid, raw_text) VALUES ('delete', old.id, old.raw_text);
+            INSERT INTO rfq_requests_fts(rowid, raw_text) VALUES (new.id, new.raw_text); END""",
+        f"""CREATE TRIGGER IF NOT EXISTS rfq_items_fts_ai AFTER INSERT ON rfq_items BEGIN
+            INSERT INTO rfq_items_fts(rowid, spec) VALUES (new.id, {new_spec}); END""",
+        """CREATE TRIGGER IF NOT EXISTS rfq_items_fts_ad AFTER DELETE ON rfq_items BEGIN
+            DELETE FROM rfq_items_fts WHERE rowid = old.id; END""",
+        f"""CREATE TRIGGER IF NOT EXISTS rfq_items_fts_au AFTER UPDATE OF spec ON rfq_items BEGIN
+            DELETE FROM rfq_items_fts WHERE rowid = old.id;
+            INSERT INTO rfq_items_fts(rowid, spec) VALUES (new.id, {new_spec}); END""",
+    ]
+    for sql in triggers:
+        cursor.execute(sql)
+
+    # PRAGMA user_version 1 -> 2: 為既有資料建立索引
+    cursor.execute('PRAGMA user_version')
+    if cursor.fetchone()[0] < 2:
+        cursor.execute("INSERT INTO suppliers_fts(suppliers_fts) VALUES ('rebuild')")
+        cursor.execute("INSERT INTO rfq_requests_fts(rfq_requests_fts) VALUES ('rebuild')")
+        cursor.execute('DELETE FROM rfq_items_fts')
+        cursor.execute(f"INSERT INTO rfq_items_fts(rowid, spec) SELECT id, {_ITEM_SEARCH_TEXT.format(s='spec')} FROM rfq_items")
+        cursor.execute('PRAGMA user_version = 2')
+
+def _fts_terms(text):
+    """將輸入拆成 (MATCH 運算式, 需改用 LIKE 的過短字詞)；每個字詞以雙引號包住，避免 FTS 語法錯誤"""
+    terms = (text or "").split()
+    match = " ".join('"' + t.replace('"', '""') + '"' for t in terms if len(t) >= 3)
+    return match, [t for t in terms if len(t) < 3]
+
+def _like_clause(columns, short_terms):
+    """每個短字詞需出現在任一欄位 (trigram 無法索引少於 3 個字元的字詞)"""
+    clauses, params = [], []
+    for term in short_terms:
+        clauses.append("(" + " OR ".join(f"{c} LIKE ?" for c in columns) + ")")
+        params.extend([f"%{term}%"] * len(columns))
+    return " AND ".join(clauses), params
+
+def search_suppliers_text(query, limit=50):
+    """以名稱 / 聯絡人 / Email / 地址全文檢索供應商，依 bm25 排序；回傳格式同 get_suppliers"""
+    match, short_terms = _fts_terms(query)
+    if not match and not short_terms:
+        return []
+    like, like_params = _like_clause([f"s.{c}" for c in SUPPLIER_SEARCH_COLUMNS], short_terms)
+    if not match:
+        return _query(SUPPLIER_SELECT + f' WHERE {like} ORDER BY s.id LIMIT ?', like_params + [limit])
+    sql = SUPPLIER_SELECT + ' JOIN suppliers_fts ON suppliers_fts.rowid = s.id WHERE suppliers_fts MATCH ?'
+    if like:
+        sql += f' AND {like}'
+    return _query(sql + ' ORDER BY suppliers_fts.rank LIMIT ?', [match] + like_params + [limit])
+
+def _fts_ranked_ids(table, match):
+    """
+    回傳依相關度排序的 rowid。先以 rowid 倒序探測命中數 (不需計算 bm25，約 1 ms)：
+    命中數 <= SEARCH_CANDIDATES 時以 bm25 排序；否則為常見字詞，bm25 需走訪整個 doclist (數萬筆時 > 10 ms)，
+    改以新到舊排序並只取最新的 SEARCH_CANDIDATES 筆。
+    """
+    rows = _query(f'SELECT rowid FROM {table} WHERE {table} MATCH ? ORDER BY rowid DESC LIMIT ?', (match, SEARCH_CANDIDATES + 1))
+    if len(rows) > SEARCH_CANDIDATES:
+        return [r[0] for r in rows[:SEARCH_CANDIDATES]]
+    return [r[0] for r in _query(f'SELECT rowid FROM {table} WHERE {table} MATCH ? ORDER BY rank', (match,))]
+
+def search_rfq_history(query, limit=50):
+    """
+    全文檢索 RFQ 原文 (rfq_requests.raw_text) 與品項 (rfq_items.spec)。
+    兩個來源的排名以 reciprocal rank fusion 合併。回傳 [(request_id, created_at, status, raw_text 前 200 字)]。
+    """
+    match, short_terms = _fts_terms(query)
+    if not match and not short_terms:
+        return []
+    like, like_params = _like_clause(["r.raw_text"], short_terms)
+    if not match:
+        return _query(f'''
+            SELECT r.id, r.created_at, r.status, substr(r.raw_text, 1, 200) FROM rfq_requests r
+            WHERE {like} ORDER BY r.id DESC LIMIT ?
+        ''', like_params + [limit])
+
+    scores = {}
+    for pos, req_id in enumerate(_fts_ranked_ids('rfq_requests_fts', match)):
+        scores[req_id] = scores.get(req_id, 0.0) + 1.0 / (60 + pos)
+    item_ids = _fts_ranked_ids('rfq_items_fts', match)
+    if item_ids:
+        owner = dict(_query('SELECT id, request_id FROM rfq_items WHERE id IN (SELECT value FROM json_each(?))', (json.dumps(item_ids),)))
+        best = {}
+        for pos, item_id in enumerate(item_ids):
+            req_id = owner.get(item_id)
+            if req_id is not None and req_id not in best:
+                best[req_id] = pos
+        for req_id, pos in best.items():
+            scores[req_id] = scores.get(req_id, 0.0) + 1.0 / (60 + pos)
+    if not scores:
+        return []
+
+    rows = _query(f'''
+        SELECT r.id, r.created_at, r.status, substr(r.raw_text, 1, 200) FROM rfq_requests r
+        WHERE r.id IN (SELECT value FROM json_each(?)) {('AND ' + like) if like else ''}
+    ''', [json.dumps(list(scores))] + like_params)
+    rows.sort(key=lambda r: (-scores[r[0]], -r[0]))
+    return rows[:limit]
+
+def get_supplier_capabilities(supplier_id=None):
+    """
+    Returns {supplier_id: {"materials": [...], "forms": [...], "qualifications": [...]}}.
+    supplier_id may be a single id or a list of ids (e.g. one page of the supplier table).
+    """
+    capabilities = {}
+    if isinstance(supplier_id, (list, tuple, set)):
+        ids = list(supplier_id)
+        if not ids:
+            return capabilities
+        where, params = f'WHERE supplier_id IN ({",".join("?" * len(ids))})', ids
+    elif supplier_id is not None:
+        where, params = 'WHERE supplier_id = ?', (supplier_id,)
+    else:
+        where, params = '', ()
+    for group, (table, column) in CAPABILITY_TABLES.items():
+        rows = _query(f'SELECT supplier_id, {column} FROM {table} {where} ORDER BY rowid', params)
+        for s_id, value in rows:
+            caps = capabilities.setdefault(s_id, {"materials": [], "forms": [], "qualifications": []})
+            caps[group].append(value)
+    return capabilities
+
+# --- Supplier Capability Index ---
+
+class _CowMap(Mapping):
+    """
+    Copy-on-write mapping for int keys. Entries live in buckets of 1024 ids;
+    copy() shares the buckets and a write copies only the bucket it touches,
+    so publishing a snapshot after one supplier edit costs O(N / 1024), not O(N).
+    """
+    BUCKET_BITS = 10
+
+    def __init__(self):
+        self._buckets = {}
+        self._owned = set()  # buckets not shared with any other snapshot
+        self._len = 0
+
+    def __getitem__(self, key):
+        return self._buckets.get(key >> self.BUCKET_BITS, {})[key]
+
+    def __iter__(self):
+        for bucket in self._buckets.values():
+            yield from bucket
+
+    def __len__(self):
+        return self._len
+
+    def copy(self):
+        clone = _CowMap()
+        clone._buckets = dict(self._buckets)
+        clone._len = self._len
+        self._owned = set()  # buckets are shared from now on
+        return clone
+
+    def _own(self, key):
+        n = key >> self.BUCKET_BITS
+        if n not in self._owned:
+            self._buckets[n] = dict(self._buckets.get(n, {}))
+            self._owned.add(n)
+        return self._buckets[n]
+
+    def __setitem__(self, key, value):
+        bucket = self._own(key)
+        self._len += key not in bucket
+        bucket[key] = value
+
+    def pop(self, key, default=None):
+        if key not in self:
+            return default
+        self._len -= 1
+        return self._own(key).pop(key)
+
+
+class SupplierCapabilityIndex:
+    """
+    In-memory supplier index: each material / form / qualification maps to a
+    bitset (Python int) whose bit N is set when supplier id N has that option.
+    A published index is never mutated: updates copy it and swap the global, so
+    worker threads can iterate `rows` while the UI edits suppliers. The copy is
+    cheap: rows are copy-on-write and only the postings the supplier touches change.
+    """
+    def __init__(self):
+        self.rows = _CowMap()
+        self.caps = _CowMap()  # supplier id -> (materials, forms, qualifications)
+        self.materials = {}
+        self.forms = {}
+        self.qualifications = {}
+
+    @classmethod
+    def build(cls, rows, capabilities):
+        index = cls()
+        empty = {"materials": [], "forms": [], "qualifications": []}
+        for row in rows:
+            caps = capabilities.get(row[0], empty)
+            index.add(row, caps["materials"], caps["forms"], caps["qualifications"])
+        return index
+
+    def copy(self):
+        # postings dicts hold one entry per option value (a few dozen), not per supplier
+        index = SupplierCapabilityIndex()
+        index.rows = self.rows.copy()
+        index.caps = self.caps.copy()
+        index.materials = dict(self.materials)
+        index.forms = dict(self.forms)
+        index.qualifications = dict(self.qualifications)
+        return index
+
+    def add(self, row, materials, forms, qualifications):
+        supplier_id = row[0]
+        self.remove(supplier_id)
+        self.rows[supplier_id] = row
+        self.caps[supplier_id] = (tuple(materials), tuple(forms), tuple(qualifications))
+        bit = 1 << supplier_id
+        for bitsets, values in zip((self.materials, self.forms, self.qualifications), self.caps[supplier_id]):
+            for value in values:
+                bitsets[value] = bitsets.get(value, 0) | bit
+
+    def remove(self, supplier_id):
+        caps = self.caps.pop(supplier_id)
+        if caps is None:
+            return
+        self.rows.pop(supplier_id)
+        mask = ~(1 << supplier_id)
+        for bitsets, values in zip((self.materials, self.forms, self.qualifications), caps):
+            for value in values:
+                bitsets[value] &= mask
+
+    def match(self, materials_list, forms_list, qualifications_list=None):
+        """material ∈ M OR form ∈ F, narrowed to suppliers holding every qualification in Q."""
+        bits = 0
+        for m in materials_list or []:
+            bits |= self.materials.get(m, 0)
+        for f in forms_list or []:
+            bits |= self.forms.get(f, 0)
+        for q in qualifications_list or []:
+            bits &= self.qualifications.get(q, 0)
+        return bits
+
+    def search(self, materials_list, forms_list, qualifications_list=None):
+        bits = self.match(materials_list, forms_list, qualifications_list)
+        rows = []
+        while bits:
+            low = bits & -bits
+            rows.append(self.rows[low.bit_length() - 1])
+            bits ^= low
+        return rows
+
+def get_capability_index():
+    """Returns the process-wide capability index, building it from the DB on first use."""
+    global _capability_index
+    index = _capability_index
+    if index is None:
+        with _capability_lock:
+            if _capability_index is None:
+                _capability_index = SupplierCapabilityIndex.build(get_suppliers(), get_supplier_capabilities())
+            index = _capability_index
+    return index
+
+def invalidate_capability_index():
+    """Drops the cached index (e.g. after bulk imports that bypass this module)."""
+    global _capability_index
+    with _capability_lock:
+        _capability_index = None
+
+def _refresh_indexed_supplier(supplier_id, deleted=False):
+    """Publishes a new index snapshot with this supplier re-read from the DB (or removed)."""
+    global _capability_index
+    with _capability_lock:
+        if _capability_index is None:
+            return
+        row = None
+        if not deleted:
+            rows = _query(SUPPLIER_SELECT + ' WHERE s.id = ?', (supplier_id,))
+            row = rows[0] if rows else None
+        index = _capability_index.copy()
+        if row is None:
+            index.remove(supplier_id)
+        else:
+            index.add(row, _decode_options(row[6]), _decode_options(row[7]), _decode_options(row[8]))
+        _capability_index = index
 
 # --- CRUD Operations for Suppliers ---
 
 def add_supplier(name, contact_person, email, phone, address, materials, forms, qualifications):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO suppliers (name, contact_person, email, phone, address, materials, forms, qualifications)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (name, contact_person, email, phone, address, materials, forms, qualifications))
-    conn.commit()
-    if DB_NAME != ":memory:":
-        conn.close()
+    with transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO suppliers (name, contact_person, email, phone, address)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (name, contact_person, email, phone, address))
+        supplier_id = cursor.lastrowid
+        write_supplier_capabilities(cursor, supplier_id, materials, forms, qualifications)
+    _refresh_indexed_supplier(supplier_id)
+    return supplier_id
 
 def get_suppliers():
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM suppliers')
-    rows = cursor.fetchall()
-    if DB_NAME != ":memory:":
-        conn.close()
-    return rows
+    return _query(SUPPLIER_SELECT)
+
+def get_supplier(supplier_id):
+    rows = _query(SUPPLIER_SELECT + ' WHERE s.id = ?', (supplier_id,))
+    return rows[0] if rows else None
+
+def get_suppliers_by_ids(supplier_ids):
+    """Returns supplier rows in the order of `supplier_ids`; unknown ids are skipped."""
+    ids = list(supplier_ids)
+    if not ids:
+        return []
+    rows = {row[0]: row for row in _query(SUPPLIER_SELECT + ' WHERE s.id IN (SELECT value FROM json_each(?))', (json.dumps(ids),))}
+    return [rows[s_id] for s_id in ids if s_id in rows]
+
+def get_suppliers_page(after_id=None, before_id=None, limit=SUPPLIER_PAGE_SIZE):
+    """
+    Keyset pagination by id: the page after `after_id`, or the page before `before_id`.
+    Rows are always returned in ascending id order.
+    """
+    if before_id is not None:
+        rows = _query(SUPPLIER_SELECT + ' WHERE s.id < ? ORDER BY s.id DESC LIMIT ?', (before_id, limit))
+        return rows[::-1]
+    return _query(SUPPLIER_SELECT + ' WHERE s.id > ? ORDER BY s.id LIMIT ?', (after_id if after_id is not None else -1, limit))
+
+def count_suppliers():
+    return _query('SELECT COUNT(*) FROM suppliers')[0][0]
 
 def update_supplier(supplier_id, name, contact_person, email, phone, address, materials, forms, qualifications):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE suppliers
-        SET name = ?, contact_person = ?, email = ?, phone = ?, address = ?, 
-            materials = ?, forms = ?, qualifications = ?
-        WHERE id = ?
-    ''', (name, contact_person, email, phone, address, materials, forms, qualifications, supplier_id))
-    conn.commit()
-    if DB_NAME != ":memory:":
-        conn.close()
+    with transaction() as cursor:
+        cursor.execute('''
+            UPDATE suppliers
+            SET name = ?, contact_person = ?, email = ?, phone = ?, address = ?
+            WHERE id = ?
+        ''', (name, contact_person, email, phone, address, supplier_id))
+        write_supplier_capabilities(cursor, supplier_id, materials, forms, qualifications)
+    _refresh_indexed_supplier(supplier_id)
 
 def delete_supplier(supplier_id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM suppliers WHERE id = ?', (supplier_id,))
-    conn.commit()
-    if DB_NAME != ":memory:":
-        conn.close()
+    with transaction() as cursor:
+        for table, _ in CAPABILITY_TABLES.values():
+            cursor.execute(f'DELETE FROM {table} WHERE supplier_id = ?', (supplier_id,))
+        cursor.execute('DELETE FROM suppliers WHERE id = ?', (supplier_id,))
+    _refresh_indexed_supplier(supplier_id, deleted=True)
 
 # --- CRUD Operations for Templates ---
 
 # Updated to include cc_recipients and use_default_subject
 def add_template(name, subject_format, preamble_html, closing_html, cc_recipients="", use_default_subject=0):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO templates (name, subject_format, preamble_html, closing_html, cc_recipients, use_default_subject)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (name, subject_format, preamble_html, closing_html, cc_recipients, use_default_subject))
-    conn.commit()
-    if DB_NAME != ":memory:":
-        conn.close()
+    with transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO templates (name, subject_format, preamble_html, closing_html, cc_recipients, use_default_subject)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (name, subject_format, preamble_html, closing_html, cc_recipients, use_default_subject))
 
 def update_template(template_id, name, subject_format, preamble_html, closing_html, cc_recipients, use_default_subject):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        UPDATE templates
-        SET name = ?, subject_format = ?, preamble_html = ?, closing_html = ?, cc_recipients = ?, use_default_subject = ?
-        WHERE id = ?
-    ''', (name, subject_format, preamble_html, closing_html, cc_recipients, use_default_subject, template_id))
-    conn.commit()
-    if DB_NAME != ":memory:":
-        conn.close()
+    with transaction() as cursor:
+        cursor.execute('''
+            UPDATE templates
+            SET name = ?, subject_format = ?, preamble_html = ?, closing_html = ?, cc_recipients = ?, use_default_subject = ?
+            WHERE id = ?
+        ''', (name, subject_format, preamble_html, closing_html, cc_recipients, use_default_subject, template_id))
 
 def delete_template(template_id):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM templates WHERE id = ?', (template_id,))
-    conn.commit()
-    if DB_NAME != ":memory:":
-        conn.close()
+    with transaction() as cursor:
+        cursor.execute('DELETE FROM templates WHERE id = ?', (template_id,))
 
 def get_templates():
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM templates')
-    rows = cursor.fetchall()
-    if DB_NAME != ":memory:":
-        conn.close()
-    return rows
+    return _query('SELECT * FROM templates')
 
 # --- RFQ Operations --- (Unchanged)
 
 def save_rfq_request(raw_text, parsed_items_json, created_by="system"):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO rfq_requests (raw_text, parsed_items, created_by, status)
-        VALUES (?, ?, ?, 'Analyzed')
-    ''', (raw_text, parsed_items_json, created_by))
-    req_id = cursor.lastrowid
-    conn.commit()
-    if DB_NAME != ":memory:":
-        conn.close()
+    with transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO rfq_requests (raw_text, parsed_items, created_by, status)
+            VALUES (?, ?, ?, 'Analyzed')
+        ''', (raw_text, parsed_items_json, created_by))
+        req_id = cursor.lastrowid
     return req_id
 
 def save_rfq_item(request_id, item_index, material_type, form_type, spec_json, matched_suppliers_ids):
-    conn = get_connection()
-    cursor = conn.cursor()
     matched_suppliers_json = json.dumps(matched_suppliers_ids)
-    cursor.execute('''
-        INSERT INTO rfq_items (request_id, item_index, material_type, form_type, spec, matched_suppliers, status)
-        VALUES (?, ?, ?, ?, ?, ?, 'Pending')
-    ''', (request_id, item_index, material_type, form_type, spec_json, matched_suppliers_json))
-    conn.commit()
-    if DB_NAME != ":memory:":
-        conn.close()
-
-def search_suppliers(materials_list, forms_list):
-    conn = get_connection()
-    cursor = conn.cursor()
-    all_suppliers = get_suppliers()
-    matched_suppliers = []
-
-    target_materials = set(materials_list)
-    target_forms = set(forms_list)
-
-    for supplier in all_suppliers:
-        try:
-            s_materials = set(json.loads(supplier[6])) if supplier[6] else set()
-            s_forms = set(json.loads(supplier[7])) if supplier[7] else set()
-            mat_match = not s_materials.isdisjoint(target_materials)
-            form_match = not s_forms.isdisjoint(target_forms)
-            if mat_match or form_match:
-                matched_suppliers.append(supplier)
-        except json.JSONDecodeError:
-            continue
-
-    conditions = []
-    params = []
-    if materials_list:
-        mat_conditions = []
-        for m in materials_list:
-            mat_conditions.append("materials LIKE ?")
-            params.append(f'%"{m}"%')
-        if mat_conditions:
-            conditions.append(f"({' OR '.join(mat_conditions)})")
-
-    if forms_list:
-        form_conditions = []
-        for f in forms_list:
-            form_conditions.append("forms LIKE ?")
-            params.append(f'%"{f}"%')
-        if form_conditions:
-            conditions.append(f"({' OR '.join(form_conditions)})")
-
-    if not conditions:
+    with transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO rfq_items (request_id, item_index, material_type, form_type, spec, matched_suppliers, status)
+            VALUES (?, ?, ?, ?, ?, ?, 'Pending')
+        ''', (request_id, item_index, material_type, form_type, spec_json, matched_suppliers_json))
+
+def save_rfq_analysis(raw_text, items, matches, created_by="system"):
+    """
+    Saves an analyzed RFQ and all of its items in one transaction.
+    matches[i] is the list of matched supplier ids for items[i].
+    Returns (request_id, [rfq_item ids in item order]).
+    Raises ValueError (before writing anything) if items and matches differ in length.
+    """
+    if len(items) != len(matches):
+        raise ValueError(f"save_rfq_analysis: {len(items)} items but {len(matches)} match lists")
+    with transaction() as cursor:
+        cursor.execute('''
+            INSERT INTO rfq_requests (raw_text, parsed_items, created_by, status)
+            VALUES (?, ?, ?, 'Analyzed')
+        ''', (raw_text, json.dumps(items), created_by))
+        req_id = cursor.lastrowid
+        cursor.executemany('''
+            INSERT INTO rfq_items (request_id, item_index, material_type, form_type, spec, matched_suppliers, status)
+            VALUES (?, ?, ?, ?, ?, ?, 'Pending')
+        ''', [
+            (req_id, idx, item.get("material_type", "Other"), item.get("form", "Other"), json.dumps(item), json.dumps(matched_ids))
+            for idx, (item, matched_ids) in enumerate(zip(items, matches))
+        ])
+        cursor.execute('SELECT id FROM rfq_items WHERE request_id = ? ORDER BY item_index', (req_id,))
+        item_ids = [row[0] for row in cursor.fetchall()]
+    return req_id, item_ids
+
+# --- RFQ History ---
+
+def _utc_day_bounds(date_from=None, date_to=None):
+    """
+    本地日期區間 ('YYYY-MM-DD', 含頭尾) 換成 UTC 時間字串 [start, end)。
+    created_at 由 CURRENT_TIMESTAMP 產生，存的是 UTC；台灣 (UTC+8) 的一天是前一日 16:00 起算。
+    """
+    def to_utc(day, offset_days=0):
+        local = datetime.strptime(day, "%Y-%m-%d") + timedelta(days=offset_days)
+        return local.astimezone().astimezone(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    return (to_utc(date_from) if date_from else None,
+            to_utc(date_to, 1) if date_to else None)
+
+def _rfq_id_bounds(start=None, end=None):
+    """
+    UTC 時間區間 [start, end) 內 rfq_requests.id 的最小 / 最大值 (low, high)；區間內沒有資料時回傳 None。
+    只用來縮小 id 範圍 (走 created_at 索引)，不假設 created_at 與 id 同步遞增；精確比對另由呼叫端加上日期條件。
+    """
+    if not start and not end:
+        return None, None
+    conds, params = [], []
+    if start:
+        conds.append('created_at >= ?')
+        params.append(start)
+    if end:
+        conds.append('created_at < ?')
+        params.append(end)
+    low, high = _query(f'SELECT MIN(id), MAX(id) FROM rfq_requests WHERE {" AND ".join(conds)}', params)[0]
+    if low is None:
+        return None
+    return low, high
+
+def get_rfq_history_page(before_id=None, limit=RFQ_HISTORY_PAGE_SIZE, status=None, material_type=None, date_from=None, date_to=None):
+    """
+    詢價紀錄 keyset 分頁 (由新到舊)：回傳 id < before_id 的下一頁。
+    每列為 (id, created_at, status, raw_text 前 200 字, 品項數)；品項本身請用 get_rfq_items 延遲載入。
+    """
+    start, end = _utc_day_bounds(date_from, date_to)
+    bounds = _rfq_id_bounds(start, end)
+    if bounds is None:
         return []
+    low, high = bounds
 
-    sql = f"SELECT * FROM suppliers WHERE {' OR '.join(conditions)}"
-    cursor.execute(sql, params)
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    # id 條件依查詢起點套用在 r.id 或 i.request_id
+    id_conds, params = [], []
+    for op, value in (('<', before_id), ('>=', low), ('<=', high)):
+        if value is not None:
+            id_conds.append((op, value))
+            params.append(value)
+    date_conds = []
+    for cond, value in (('r.created_at >= ?', start), ('r.created_at < ?', end)):
+        if value:
+            date_conds.append(cond)
+            params.append(value)
+    if status:
+        params.append(status)
+
+    select = '''
+        SELECT r.id, r.created_at, r.status, substr(r.raw_text, 1, 200),
+            (SELECT COUNT(*) FROM rfq_items c WHERE c.request_id = r.id)
+    '''
+    if material_type:
+        # 由 idx_rfq_items_material 依 request_id 倒序走訪，不會掃過其他材料的紀錄
+        conds = ['i.material_type = ?'] + [f'i.request_id {op} ?' for op, _ in id_conds] + date_conds
+        if status:
+            conds.append('r.status = ?')
+        sql = select + f'''
+            FROM rfq_items i JOIN rfq_requests r ON r.id = i.request_id
+            WHERE {" AND ".join(conds)}
+            GROUP BY i.request_id ORDER BY i.request_id DESC LIMIT ?
+        '''
+        return _query(sql, [material_type] + params + [limit])
+
+    conds = [f'r.id {op} ?' for op, _ in id_conds] + date_conds
+    if status:
+        conds.append('r.status = ?')
+    where = " AND ".join(conds) or '1'
+    return _query(select + f' FROM rfq_requests r WHERE {where} ORDER BY r.id DESC LIMIT ?', params + [limit])
+
+def get_rfq_statuses():
+    return [row[0] for row in _query('SELECT DISTINCT status FROM rfq_requests WHERE status IS NOT NULL ORDER BY status')]
+
+def get_rfq_items(request_id):
+    """回傳單一詢價的品項 [(id, item_index, material_type, form_type, spec, matched_suppliers, status)]"""
+    return _query('''
+        SELECT id, item_index, material_type, form_type, spec, matched_suppliers, status
+        FROM rfq_items WHERE request_id = ? ORDER BY item_index
+    ''', (request_id,))
+
+# --- Parse Cache ---
+
+def get_cached_parse(cache_key):
+    """Returns the cached result JSON string (and bumps its LRU timestamp), or None."""
+    with transaction() as cursor:
+        cursor.execute('SELECT result FROM parse_cache WHERE cache_key = ?', (cache_key,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        cursor.execute(
+            'UPDATE parse_cache SET hit_count = hit_count + 1, last_used_at = ? WHERE cache_key = ?',
+            (time.time(), cache_key)
+        )
+    return row[0]
+
+def put_cached_parse(cache_key, prompt_version, result_json, max_entries=PARSE_CACHE_MAX_ENTRIES):
+    """Stores a result and evicts the least recently used entries beyond max_entries."""
+    with transaction() as cursor:
+        cursor.execute('''
+            INSERT OR REPLACE INTO parse_cache (cache_key, prompt_version, result, last_used_at)
+            VALUES (?, ?, ?, ?)
+        ''', (cache_key, prompt_version, result_json, time.time()))
+        cursor.execute('''
+            DELETE FROM parse_cache WHERE cache_key IN (
+                SELECT cache_key FROM parse_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+            )
+        ''', (max_entries,))
+
+def purge_parse_cache(keep_prompt_version=None):
+    """Deletes entries from other prompt versions (or everything when None). Returns the number removed."""
+    with transaction() as cursor:
+        if keep_prompt_version is None:
+            cursor.execute('DELETE FROM parse_cache')
+        else:
+            cursor.execute('DELETE FROM parse_cache WHERE prompt_version != ?', (keep_prompt_version,))
+        return cursor.rowcount
+
+def count_parse_cache():
+    return _query('SELECT COUNT(*) FROM parse_cache')[0][0]
+
+def search_suppliers(materials_list, forms_list, qualifications_list=None):
+    """
+    Returns supplier rows offering any of the materials or forms. When
+    qualifications_list is given, only suppliers holding all of them are kept.
+    """
+    if not materials_list and not forms_list:
+        return []
+    return get_capability_index().search(materials_list, forms_list, qualifications_list)
 
 if __name__ == "__main__":
     init_db()
@@ -0,0 +1,194 @@
+# drafts.py
+# 詢價草稿輸出：樣板預先編譯一次，每家供應商只填主旨 / 收件人；
+# 由工作執行緒池組成 RFC 822 郵件後交給輸出端 (.eml 檔或 Outlook COM)。
+
+import html
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from email.message import EmailMessage
+from email.policy import SMTP
+
+DRAFTS_DIR = "drafts"
+DRAFT_WORKERS = 4  # 同時組信 / 寫檔的執行緒數
+
+DEFAULT_TEMPLATE = (0, "Default", "Inquiry {date}", "<p>Hi,</p>", "<p>Thanks</p>", "", "", "", "", "", "", "", 0)
+
+_CELL = "border: 1px solid #333; padding: 10px;"
+_HEADERS = ["Material", "Spec", "Form", "Dimensions", "Quantity", "Price", "MOQ", "Notes"]
+_TABLE_HEAD = (
+    "<table style='border-collapse: collapse; width: 100%; font-family: Arial, sans-serif; font-size: 13px;'><thead><tr>"
+    + "".join(f"<th style='{_CELL} background-color: #eee;'>{h}</th>" for h in _HEADERS)
+    + "</tr></thead><tbody>"
+)
+_TABLE_TAIL = "</tbody></table>"
+_ROW = "<tr>" + "".join(f"<td style='{_CELL}'>{{{k}}}</td>" for k in (
+    "material", "material_spec", "form", "dimensions", "quantity", "price", "moq", "notes"
+)) + "</tr>"
+_UNSAFE_FILENAME = re.compile(r'[\\/:*?"<>|\s]+')
+
+
+@dataclass
+class Draft:
+    supplier_id: int
+    to: str
+    cc: str
+    subject: str
+    html: str
+
+    def to_message(self, sender=None):
+        msg = EmailMessage()
+        msg["Subject"] = self.subject
+        if sender:
+            msg["From"] = sender
+        msg["To"] = self.to or ""
+        if self.cc:
+            msg["Cc"] = self.cc
+        # Outlook / Thunderbird 開啟時視為未寄出的草稿
+        msg["X-Unsent"] = "1"
+        msg.set_content("此郵件為 HTML 格式。")
+        msg.add_alternative(self.html, subtype="html")
+        return msg
+
+
+class CompiledTemplate:
+    """templates 資料列預先處理成固定的 HTML 片段與主旨格式；render 時只做字串組合"""
+    def __init__(self, template):
+        template = tuple(template) + (None,) * (13 - len(template))
+        self.subject_format = template[2] or "Inquiry"
+        self.preamble = f"<div>{template[3] or ''}</div>"
+        self.closing = f"<div>{template[4] or ''}</div>"
+        self.cc = template[11] or ""
+        self.use_default_subject = bool(template[12])
+
+    def render_table(self, items):
+        rows = "".join(_ROW.format(
+            material=f"{_esc(item.get('material_type'))}<br>({_esc(item.get('qual'))})",
+            material_spec=_esc(item.get("material_spec")),
+            form=_esc(item.get("form")),
+            dimensions=_esc(item.get("dimensions")),
+            quantity=_esc(item.get("quantity")),
+            price="",
+            moq=_esc(item.get("moq")),
+            notes=_esc(item.get("notes")),
+        ) for item in items)
+        return _TABLE_HEAD + rows + _TABLE_TAIL
+
+    def render_body(self, items, annotation=""):
+        """同一群組寄給每家供應商的內文相同，只需組一次"""
+        extra = f"<div style='margin-bottom: 10px;'>{_esc(annotation)}</div>" if annotation else ""
+        return f"{self.preamble}{extra}<br>{self.render_table(items)}<br>{self.closing}"
+
+    def subject_prefix(self, material_type_group, now=None):
+        now = now or datetime.now()
+        if self.use_default_subject:
+            return f"RFQ{now.strftime('%y%m%d%H')}_{material_type_group}_"
+        return self.subject_format.format(date=now.strftime("%Y%m%d")) + "_"
+
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+def compile_template(template):
+    """同一樣板內容只編譯一次 (以資料列內容為 key，樣板修改後自然失效)"""
+    key = tuple(template)
+    with _compiled_lock:
+        compiled = _compiled.get(key)
+        if compiled is None:
+            compiled = _compiled[key] = CompiledTemplate(template)
+    return compiled
+
+def _esc(value):
+    return html.escape(str(value)) if value is not None else ""
+
+
+# --- 輸出端 (sink) ---
+# 介面: write(draft) -> 描述字串；thread_safe=False 的輸出端由呼叫端執行緒依序寫入
+
+class EmlSink:
+    """寫成 .eml 檔 (RFC 822)，任何平台皆可用郵件程式開啟後寄出"""
+    thread_safe = True
+
+    def __init__(self, directory=DRAFTS_DIR, sender=None):
+        self.directory = directory
+        self.sender = sender
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, draft):
+        name = _UNSAFE_FILENAME.sub("_", draft.subject).strip("_")[:120] or "draft"
+        path = os.path.join(self.directory, f"{name}_{draft.supplier_id}.eml")
+        with open(path, "wb") as f:
+            f.write(draft.to_message(self.sender).as_bytes(policy=SMTP))
+        return path
+
+    def close(self):
+        pass
+
+
+class OutlookSink:
+    """存成 Outlook 草稿；COM 物件不可跨執行緒，須在同一執行緒依序呼叫"""
+    thread_safe = False
+
+    def __init__(self):
+        import pythoncom
+        import win32com.client
+        pythoncom.CoInitialize()  # 於背景執行緒建立時需先初始化 COM
+        self.outlook = win32com.client.Dispatch('Outlook.Application')
+
+    def write(self, draft):
+        mail = self.outlook.CreateItem(0)
+        mail.Subject, mail.To, mail.CC = draft.subject, draft.to, draft.cc
+        mail.HTMLBody = draft.html
+        mail.Save()
+        return draft.subject
+
+    def close(self):
+        import pythoncom
+        pythoncom.CoUninitialize()
+
+
+def default_sink():
+    """Windows 且安裝 pywin32 時存到 Outlook，其餘平台輸出 .eml"""
+    if os.name == 'nt':
+        try:
+            return OutlookSink()
+        except ImportError:
+            pass
+    return EmlSink()
+
+
+def build_drafts(template, suppliers, items, material_type_group, annotation=""):
+    """suppliers: 供應商資料列 (id, name, contact, email, ...)；回傳每家一封 Draft"""
+    compiled = compile_template(template)
+    body = compiled.render_body(items, annotation)
+    prefix = compiled.subject_prefix(material_type_group)
+    return [Draft(s[0], s[3] or "", compiled.cc, prefix + s[1], body) for s in suppliers]
+
+
+def write_drafts(drafts, sink, workers=DRAFT_WORKERS):
+    """
+    將草稿交給輸出端；thread_safe 的輸出端 (.eml) 由執行緒池平行組信寫檔。
+    回傳 (成功清單, [(draft, 例外)])，單封失敗不影響其他封。
+    """
+    written, failed = [], []
+
+    def _write(draft):
+        try:
+            return draft, sink.write(draft), None
+        except Exception as ex:
+            return draft, None, ex
+
+    if sink.thread_safe and len(drafts) > 1:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rfq-drafts") as pool:
+            results = list(pool.map(_write, drafts))
+    else:
+        results = [_write(d) for d in drafts]
+    for draft, result, error in results:
+        if error is None:
+            written.append(result)
+        else:
+            failed.append((draft, error))
+    return written, failed
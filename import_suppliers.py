@@ -1,10 +1,8 @@
-import sqlite3
 import csv
 import json
 import os
 
-# 設定資料庫檔案名稱 (需與 database.py 一致)
-DB_NAME = "rfq_system.db"
+import database
 
 def clean_and_json(value_str):
     """將逗號分隔的字串轉換為 JSON 陣列"""
@@ -19,44 +17,41 @@ def import_from_csv(csv_file):
         print(f"錯誤：找不到檔案 {csv_file}")
         return
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    # 確保關聯表 (supplier_materials / forms / qualifications) 已建立
+    database.init_db()
 
     count = 0
     try:
-        with open(csv_file, mode='r', encoding='utf-8-sig') as f:
+        # 單一交易: 全部成功才 commit，任何一筆失敗即整批 rollback
+        with database.transaction() as cursor, open(csv_file, mode='r', encoding='utf-8-sig') as f:
             reader = csv.DictReader(f)
             for row in reader:
-                # 轉換多選欄位為 JSON 格式
-                materials_json = clean_and_json(row['Materials'])
-                forms_json = clean_and_json(row['Forms'])
-                quals_json = clean_and_json(row['Qualifications'])
-
                 cursor.execute('''
                     INSERT INTO suppliers (
-                        name, contact_person, email, phone, address, 
-                        materials, forms, qualifications
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                        name, contact_person, email, phone, address
+                    ) VALUES (?, ?, ?, ?, ?)
                 ''', (
                     row['Name'],
                     row['Contact'],
                     row['Email'],
                     row['Phone'],
-                    row['Address'],
-                    materials_json,
-                    forms_json,
-                    quals_json
+                    row['Address']
                 ))
+                # 多選欄位寫入關聯表
+                database.write_supplier_capabilities(
+                    cursor,
+                    cursor.lastrowid,
+                    clean_and_json(row['Materials']),
+                    clean_and_json(row['Forms']),
+                    clean_and_json(row['Qualifications'])
+                )
                 count += 1
-        
-        conn.commit()
+
+        database.invalidate_capability_index()
         print(f"成功！已匯入 {count} 筆供應商資料。")
 
     except Exception as e:
         print(f"匯入失敗：{e}")
-        conn.rollback()
-    finally:
-        conn.close()
 
 if __name__ == "__main__":
     # 請確保您的 CSV 檔名為 suppliers.csv
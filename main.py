@@ -1,10 +1,14 @@
 import flet as ft
 import json
 import os
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from config import TRANSLATIONS, OPTIONS, OPTION_TRANSLATIONS
 import database
 import analyzer
+import drafts
+
+ANALYSIS_WORKERS = 2  # 同時進行的背景解析數量 (其餘排隊)
 
 # --- 工具函數 ---
 def to_json_str(data_list):
@@ -25,8 +29,16 @@ class SupplierManager(ft.Column):
         self.t = TRANSLATIONS[lang]
         self.opt_trans = OPTION_TRANSLATIONS.get(lang, {})
         
-        self.suppliers = []
+        self.suppliers = {}
+        self.capabilities = {}
+        self.row_by_id = {}
         self.editing_id = None
+        self.loaded = False
+        # keyset 分頁: 各頁起點 (前一頁最後一筆 id) 的堆疊，None 代表第一頁
+        self.page_after_ids = [None]
+        self.has_next = False
+        self.total = 0
+        self._display_cache = {}
         
         # 初始化輸入欄位
         self.input_name = ft.TextField(label=self.t["name"])
@@ -67,11 +79,25 @@ class SupplierManager(ft.Column):
             icon=ft.Icons.ADD,
             on_click=self.open_add_dialog
         )
+        self.search_query = ""
+        self.search_box = ft.TextField(
+            hint_text=self.t["search_hint"],
+            prefix_icon=ft.Icons.SEARCH,
+            dense=True,
+            width=320,
+            on_submit=self.run_search,
+            on_change=lambda e: self.run_search(e) if not e.control.value else None
+        )
+        
+        self.prev_btn = ft.IconButton(ft.Icons.CHEVRON_LEFT, on_click=lambda e: self.go_page(-1), disabled=True)
+        self.next_btn = ft.IconButton(ft.Icons.CHEVRON_RIGHT, on_click=lambda e: self.go_page(1), disabled=True)
+        self.page_info = ft.Text("", size=12)
         
         self.controls = [
-            ft.Row([ft.Text(self.t["supplier_management"], size=30), self.add_btn], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
+            ft.Row([ft.Text(self.t["supplier_management"], size=30), ft.Row([self.search_box, self.add_btn])], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
             ft.Divider(),
-            ft.Row([self.data_table], scroll=ft.ScrollMode.AUTO)
+            ft.Row([self.data_table], scroll=ft.ScrollMode.AUTO),
+            ft.Row([self.prev_btn, self.page_info, self.next_btn], alignment=ft.MainAxisAlignment.CENTER)
         ]
 
     def _create_checkbox_group(self, options):
@@ -95,38 +121,113 @@ class SupplierManager(ft.Column):
         self._set_checked_values(self.check_qualifications, [])
         self.editing_id = None
 
-    def load_data(self):
-        self.suppliers = database.get_suppliers()
-        self.data_table.rows = []
-        for s in self.suppliers:
-            s_id = s[0]
-            mats = from_json_str(s[6])
-            forms = from_json_str(s[7])
-            quals = from_json_str(s[8])
-            
-            mats_disp = ", ".join([self.opt_trans.get(m, m) for m in mats])
-            forms_disp = ", ".join([self.opt_trans.get(f, f) for f in forms])
-            quals_disp = ", ".join([self.opt_trans.get(q, q) for q in quals])
+    def _display(self, values):
+        """選項清單的翻譯顯示字串 (依內容快取，避免每列重新組字串)"""
+        key = tuple(values)
+        text = self._display_cache.get(key)
+        if text is None:
+            text = ", ".join([self.opt_trans.get(v, v) for v in values])
+            self._display_cache[key] = text
+        return text
+
+    def _build_row(self, s):
+        s_id = s[0]
+        caps = self.capabilities.get(s_id, {})
+        return ft.DataRow(cells=[
+            ft.DataCell(ft.Text(s[1])),
+            ft.DataCell(ft.Text(s[2])),
+            ft.DataCell(ft.Text(s[4])),
+            ft.DataCell(ft.Text(self._display(caps.get("materials", [])))),
+            ft.DataCell(ft.Text(self._display(caps.get("forms", [])))),
+            ft.DataCell(ft.Text(self._display(caps.get("qualifications", [])))),
+            ft.DataCell(ft.Row([
+                ft.IconButton(ft.Icons.EDIT, on_click=lambda e, sid=s_id: self.open_edit_dialog(sid)),
+                ft.IconButton(ft.Icons.DELETE, on_click=lambda e, sid=s_id: self.delete_supplier(sid))
+            ])),
+        ])
 
-            self.data_table.rows.append(
-                ft.DataRow(cells=[
-                    ft.DataCell(ft.Text(s[1])),
-                    ft.DataCell(ft.Text(s[2])),
-                    ft.DataCell(ft.Text(s[4])),
-                    ft.DataCell(ft.Text(mats_disp)),
-                    ft.DataCell(ft.Text(forms_disp)),
-                    ft.DataCell(ft.Text(quals_disp)),
-                    ft.DataCell(ft.Row([
-                        ft.IconButton(ft.Icons.EDIT, on_click=lambda e, sid=s_id: self.open_edit_dialog(sid)),
-                        ft.IconButton(ft.Icons.DELETE, on_click=lambda e, sid=s_id: self.delete_supplier(sid))
-                    ])),
-                ])
-            )
+    def _refresh_pager(self):
+        if self.search_query:
+            self.page_info.value = self.t["search_results"].format(
+                query=self.search_query, count=len(self.suppliers))
+            self.prev_btn.disabled = self.next_btn.disabled = True
+            return
+        page_no = len(self.page_after_ids)
+        self.page_info.value = self.t["page_info"].format(page=page_no, total=self.total)
+        self.prev_btn.disabled = page_no == 1
+        self.next_btn.disabled = not self.has_next
+
+    def _safe_update(self):
         try:
             self.update()
         except Exception:
             pass
 
+    def load_data(self, force=False):
+        """載入目前頁 (keyset 分頁)；已載入時切換分頁不會重建表格，除非 force=True"""
+        if self.loaded and not force:
+            return
+        page_size = database.SUPPLIER_PAGE_SIZE
+        if self.search_query:
+            rows = database.search_suppliers_text(self.search_query, limit=page_size)
+            self.has_next = False
+        else:
+            # 多取一筆判斷是否還有下一頁
+            rows = database.get_suppliers_page(after_id=self.page_after_ids[-1], limit=page_size + 1)
+            if not rows and len(self.page_after_ids) > 1:
+                # 本頁已被刪空，退回前一頁
+                self.page_after_ids.pop()
+                rows = database.get_suppliers_page(after_id=self.page_after_ids[-1], limit=page_size + 1)
+            self.has_next = len(rows) > page_size
+            rows = rows[:page_size]
+
+        self.suppliers = {s[0]: s for s in rows}
+        self.capabilities = database.get_supplier_capabilities(list(self.suppliers))
+        self.total = database.count_suppliers()
+        self.row_by_id = {s[0]: self._build_row(s) for s in rows}
+        self.data_table.rows = list(self.row_by_id.values())
+        self.loaded = True
+        self._refresh_pager()
+        self._safe_update()
+
+    def run_search(self, e):
+        """全文檢索 (FTS5)；清空搜尋框則回到分頁瀏覽"""
+        self.search_query = (self.search_box.value or "").strip()
+        self.page_after_ids = [None]
+        self.load_data(force=True)
+
+    def go_page(self, step):
+        if step > 0 and self.has_next and self.suppliers:
+            self.page_after_ids.append(max(self.suppliers))
+        elif step < 0 and len(self.page_after_ids) > 1:
+            self.page_after_ids.pop()
+        else:
+            return
+        self.load_data(force=True)
+
+    def _patch_row(self, s_id):
+        """新增 / 編輯後只更新該列，不重建整張表"""
+        s = database.get_supplier(s_id)
+        if s is None:
+            return
+        self.capabilities.update(database.get_supplier_capabilities(s_id) or {s_id: {}})
+        row = self._build_row(s)
+        old_row = self.row_by_id.get(s_id)
+        if old_row is not None:
+            self.data_table.rows[self.data_table.rows.index(old_row)] = row
+        elif self.search_query:
+            # 搜尋結果中不插入新列
+            return
+        elif not self.has_next and len(self.suppliers) < database.SUPPLIER_PAGE_SIZE:
+            # 新的 id 最大，只有在最後一頁且未滿時才會出現在目前頁
+            self.data_table.rows.append(row)
+        else:
+            # 新供應商落在後面的頁
+            self.has_next = True
+            return
+        self.suppliers[s_id] = s
+        self.row_by_id[s_id] = row
+
     def open_add_dialog(self, e):
         self._clear_inputs()
         self.dialog.title.value = ft.Text(self.t["add_supplier"])
@@ -134,7 +235,7 @@ class SupplierManager(ft.Column):
         self.main_page.update()
 
     def open_edit_dialog(self, s_id):
-        supplier = next((s for s in self.suppliers if s[0] == s_id), None)
+        supplier = self.suppliers.get(s_id)
         if not supplier: return
         self.editing_id = s_id
         self.input_name.value = supplier[1]
@@ -142,9 +243,10 @@ class SupplierManager(ft.Column):
         self.input_email.value = supplier[3]
         self.input_phone.value = supplier[4]
         self.input_address.value = supplier[5]
-        self._set_checked_values(self.check_materials, from_json_str(supplier[6]))
-        self._set_checked_values(self.check_forms, from_json_str(supplier[7]))
-        self._set_checked_values(self.check_qualifications, from_json_str(supplier[8]))
+        caps = self.capabilities.get(s_id, {})
+        self._set_checked_values(self.check_materials, caps.get("materials", []))
+        self._set_checked_values(self.check_forms, caps.get("forms", []))
+        self._set_checked_values(self.check_qualifications, caps.get("qualifications", []))
         self.dialog.title.value = ft.Text(self.t["edit_supplier"])
         self.dialog.open = True
         self.main_page.update()
@@ -162,15 +264,29 @@ class SupplierManager(ft.Column):
             to_json_str(self._get_checked_values(self.check_qualifications))
         )
         if self.editing_id:
-            database.update_supplier(self.editing_id, *data)
+            s_id = self.editing_id
+            database.update_supplier(s_id, *data)
         else:
-            database.add_supplier(*data)
+            s_id = database.add_supplier(*data)
+            self.total += 1
         self.close_dialog(None)
-        self.load_data()
+        self._patch_row(s_id)
+        self._refresh_pager()
+        self._safe_update()
 
     def delete_supplier(self, s_id):
         database.delete_supplier(s_id)
-        self.load_data()
+        row = self.row_by_id.pop(s_id, None)
+        if row is not None:
+            self.data_table.rows.remove(row)
+        self.suppliers.pop(s_id, None)
+        self.capabilities.pop(s_id, None)
+        self.total -= 1
+        if not self.suppliers and not self.search_query:
+            self.load_data(force=True)
+            return
+        self._refresh_pager()
+        self._safe_update()
 
 # --- 樣板管理組件 (維持您手動修復後的版本) ---
 class TemplateManager(ft.Column):
@@ -289,7 +405,138 @@ class TemplateManager(ft.Column):
         database.delete_template(t_id)
         self.load_data()
 
-# --- 詢價解析組件 (應用修改：輸入框放大 + 認證過濾 + UI版面調整) ---
+class AnalysisJob:
+    """背景解析佇列中的一筆 RFQ：持有取消旗標、進度列與該筆的結果區塊"""
+    def __init__(self, job_no, text, on_cancel):
+        self.job_no = job_no
+        self.text = text
+        self.cancel_event = threading.Event()
+        self.status_text = ft.Text("排隊中...", size=12, expand=True)
+        self.progress_ring = ft.ProgressRing(width=16, height=16, stroke_width=2, visible=False)
+        self.cancel_btn = ft.IconButton(ft.Icons.CANCEL, tooltip="取消", on_click=lambda e: on_cancel(self))
+        preview = text.strip().splitlines()[0][:40] if text.strip() else ""
+        self.row = ft.Row([
+            self.progress_ring,
+            ft.Text(f"RFQ #{job_no}", weight=ft.FontWeight.BOLD),
+            ft.Text(preview, size=12, color=ft.Colors.GREY_700, width=300, no_wrap=True),
+            self.status_text,
+            self.cancel_btn
+        ])
+        self.section = ft.Column([ft.Text(f"RFQ #{job_no}", size=16, weight=ft.FontWeight.BOLD)], visible=False)
+        self.cards = {}
+        self.streamed = []
+
+_QUAL_RANK = {"ISO": 0, "Automotive": 1, "Aerospace": 2}
+
+class MaterialGroupCard:
+    """單一材質群組的結果卡片；串流解析時逐列 add_item，需求認證升級時重新篩選供應商"""
+    def __init__(self, mat_type, on_generate_drafts):
+        self.mat_type = mat_type
+        self.req_qual = "ISO"
+        self.matched_suppliers = database.search_suppliers([mat_type], [], [self.req_qual])
+        self.ui_rows_data = []
+
+        self.items_table = ft.DataTable(
+            columns=[
+                ft.DataColumn(ft.Text("#/Qual")), 
+                ft.DataColumn(ft.Text("Spec")), 
+                ft.DataColumn(ft.Text("Form")), 
+                ft.DataColumn(ft.Text("Dimensions")), 
+                ft.DataColumn(ft.Text("Qty")), 
+                ft.DataColumn(ft.Text("Price")), 
+                ft.DataColumn(ft.Text("MOQ")), 
+                ft.DataColumn(ft.Text("Notes"))
+            ], 
+            rows=[], 
+            border=ft.border.all(1, ft.Colors.GREY_300)
+        )
+        self.qual_badge = ft.Text(f"需求認證: {self.req_qual}", color=ft.Colors.WHITE)
+        self.supplier_hint = ft.Text(weight=ft.FontWeight.BOLD)
+        self.supp_dds = [ft.Dropdown(width=200, dense=True) for i in range(4)]
+        self._refresh_suppliers()
+
+        # 群組專用的備註輸入框
+        txt_group_anno = ft.TextField(label="詢價備註 (將顯示於 Email Preamble 下方)", multiline=True, min_lines=2, text_size=13)
+
+        batch_draft_btn = ft.Button(
+            "生成草稿 (批次)",
+            icon=ft.Icons.EMAIL,
+            on_click=lambda e: on_generate_drafts(self.ui_rows_data, self.supp_dds, mat_type, txt_group_anno.value)
+        )
+        
+        self.card = ft.Card(content=ft.Container(padding=20, content=ft.Column([
+            ft.Row([
+                ft.Icon(ft.Icons.CATEGORY, color=ft.Colors.BLUE), 
+                ft.Text(f"材質群組: {mat_type}", size=20, weight=ft.FontWeight.BOLD),
+                ft.Container(content=self.qual_badge, bgcolor=ft.Colors.BLUE, padding=5, border_radius=5)
+            ]), 
+            ft.Divider(), 
+            ft.Row([self.items_table], expand=True, scroll=ft.ScrollMode.AUTO), 
+            ft.Divider(), 
+            txt_group_anno,
+            self.supplier_hint, 
+            ft.Row(self.supp_dds, wrap=True), 
+            ft.Row([batch_draft_btn], alignment=ft.MainAxisAlignment.END)
+        ])))
+
+    def _refresh_suppliers(self):
+        options = [ft.dropdown.Option(str(s[0]), f"{s[1]} ({s[2]})") for s in self.matched_suppliers]
+        valid_ids = {o.key for o in options}
+        for i, dd in enumerate(self.supp_dds):
+            dd.label = f"供應商 {i+1} ({self.req_qual})"
+            dd.options = options
+            if dd.value not in valid_ids:
+                dd.value = None
+        self.qual_badge.value = f"需求認證: {self.req_qual}"
+        self.supplier_hint.value = f"選擇詢價對象 (已篩選 {self.req_qual} 認證, 最多 4 家):"
+
+    def add_item(self, item):
+        # 認證類別篩選邏輯: 群組取最高等級，升級時重新匹配供應商
+        qual = item.get("qualification", "ISO")
+        if _QUAL_RANK.get(qual, 0) > _QUAL_RANK[self.req_qual]:
+            self.req_qual = qual
+            self.matched_suppliers = database.search_suppliers([self.mat_type], [], [self.req_qual])
+            self._refresh_suppliers()
+
+        txt_spec = ft.TextField(value=item.get("material_spec", "-"), border=ft.InputBorder.UNDERLINE, dense=True, text_size=13, expand=True)
+        txt_form = ft.TextField(value=item.get("form", "-"), border=ft.InputBorder.UNDERLINE, dense=True, text_size=13, width=80)
+        txt_dims = ft.TextField(value=item.get("dimensions", "-"), border=ft.InputBorder.UNDERLINE, dense=True, text_size=13, expand=True)
+        txt_qty = ft.TextField(value=item.get("quantity", "-"), border=ft.InputBorder.UNDERLINE, dense=True, text_size=13, width=80)
+        txt_notes = ft.TextField(value=item.get("notes", "-"), border=ft.InputBorder.UNDERLINE, dense=True, text_size=13, expand=True)
+        txt_moq = ft.TextField(value="", border=ft.InputBorder.UNDERLINE, dense=True, text_size=13, width=80, hint_text="if need")
+        
+        self.ui_rows_data.append({
+            "mat_type": self.mat_type, 
+            "spec": txt_spec, 
+            "form": txt_form, 
+            "dimensions": txt_dims, 
+            "quantity": txt_qty, 
+            "moq": txt_moq, 
+            "notes": txt_notes,
+            "qual": qual
+        })
+        
+        mat_display = ft.Column([
+            ft.Text(str(len(self.ui_rows_data))),
+            ft.Container(
+                content=ft.Text(qual, size=10, color=ft.Colors.WHITE),
+                bgcolor=ft.Colors.BLUE_GREY if qual=="ISO" else (ft.Colors.ORANGE if qual=="Automotive" else ft.Colors.RED),
+                padding=2, border_radius=3
+            )
+        ], spacing=2)
+
+        self.items_table.rows.append(ft.DataRow(cells=[
+            ft.DataCell(mat_display),
+            ft.DataCell(txt_spec), 
+            ft.DataCell(txt_form), 
+            ft.DataCell(txt_dims), 
+            ft.DataCell(txt_qty), 
+            ft.DataCell(ft.Text("(Vendor)")), 
+            ft.DataCell(txt_moq), 
+            ft.DataCell(txt_notes)
+        ]))
+
+# --- 詢價解析組件 (應用修改：輸入框放大 + 認證過濾 + UI版面調整 + 背景解析佇列) ---
 class RFQAnalyzer(ft.Column):
     def __init__(self, page: ft.Page, lang="zh"):
         super().__init__(expand=True, scroll=ft.ScrollMode.AUTO)
@@ -299,6 +546,12 @@ class RFQAnalyzer(ft.Column):
         self.opt_trans = OPTION_TRANSLATIONS.get(lang, {})
         self.analyzed_items = []
 
+        # 背景解析: 點擊後立即排入佇列，UI 不再等待 GPT 回應
+        self.executor = ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS, thread_name_prefix="rfq-analysis")
+        # 草稿輸出另用單一執行緒 (Outlook COM 需固定在同一執行緒)，不與解析搶佇列
+        self.draft_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rfq-drafts-batch")
+        self.job_counter = 0
+
         # 修改: 橫向滿版 (width=float("inf"))
         self.input_text = ft.TextField(
             multiline=True, 
@@ -308,6 +561,7 @@ class RFQAnalyzer(ft.Column):
             width=float("inf") # 強制水平滿版
         )
         self.analyze_btn = ft.Button("開始解析", icon=ft.Icons.ANALYTICS, on_click=self.run_analysis)
+        self.jobs_container = ft.Column(spacing=2)
         self.results_container = ft.Column()
 
         self.controls = [
@@ -316,188 +570,268 @@ class RFQAnalyzer(ft.Column):
             ft.Divider(height=10, thickness=1),
             self.input_text,
             ft.Row([self.analyze_btn], alignment=ft.MainAxisAlignment.END),
+            self.jobs_container,
             ft.Divider(),
             ft.Text("解析結果與匹配 (材質分組)", size=20, weight=ft.FontWeight.BOLD),
             self.results_container
         ]
 
+    def _notify(self, message):
+        self.main_page.snack_bar = ft.SnackBar(ft.Text(message))
+        self.main_page.snack_bar.open = True
+
     def run_analysis(self, e):
-        self.analyze_btn.disabled = True
-        self.analyze_btn.text = "解析中..."
+        """將目前輸入的 RFQ 排入背景佇列，可連續排入多筆"""
+        text = self.input_text.value or ""
+        if not text.strip():
+            return
+        self.job_counter += 1
+        job = AnalysisJob(self.job_counter, text, self.cancel_job)
+        self.jobs_container.controls.append(job.row)
+        self.results_container.controls.insert(0, job.section)
+        self.input_text.value = ""
         self.main_page.update()
+        self.executor.submit(self._run_job, job)
+
+    def cancel_job(self, job):
+        job.cancel_event.set()
+        job.status_text.value = "取消中..."
+        job.cancel_btn.disabled = True
+        self.main_page.update()
+
+    def _set_job_status(self, job, message):
+        job.status_text.value = message
+        self.main_page.update()
+
+    def _add_streamed_item(self, job, item):
+        """串流回呼 (工作執行緒)：將 item 加入所屬材質群組卡片，群組不存在時建立"""
+        mat_type = item.get("material_type", "Other")
+        card = job.cards.get(mat_type)
+        if card is None:
+            card = MaterialGroupCard(mat_type, self.generate_batch_drafts)
+            job.cards[mat_type] = card
+            job.section.controls.append(card.card)
+        card.add_item(item)
+        job.streamed.append(item)
+        job.section.visible = True
+        job.status_text.value = f"解析中... 已取得 {len(job.streamed)} 項"
+        self.main_page.update()
+
+    def _run_job(self, job):
+        """於工作執行緒執行：串流解析並即時加入群組卡片 → 以最終結果補齊 → 單一交易寫入"""
         try:
-            analysis_result = analyzer.analyze_rfq(self.input_text.value)
+            if job.cancel_event.is_set():
+                job.status_text.value = "已取消"
+                return
+            job.progress_ring.visible = True
+            self._set_job_status(job, "解析中...")
+
+            analysis_result = analyzer.analyze_rfq(
+                job.text,
+                on_progress=lambda m: self._set_job_status(job, m),
+                cancel_event=job.cancel_event,
+                on_item=lambda item: self._add_streamed_item(job, item)
+            )
+            if analysis_result.get("cancelled") or job.cancel_event.is_set():
+                job.status_text.value = "已取消"
+                return
             all_items = analysis_result.get("items", [])
-            req_id = database.save_rfq_request(self.input_text.value, json.dumps(all_items))
-            self.results_container.controls = []
-            
-            grouped_items = {}
-            for item in all_items:
-                mat_type = item.get("material_type", "Other")
-                if mat_type not in grouped_items: grouped_items[mat_type] = []
-                grouped_items[mat_type].append(item)
-            
-            if not grouped_items:
-                 self.main_page.snack_bar = ft.SnackBar(ft.Text("未能解析出項目"))
-                 self.main_page.snack_bar.open = True
-                 return
+
+            # 最終結果為準：補上快取命中 / 修復後才通過的 items；若已顯示的 item 不在結果中則整段重建
+            remaining = list(all_items)
+            for item in job.streamed:
+                if item not in remaining:
+                    del job.section.controls[1:]
+                    job.cards.clear()
+                    job.streamed.clear()
+                    remaining = list(all_items)
+                    break
+                remaining.remove(item)
+            for item in remaining:
+                self._add_streamed_item(job, item)
+
+            database.save_rfq_analysis(
+                job.text,
+                all_items,
+                [[s[0] for s in job.cards[item.get("material_type", "Other")].matched_suppliers] for item in all_items]
+            )
             
-            for mat_type, group_items_list in grouped_items.items():
-                # 認證類別篩選邏輯
-                req_qual = "ISO"
-                for it in group_items_list:
-                    q = it.get("qualification", "ISO")
-                    if q == "Aerospace": 
-                        req_qual = "Aerospace"
-                    elif q == "Automotive" and req_qual == "ISO": 
-                        req_qual = "Automotive"
-
-                initial_suppliers = database.search_suppliers([mat_type], [])
-                
-                matched_suppliers = []
-                for s in initial_suppliers:
-                    s_quals = from_json_str(s[8])
-                    if req_qual in s_quals:
-                        matched_suppliers.append(s)
-
-                supplier_options = [ft.dropdown.Option(str(s[0]), f"{s[1]} ({s[2]})") for s in matched_suppliers]
-                
-                ui_rows_data = [] 
-                data_rows = []
-                for idx, item in enumerate(group_items_list):
-                    database.save_rfq_item(req_id, idx, mat_type, item.get("form", "Other"), json.dumps(item), [s[0] for s in matched_suppliers])
-                    
-                    txt_spec = ft.TextField(value=item.get("material_spec", "-"), border=ft.InputBorder.UNDERLINE, dense=True, text_size=13, expand=True)
-                    txt_form = ft.TextField(value=item.get("form", "-"), border=ft.InputBorder.UNDERLINE, dense=True, text_size=13, width=80)
-                    txt_dims = ft.TextField(value=item.get("dimensions", "-"), border=ft.InputBorder.UNDERLINE, dense=True, text_size=13, expand=True)
-                    txt_qty = ft.TextField(value=item.get("quantity", "-"), border=ft.InputBorder.UNDERLINE, dense=True, text_size=13, width=80)
-                    txt_notes = ft.TextField(value=item.get("notes", "-"), border=ft.InputBorder.UNDERLINE, dense=True, text_size=13, expand=True)
-                    txt_moq = ft.TextField(value="", border=ft.InputBorder.UNDERLINE, dense=True, text_size=13, width=80, hint_text="if need")
-                    
-                    ui_rows_data.append({
-                        "mat_type": mat_type, 
-                        "spec": txt_spec, 
-                        "form": txt_form, 
-                        "dimensions": txt_dims, 
-                        "quantity": txt_qty, 
-                        "moq": txt_moq, 
-                        "notes": txt_notes,
-                        "qual": item.get("qualification", "ISO")
-                    })
-                    
-                    qual_display = item.get("qualification", "ISO")
-                    mat_display = ft.Column([
-                        ft.Text(str(idx + 1)),
-                        ft.Container(
-                            content=ft.Text(qual_display, size=10, color=ft.Colors.WHITE),
-                            bgcolor=ft.Colors.BLUE_GREY if qual_display=="ISO" else (ft.Colors.ORANGE if qual_display=="Automotive" else ft.Colors.RED),
-                            padding=2, border_radius=3
-                        )
-                    ], spacing=2)
-
-                    data_rows.append(ft.DataRow(cells=[
-                        ft.DataCell(mat_display),
-                        ft.DataCell(txt_spec), 
-                        ft.DataCell(txt_form), 
-                        ft.DataCell(txt_dims), 
-                        ft.DataCell(txt_qty), 
-                        ft.DataCell(ft.Text("(Vendor)")), 
-                        ft.DataCell(txt_moq), 
-                        ft.DataCell(txt_notes)
-                    ]))
-                
-                items_table = ft.DataTable(
-                    columns=[
-                        ft.DataColumn(ft.Text("#/Qual")), 
-                        ft.DataColumn(ft.Text("Spec")), 
-                        ft.DataColumn(ft.Text("Form")), 
-                        ft.DataColumn(ft.Text("Dimensions")), 
-                        ft.DataColumn(ft.Text("Qty")), 
-                        ft.DataColumn(ft.Text("Price")), 
-                        ft.DataColumn(ft.Text("MOQ")), 
-                        ft.DataColumn(ft.Text("Notes"))
-                    ], 
-                    rows=data_rows, 
-                    border=ft.border.all(1, ft.Colors.GREY_300)
-                )
-                
-                supp_dds = [ft.Dropdown(label=f"供應商 {i+1} ({req_qual})", options=supplier_options, width=200, dense=True) for i in range(4)]
-
-                # 新增：群組專用的備註輸入框
-                txt_group_anno = ft.TextField(label="詢價備註 (將顯示於 Email Preamble 下方)", multiline=True, min_lines=2, text_size=13)
-
-                # 修改：將 txt_group_anno 傳入 generate_batch_drafts
-                batch_draft_btn = ft.Button(
-                    "生成草稿 (批次)",
-                    icon=ft.Icons.EMAIL,
-                    on_click=lambda e, rows=ui_rows_data, mt=mat_type, dds=supp_dds, anno=txt_group_anno: self.generate_batch_drafts(rows, dds, mt, anno.value)
-                )
-                
-                card = ft.Card(content=ft.Container(padding=20, content=ft.Column([
-                    ft.Row([
-                        ft.Icon(ft.Icons.CATEGORY, color=ft.Colors.BLUE), 
-                        ft.Text(f"材質群組: {mat_type}", size=20, weight=ft.FontWeight.BOLD),
-                        ft.Container(content=ft.Text(f"需求認證: {req_qual}", color=ft.Colors.WHITE), bgcolor=ft.Colors.BLUE, padding=5, border_radius=5)
-                    ]), 
-                    ft.Divider(), 
-                    ft.Row([items_table], expand=True, scroll=ft.ScrollMode.AUTO), 
-                    ft.Divider(), 
-                    txt_group_anno,
-                    ft.Text(f"選擇詢價對象 (已篩選 {req_qual} 認證, 最多 4 家):", weight=ft.FontWeight.BOLD), 
-                    ft.Row(supp_dds, wrap=True), 
-                    ft.Row([batch_draft_btn], alignment=ft.MainAxisAlignment.END)
-                ])))
-                self.results_container.controls.append(card)
+            if not all_items:
+                job.status_text.value = "未能解析出項目"
+                self._notify(f"RFQ #{job.job_no}: 未能解析出項目")
+            else:
+                job.status_text.value = f"完成 ({len(all_items)} 項)"
         except Exception as ex:
-            self.main_page.snack_bar = ft.SnackBar(ft.Text(f"發生錯誤: {str(ex)}"))
-            self.main_page.snack_bar.open = True
+            job.status_text.value = f"發生錯誤: {str(ex)}"
+            self._notify(f"RFQ #{job.job_no} 發生錯誤: {str(ex)}")
         finally:
-            self.reset_btn()
+            job.progress_ring.visible = False
+            job.cancel_btn.disabled = True
             self.main_page.update()
 
-    def reset_btn(self):
-        self.analyze_btn.disabled = False
-        self.analyze_btn.text = "開始解析"
-
     def generate_batch_drafts(self, ui_rows, dropdowns, material_type_group, group_annotation):
-        selected_ids = [dd.value for dd in dropdowns if dd.value]
+        selected_ids = list(dict.fromkeys(int(dd.value) for dd in dropdowns if dd.value))
         if not selected_ids:
             self.main_page.snack_bar = ft.SnackBar(ft.Text("請至少選擇 1 家供應商"))
             self.main_page.snack_bar.open = True
             return
-        suppliers_db = database.get_suppliers()
-        templates = database.get_templates()
-        template = templates[0] if templates else (0, "Default", "Inquiry {date}", "<p>Hi,</p>", "<p>Thanks</p>", "", "", "", "", "", "", "", 0)
-        tmpl_cc = template[11] if len(template) > 11 else ""
-        use_default_subj = template[12] if len(template) > 12 else 0
-        
-        current_items_data = [{"material_type": r["mat_type"], "material_spec": r["spec"].value, "form": r["form"].value, "dimensions": r["dimensions"].value, "quantity": r["quantity"].value, "moq": r["moq"].value, "notes": r["notes"].value, "qual": r["qual"]} for r in ui_rows]
-        
-        extra_anno_html = f"<div style='margin-bottom: 10px;'>{group_annotation}</div>" if group_annotation else ""
+        # 在 UI 執行緒先讀出欄位值，組信 / 寫檔交給背景執行緒
+        items = [{"material_type": r["mat_type"], "material_spec": r["spec"].value, "form": r["form"].value, "dimensions": r["dimensions"].value, "quantity": r["quantity"].value, "moq": r["moq"].value, "notes": r["notes"].value, "qual": r["qual"]} for r in ui_rows]
+        self._notify(f"草稿產生中 ({len(selected_ids)} 封)...")
+        self.main_page.update()
+        self.draft_executor.submit(self._write_drafts, selected_ids, items, material_type_group, group_annotation)
 
-        table_rows_html = "".join([f"<tr><td style='border: 1px solid #333; padding: 10px;'>{item['material_type']}<br>({item['qual']})</td><td style='border: 1px solid #333; padding: 10px;'>{item['material_spec']}</td><td style='border: 1px solid #333; padding: 10px;'>{item['form']}</td><td style='border: 1px solid #333; padding: 10px;'>{item['dimensions']}</td><td style='border: 1px solid #333; padding: 10px;'>{item['quantity']}</td><td style='border: 1px solid #333; padding: 10px;'></td><td style='border: 1px solid #333; padding: 10px;'>{item['moq']}</td><td style='border: 1px solid #333; padding: 10px;'>{item['notes']}</td></tr>" for item in current_items_data])
-        full_table_html = f"<table style='border-collapse: collapse; width: 100%; font-family: Arial, sans-serif; font-size: 13px;'><thead><tr><th style='border: 1px solid #333; padding: 10px; background-color: #eee;'>Material</th><th style='border: 1px solid #333; padding: 10px; background-color: #eee;'>Spec</th><th style='border: 1px solid #333; padding: 10px; background-color: #eee;'>Form</th><th style='border: 1px solid #333; padding: 10px; background-color: #eee;'>Dimensions</th><th style='border: 1px solid #333; padding: 10px; background-color: #eee;'>Quantity</th><th style='border: 1px solid #333; padding: 10px; background-color: #eee;'>Price</th><th style='border: 1px solid #333; padding: 10px; background-color: #eee;'>MOQ</th><th style='border: 1px solid #333; padding: 10px; background-color: #eee;'>Notes</th></tr></thead><tbody>{table_rows_html}</tbody></table>"
+    def _write_drafts(self, selected_ids, items, material_type_group, group_annotation):
         try:
-            if os.name == 'nt':
-                import win32com.client
-                outlook = win32com.client.Dispatch('Outlook.Application')
-                for supp_id in list(set(selected_ids)):
-                    supplier = next((s for s in suppliers_db if str(s[0]) == str(supp_id)), None)
-                    if not supplier: continue
-                    if use_default_subj: subject = f"RFQ{datetime.now().strftime('%y%m%d%H')}_{material_type_group}_{supplier[1]}"
-                    else: subject = (template[2] or "Inquiry").format(date=datetime.now().strftime("%Y%m%d")) + f"_{supplier[1]}"
-                    mail = outlook.CreateItem(0)
-                    mail.Subject, mail.To, mail.CC = subject, supplier[3], tmpl_cc
-                    mail.HTMLBody = f"<div>{template[3]}</div>{extra_anno_html}<br>{full_table_html}<br><div>{template[4]}</div>"
-                    mail.Save()
-                self.main_page.snack_bar = ft.SnackBar(ft.Text(f"成功建立 {len(selected_ids)} 封草稿"))
-            else: self.main_page.snack_bar = ft.SnackBar(ft.Text("非 Windows 環境: 模擬成功"))
-            self.main_page.snack_bar.open = True
+            templates = database.get_templates()
+            template = templates[0] if templates else drafts.DEFAULT_TEMPLATE
+            suppliers = database.get_suppliers_by_ids(selected_ids)
+            batch = drafts.build_drafts(template, suppliers, items, material_type_group, group_annotation)
+
+            sink = drafts.default_sink()
+            try:
+                written, failed = drafts.write_drafts(batch, sink)
+            finally:
+                sink.close()
+            target = f" → {os.path.abspath(sink.directory)}" if isinstance(sink, drafts.EmlSink) else ""
+            message = f"成功建立 {len(written)} 封草稿{target}"
+            if failed:
+                message += f"，{len(failed)} 封失敗: {failed[0][1]}"
+            self._notify(message)
         except Exception as ex:
-            self.main_page.snack_bar = ft.SnackBar(ft.Text(f"錯誤: {str(ex)}"))
-            self.main_page.snack_bar.open = True
+            self._notify(f"錯誤: {str(ex)}")
         self.main_page.update()
 
+# --- 詢價紀錄 ---
+class RFQHistory(ft.Column):
+    """歷史詢價瀏覽：keyset 分頁 (由新到舊, 捲動載入更多)，品項於展開時才查詢"""
+    def __init__(self, page: ft.Page, lang="zh"):
+        super().__init__(expand=True, scroll=ft.ScrollMode.AUTO)
+        self.main_page = page
+        self.opt_trans = OPTION_TRANSLATIONS.get(lang, {})
+        self.loaded = False
+        self.last_id = None
+        self.has_next = False
+        self.search_query = ""
+        self.items_loaded = set()
+
+        self.date_from = ft.TextField(label="起日 (YYYY-MM-DD)", dense=True, width=170, on_submit=self.apply_filters)
+        self.date_to = ft.TextField(label="迄日 (YYYY-MM-DD)", dense=True, width=170, on_submit=self.apply_filters)
+        self.status_dd = ft.Dropdown(label="狀態", dense=True, width=150, options=[])
+        self.material_dd = ft.Dropdown(
+            label="材料", dense=True, width=180,
+            options=[ft.dropdown.Option("", "全部")] + [ft.dropdown.Option(m, self.opt_trans.get(m, m)) for m in OPTIONS["material_types"]]
+        )
+        self.search_box = ft.TextField(
+            hint_text="全文搜尋 RFQ 原文 / 品項",
+            prefix_icon=ft.Icons.SEARCH,
+            dense=True,
+            width=280,
+            on_submit=self.apply_filters,
+            on_change=lambda e: self.apply_filters(e) if not e.control.value else None
+        )
+        self.list_view = ft.Column(spacing=4)
+        self.info = ft.Text("", size=12)
+        self.more_btn = ft.TextButton("載入更多", icon=ft.Icons.EXPAND_MORE, on_click=lambda e: self.load_page(), visible=False)
+
+        self.controls = [
+            ft.Row([ft.Text("詢價紀錄", size=30), self.search_box], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
+            ft.Row([self.date_from, self.date_to, self.status_dd, self.material_dd,
+                    ft.Button("篩選", icon=ft.Icons.FILTER_ALT, on_click=self.apply_filters)], wrap=True),
+            ft.Divider(),
+            self.list_view,
+            ft.Row([self.more_btn, self.info], alignment=ft.MainAxisAlignment.CENTER),
+        ]
+
+    def _safe_update(self):
+        try:
+            self.update()
+        except Exception:
+            pass
+
+    def _filters(self):
+        return {
+            "status": self.status_dd.value or None,
+            "material_type": self.material_dd.value or None,
+            "date_from": (self.date_from.value or "").strip() or None,
+            "date_to": (self.date_to.value or "").strip() or None,
+        }
+
+    def load_data(self, force=False):
+        """第一次進入頁面時載入第一頁；之後切換頁面保留已載入的清單"""
+        if self.loaded and not force:
+            return
+        self.status_dd.options = [ft.dropdown.Option("", "全部")] + [ft.dropdown.Option(s) for s in database.get_rfq_statuses()]
+        self.list_view.controls = []
+        self.items_loaded = set()
+        self.last_id = None
+        self.loaded = True
+        self.load_page()
+
+    def apply_filters(self, e):
+        self.search_query = (self.search_box.value or "").strip()
+        self.load_data(force=True)
+
+    def load_page(self):
+        if self.search_query:
+            rows = database.search_rfq_history(self.search_query)
+            self.has_next = False
+        else:
+            page_size = database.RFQ_HISTORY_PAGE_SIZE
+            rows = database.get_rfq_history_page(before_id=self.last_id, limit=page_size + 1, **self._filters())
+            self.has_next = len(rows) > page_size
+            rows = rows[:page_size]
+        if rows:
+            self.last_id = rows[-1][0]
+        self.list_view.controls.extend(self._build_tile(r) for r in rows)
+
+        shown = len(self.list_view.controls)
+        self.info.value = f"搜尋「{self.search_query}」: {shown} 筆 (依相關度)" if self.search_query else f"已顯示 {shown} 筆"
+        self.more_btn.visible = self.has_next
+        self._safe_update()
+
+    def _build_tile(self, row):
+        req_id, created_at, status, preview = row[:4]
+        count = f" · {row[4]} 項" if len(row) > 4 else ""
+        first_line = (preview or "").strip().splitlines()[0] if (preview or "").strip() else "(空白)"
+        return ft.ExpansionTile(
+            title=ft.Text(f"#{req_id}  {first_line}", max_lines=1),
+            subtitle=ft.Text(f"{created_at} · {status}{count}", size=12),
+            controls=[],
+            data=req_id,
+            on_change=self._on_expand,
+        )
+
+    def _on_expand(self, e):
+        tile = e.control
+        if tile.data in self.items_loaded:
+            return
+        self.items_loaded.add(tile.data)
+        tile.controls = [self._build_items_table(database.get_rfq_items(tile.data))]
+        tile.update()
+
+    def _build_items_table(self, items):
+        if not items:
+            return ft.Text("無品項", italic=True)
+        rows = []
+        for _, idx, material_type, form_type, spec, matched, status in items:
+            data = from_json_str(spec)
+            data = data if isinstance(data, dict) else {}
+            rows.append(ft.DataRow(cells=[
+                ft.DataCell(ft.Text(str(idx + 1))),
+                ft.DataCell(ft.Text(self.opt_trans.get(material_type, material_type))),
+                ft.DataCell(ft.Text(data.get("material_spec", ""))),
+                ft.DataCell(ft.Text(self.opt_trans.get(form_type, form_type))),
+                ft.DataCell(ft.Text(data.get("dimensions", ""))),
+                ft.DataCell(ft.Text(data.get("quantity", ""))),
+                ft.DataCell(ft.Text(str(len(from_json_str(matched))))),
+                ft.DataCell(ft.Text(status or "")),
+            ]))
+        return ft.DataTable(
+            columns=[ft.DataColumn(ft.Text(h)) for h in ["#", "材料", "規格", "形狀", "尺寸", "數量", "供應商數", "狀態"]],
+            rows=rows,
+        )
+
 # --- 主程式 ---
 def main(page: ft.Page):
     database.init_db()
@@ -509,6 +843,7 @@ def main(page: ft.Page):
     supplier_manager = SupplierManager(page, current_lang)
     rfq_analyzer = RFQAnalyzer(page, current_lang)
     template_manager = TemplateManager(page)
+    rfq_history = RFQHistory(page, current_lang)
     
     # 修改: 減少 Top Padding (從 20 改為 10)，讓 Header 區域更緊湊
     content_area = ft.Container(content=supplier_manager, expand=True, padding=ft.padding.only(left=20, top=10, right=20, bottom=20))
@@ -522,6 +857,9 @@ def main(page: ft.Page):
         elif index == 1:
             content_area.content = rfq_analyzer
         elif index == 2:
+            content_area.content = rfq_history
+            rfq_history.load_data()
+        elif index == 3:
             content_area.content = template_manager
             template_manager.load_data()            
         page.update()
@@ -531,6 +869,7 @@ def main(page: ft.Page):
         destinations=[
             ft.NavigationRailDestination(icon=ft.Icons.PERSON_OUTLINE, selected_icon=ft.Icons.PERSON, label="供應商管理"),
             ft.NavigationRailDestination(icon=ft.Icons.ANALYTICS_OUTLINED, selected_icon=ft.Icons.ANALYTICS, label="詢價解析"),
+            ft.NavigationRailDestination(icon=ft.Icons.HISTORY, selected_icon=ft.Icons.HISTORY, label="詢價紀錄"),
             ft.NavigationRailDestination(icon=ft.Icons.SETTINGS_OUTLINED, selected_icon=ft.Icons.SETTINGS, label="樣板設定"),
         ],
         on_change=on_nav_change,
@@ -1,11 +1,17 @@
 import os
-import time
+import sys
 import logging
 import json
 import sqlite3
-import requests
 from dotenv import load_dotenv
 
+# 本子專案以 procurement_agent/ 為工作目錄執行，需將專案根目錄加入路徑以使用共用的 LLM gateway。
+# 放在路徑最後：本目錄的 database.py 必須優先於根目錄的 database.py
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _REPO_ROOT not in sys.path:
+    sys.path.append(_REPO_ROOT)
+from core.llm_gateway import gateway, LLMGatewayError
+
 # Try to import from database.py if available, else hardcode for safety
 try:
     from database import DB_NAME
@@ -59,11 +65,7 @@ def _execute_sql(query: str) -> str:
             conn.close()
 
 def _call_gemini_rest_with_retry(prompt: str, retries: int = 3, system_instruction: str = None) -> str:
-    """Calls Gemini REST API with strict 3-retry fallback and physical rate-limiting."""
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent?key={API_KEY}"
-
-    headers = {"Content-Type": "application/json"}
-
+    """Calls Gemini REST API through the shared gateway (pooled session, Retry-After aware backoff)."""
     payload = {
         "contents": [{"parts": [{"text": prompt}]}]
     }
@@ -73,33 +75,21 @@ def _call_gemini_rest_with_retry(prompt: str, retries: int = 3, system_instructi
             "parts": [{"text": system_instruction}]
         }
 
-    for attempt in range(1, retries + 1):
-        try:
-            logging.info(f"Calling Gemini REST API (Attempt {attempt}/{retries})")
-            response = requests.post(url, headers=headers, json=payload, timeout=15)
-            response.raise_for_status()
-
-            data = response.json()
-            if "candidates" in data and data["candidates"]:
-                text = data["candidates"][0]["content"]["parts"][0]["text"]
-                return text
-            else:
-                logging.error(f"Unexpected response format: {data}")
-                raise Exception("Unexpected Gemini API response format")
-
-        except requests.exceptions.RequestException as e:
-            logging.error(f"Gemini API network error on attempt {attempt}: {e}", exc_info=True)
-        except Exception as e:
-            logging.error(f"Gemini API general error on attempt {attempt}: {e}", exc_info=True)
-
-        if attempt == retries:
-            logging.error("Max retries reached. Returning error message.")
-            return "抱歉，系統目前無法連線到 AI 引擎，請稍後再試。"
-
-        # Rate limiting / Backoff
-        time.sleep(2 ** attempt)
-
-    return "發生未知錯誤。"
+    try:
+        logging.info("Calling Gemini REST API")
+        response = gateway.call(
+            "procurement_agent",
+            "gemini_rest",
+            {"model": "gemini-2.5-flash", "api_key": API_KEY, "payload": payload},
+            max_retries=retries - 1
+        )
+        return response.text
+    except LLMGatewayError as e:
+        logging.error(f"Max retries reached. Returning error message. ({e})")
+    except Exception as e:
+        logging.error(f"Gemini API general error: {e}", exc_info=True)
+
+    return "抱歉，系統目前無法連線到 AI 引擎，請稍後再試。"
 
 def ask_procurement_agent(user_query: str) -> str:
     """
@@ -0,0 +1,240 @@
+# rfq_rules.py
+# 規則優先解析器：將 analyzer.py prompt 中的 FORM LOGIC / 認證判斷寫成程式碼。
+# 常見格式 (Ø50 x 1000、316L、10 pcs、OD/ID、t=5) 直接在本機解析，
+# 只有無法確定的行才交給 LLM。輸出的 item 皆符合 RFQ_SCHEMA。
+
+import re
+
+# 規則有變動時 +1 (會一併使解析快取失效)
+RULES_VERSION = 2
+
+_NUM = r"\d+(?:\.\d+)?"
+_MM = r"(?:\s*mm)?"
+_SEP = r"\s*[x×X*＊]\s*"
+_LEN = rf"(?:{_SEP}(?:L\s*=?\s*)?{_NUM}{_MM}(?:\s*L\b)?|\s*[,，]?\s*L\s*=\s*{_NUM}{_MM})"
+
+# --- 尺寸規則 (依序比對，先中先贏) ---
+_TUBE_DIMS = re.compile(
+    rf"\bOD\s*/\s*ID\s*{_NUM}\s*/\s*{_NUM}{_MM}{_LEN}?"
+    rf"|\bOD\s*=?\s*{_NUM}{_MM}\s*[x×X*/,]?\s*\bID\s*=?\s*{_NUM}{_MM}{_LEN}?",
+    re.IGNORECASE
+)
+_BOX_DIMS = re.compile(rf"(?<![\d.])(?:t\s*=?\s*)?({_NUM}){_MM}{_SEP}(?:t\s*=?\s*)?({_NUM}){_MM}{_SEP}(?:t\s*=?\s*)?({_NUM}){_MM}", re.IGNORECASE)
+_THICKNESS = re.compile(rf"\bt\s*=?\s*({_NUM}){_MM}", re.IGNORECASE)
+_PLANAR_DIMS = re.compile(rf"(?<![\d.])({_NUM}){_MM}{_SEP}({_NUM}){_MM}")
+_ROUND_DIMS = re.compile(rf"(?:[ØøΦφ⌀]|\bdia\.?|\bD(?=\s*=?\s*\d))\s*=?\s*{_NUM}{_MM}{_LEN}?", re.IGNORECASE)
+
+# --- 數量規則 ---
+_UNIT_ALIASES = {
+    "pcs": "pcs", "pc": "pcs", "piece": "pcs", "pieces": "pcs", "ea": "pcs",
+    "支": "pcs", "根": "pcs", "件": "pcs", "個": "pcs", "片": "pcs", "塊": "pcs", "pce": "pcs",
+    "set": "sets", "sets": "sets", "組": "sets", "套": "sets",
+    "kg": "kg", "kgs": "kg", "公斤": "kg",
+    "m": "m", "meter": "m", "meters": "m", "米": "m", "公尺": "m",
+}
+_QTY = re.compile(
+    r"(?<![\w.])(\d[\d,]*(?:\.\d+)?)\s*(" + "|".join(sorted(map(re.escape, _UNIT_ALIASES), key=len, reverse=True)) + r")(?![A-Za-z])",
+    re.IGNORECASE
+)
+_QTY_LABEL = re.compile(r"(?:\bqty|\bquantity|數量|需求量)\s*[:：=]?\s*(\d[\d,]*)(?![\d.])", re.IGNORECASE)
+
+# --- 材質等級字典 (material_type -> regex)；純數字牌號需前後不接 / - . 以避免誤判日期或尺寸 ---
+def _numeric(grades):
+    return r"(?<![\w./\-])(?:" + "|".join(grades) + r")(?![\w/]|[.\-]\d)"
+
+_GRADE_RULES = [
+    ("Nickel Alloy", r"\b(?:inconel|incoloy|hastelloy|monel)(?:\s*-?\s*[A-Z]?\d+)?\b|\balloy\s*(?:600|625|718|800|825|C-?276)\b|\bN0\d{4}\b|鎳基?合金"),
+    ("Titanium Alloy", r"\bTi-?6Al-?4V(?:\s*ELI)?\b|\bTC4\b|\b(?:Ti|titanium)\s*(?:Gr\.?|grade)\s*\d+\b|鈦合金|純鈦|\btitanium\b"),
+    ("Tool Steel", r"\b(?:SK[DHS]\s*-?\s*\d+|DC53|NAK80|P20|H13|1\.23(?:44|79))\b|工具鋼|模具鋼|\btool steel\b"),
+    ("Carbon Steel", r"\b(?:S\d{2}C|SS400|SPCC|SPHC|SAPH\d+|Q235[A-D]?|Q345|A36|C45|CK45|12L14|SCM\s*-?\s*4[1-4]\d)\b|"
+                     + _numeric([r"10(?:1[08]|2\d|3[05]|4[05]|95)", r"41[34]0", r"4340"])
+                     + r"|碳鋼|\bcarbon steel\b|\bmild steel\b"),
+    ("Stainless Steel", r"\b(?:SUS|AISI)\s*-?\s*\d{3}[A-Z]{0,2}\b|\b1[57]-[47]\s*PH\b|"
+                        + _numeric([r"30[34]L?", r"310S", r"316(?:L|Ti)?", r"321", r"347", r"41[06]", r"420", r"430", r"440C", r"2205", r"2507"])
+                        + r"|不[鏽銹锈]鋼|白鐵|\bstainless\b"),
+    ("Aluminum", r"\b(?:A|AL|AA)-?(?:[1-7]\d{3})(?:-T\d+)?\b|"
+                 + _numeric([r"1050", r"1060", r"1100", r"2011", r"2017", r"2024", r"3003", r"5052", r"5083", r"6061", r"6063", r"6082", r"7050", r"7075"])
+                 + r"(?:-T\d+)?|鋁|\balumin(?:i)?um\b"),
+    ("Copper", r"\bC(?:1020|1100|1220|2600|2680|2801|3604|5191|5210|17200)\b|\b(?:brass|bronze|copper)\b|銅"),
+    ("Plastic", r"\b(?:POM|PEEK|PTFE|PA66?|nylon|ABS|PVC|HDPE|UHMW(?:-?PE)?|PEI|PPS|acetal|delrin|teflon)\b|塑膠|塑料|鐵氟龍"),
+]
+_GRADES = [(material_type, re.compile(pattern, re.IGNORECASE)) for material_type, pattern in _GRADE_RULES]
+# 只表示材質大類的字詞；同一行另有具體牌號 (SUS304、6061) 時以牌號為 material_spec
+_GENERIC_MATERIAL = re.compile(
+    r"^(?:不[鏽銹锈]鋼|白鐵|stainless|鋁|alumin(?:i)?um|銅|copper|brass|bronze|碳鋼|carbon steel|mild steel|"
+    r"工具鋼|模具鋼|tool steel|鈦合金|純鈦|titanium|鎳基?合金|塑膠|塑料)$",
+    re.IGNORECASE
+)
+
+# --- 形狀關鍵字 ---
+_FORM_KEYWORDS = [
+    ("Forging", re.compile(r"\bforg(?:ing|ed)\b|鍛", re.IGNORECASE)),
+    ("Stamping", re.compile(r"\bstamp(?:ing|ed)\b|沖壓", re.IGNORECASE)),
+    ("Tube", re.compile(r"\btube\b|\bpipe\b|管", re.IGNORECASE)),
+    ("Plate", re.compile(r"\bblock\b|\bcuboid\b|方塊|塊材", re.IGNORECASE)),
+    ("Bar", re.compile(r"\bbar\b|\brod\b|\bround\b|棒", re.IGNORECASE)),
+    ("Sheet", re.compile(r"\bsheet\b|薄板", re.IGNORECASE)),
+    ("Plate", re.compile(r"\bplate\b|厚板|板", re.IGNORECASE)),
+]
+
+# --- 認證等級 (與 prompt 規則一致) ---
+_AEROSPACE = re.compile(r"航太|航空|aerospace|AS\s*9100|NADCAP", re.IGNORECASE)
+_AUTOMOTIVE = re.compile(r"汽車|車用|IATF", re.IGNORECASE)
+
+_BULLET = re.compile(r"^\s*(?:[-•*·]|\(?\d{1,3}[.)、]|No\.\s*\d+[.:]?)\s*")
+_NOTE_TRIM = re.compile(r"^[\s,;:：，、/|\-]+|[\s,;:：，、/|\-]+$")
+
+
+def detect_qualification(text):
+    if _AEROSPACE.search(text):
+        return "Aerospace"
+    if _AUTOMOTIVE.search(text):
+        return "Automotive"
+    return "ISO"
+
+
+def _find_dimensions(line):
+    """回傳 (原始尺寸字串, 形狀, span)；找不到則 None"""
+    m = _TUBE_DIMS.search(line)
+    if m:
+        return m.group(0).strip(), "Tube", m.span()
+    m = _BOX_DIMS.search(line)
+    if m:
+        smallest = min(float(v) for v in m.groups())
+        return m.group(0).strip(), "Sheet" if smallest < 10 else "Plate", m.span()
+    t = _THICKNESS.search(line)
+    if t:
+        spans = [t.span()]
+        planar = _PLANAR_DIMS.search(line)
+        if planar:
+            spans.append(planar.span())
+        start, end = min(s for s, _ in spans), max(e for _, e in spans)
+        form = "Sheet" if float(t.group(1)) < 10 else "Plate"
+        return line[start:end].strip(), form, (start, end)
+    m = _ROUND_DIMS.search(line)
+    if m:
+        return m.group(0).strip(), "Bar", m.span()
+    return None
+
+
+def _find_quantity(line):
+    """回傳 ('10 pcs', span)；找不到則 None"""
+    m = _QTY.search(line)
+    if m:
+        return f"{m.group(1)} {_UNIT_ALIASES[m.group(2).lower()]}", m.span()
+    m = _QTY_LABEL.search(line)
+    if m:
+        return f"{m.group(1)} pcs", m.span()
+    return None
+
+
+def _find_materials(line):
+    """回傳 [(material_type, 原始牌號字串, span)]，依出現位置排序"""
+    found = []
+    for material_type, regex in _GRADES:
+        for m in regex.finditer(line):
+            if any(s < m.end() and m.start() < e for _, _, (s, e) in found):
+                continue
+            found.append((material_type, m.group(0).strip(), m.span()))
+    return sorted(found, key=lambda f: f[2][0])
+
+
+def _pick_material(materials):
+    """同一材質大類的多個比對中取最具體的一個：牌號優先於大類字詞，其次依出現位置"""
+    return min(materials, key=lambda m: (bool(_GENERIC_MATERIAL.match(m[1])), m[2][0]))
+
+
+def _blank(line, span):
+    start, end = span
+    return line[:start] + " " * (end - start) + line[end:]
+
+
+def parse_line(line, context_material=None, qualification="ISO"):
+    """
+    解析單行。回傳 (item 或 None, 本行的材質資訊 或 None)。
+    只有材質、形狀、尺寸、數量都能確定時才回傳 item。
+    """
+    rest = line
+    dims = _find_dimensions(rest)
+    if dims:
+        rest = _blank(rest, dims[2])
+    qty = _find_quantity(rest)
+    if qty:
+        rest = _blank(rest, qty[1])
+    materials = _find_materials(rest)
+
+    line_material = None
+    if materials:
+        if len({m[0] for m in materials}) > 1:
+            return None, None
+        chosen = _pick_material(materials)
+        line_material = (chosen[0], chosen[1])
+        # 只移除選用的牌號與大類字詞；其他牌號 (如「SUS304 / SUS316L」的第二個) 保留在 notes
+        for m in materials:
+            if m is chosen or _GENERIC_MATERIAL.match(m[1]):
+                rest = _blank(rest, m[2])
+
+    form = None
+    for form_type, regex in _FORM_KEYWORDS:
+        if regex.search(line):
+            form = form_type
+            break
+    if dims:
+        # 尺寸推導優先；Tube/Forging/Stamping 關鍵字可覆寫
+        if form not in ("Tube", "Forging", "Stamping"):
+            form = dims[1]
+
+    material = line_material or context_material
+    if not (dims and qty and material and form):
+        return None, line_material
+
+    notes = _NOTE_TRIM.sub("", re.sub(r"\s{2,}", " ", rest))
+    line_qualification = detect_qualification(line)
+    item = {
+        "material_type": material[0],
+        "material_spec": material[1],
+        "form": form,
+        "dimensions": dims[0],
+        "quantity": qty[0],
+        "qualification": line_qualification if line_qualification != "ISO" else qualification,
+        "notes": notes,
+    }
+    return item, line_material
+
+
+def parse_rfq(text):
+    """
+    將 RFQ 文字切成品項行並以規則解析。回傳:
+      items          - 已確定且符合 RFQ_SCHEMA 的 items
+      unparsed       - 看起來像品項但規則無法確定的行 (交給 LLM)
+      context        - 提供給 LLM 的上下文行 (材質宣告、認證要求)
+      item_lines     - items 各自在原文的行號
+      unparsed_lines - unparsed 各自在原文的行號
+    """
+    qualification = detect_qualification(text)
+    items, unparsed, context = [], [], []
+    item_lines, unparsed_lines = [], []
+    context_material = None
+
+    for line_no, raw_line in enumerate((text or "").splitlines()):
+        line = _BULLET.sub("", raw_line).strip()
+        if not line:
+            continue
+        item, line_material = parse_line(line, context_material, qualification)
+        if item:
+            items.append(item)
+            item_lines.append(line_no)
+            continue
+        has_signal = bool(_find_dimensions(line) or _find_quantity(line))
+        if has_signal:
+            unparsed.append(line)
+            unparsed_lines.append(line_no)
+        elif line_material:
+            # 例如「材質: SUS316L」: 作為後續行的預設材質
+            context_material = line_material
+            context.append(line)
+        elif _AEROSPACE.search(line) or _AUTOMOTIVE.search(line):
+            context.append(line)
+
+    return {"items": items, "unparsed": unparsed, "context": context,
+            "item_lines": item_lines, "unparsed_lines": unparsed_lines}
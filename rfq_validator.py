@@ -0,0 +1,169 @@
+# rfq_validator.py
+# RFQ_SCHEMA 的預編譯驗證器。
+# 在 import 時將 schema 轉成巢狀 Python 檢查函式 (enum -> frozenset、pattern -> 預編譯 regex)，
+# 一次走訪即收集「所有」item 的錯誤，而不是 jsonschema.validate 只回報第一個。
+# 若 schema 使用了本產生器不支援的關鍵字，自動改用預編譯的 jsonschema 驗證器。
+
+import re
+
+from rfq_schema import RFQ_SCHEMA
+
+# 不影響驗證結果的註解性關鍵字
+_ANNOTATIONS = {"description", "title", "$schema", "$comment", "examples", "default"}
+_SUPPORTED = {"type", "required", "properties", "additionalProperties", "items", "minItems", "maxItems",
+              "enum", "minLength", "maxLength", "pattern"} | _ANNOTATIONS
+
+_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "boolean": bool,
+    "integer": int,
+    "number": (int, float),
+}
+
+
+class RFQValidationError(ValueError):
+    """errors: [(path, message)]；message: 所有錯誤合併後的文字 (可直接回饋給 LLM)"""
+    def __init__(self, errors):
+        self.errors = errors
+        self.message = "; ".join(f"{path or '<root>'}: {msg}" for path, msg in errors)
+        super().__init__(self.message)
+
+
+def _join(path, key):
+    if isinstance(key, int):
+        return f"{path}[{key}]"
+    return f"{path}.{key}" if path else key
+
+
+def _compile(schema):
+    """將 schema 節點編譯成 check(value, path, errors) 函式"""
+    unsupported = set(schema) - _SUPPORTED
+    if unsupported:
+        raise NotImplementedError(f"unsupported schema keywords: {sorted(unsupported)}")
+
+    checks = []
+
+    if "type" in schema:
+        name = schema["type"]
+        # ["string", "null"] 等聯集型別或 "null" 交給 jsonschema
+        if not isinstance(name, str) or name not in _TYPES:
+            raise NotImplementedError(f"unsupported type: {name!r}")
+        py_type = _TYPES[name]
+        def check_type(value, path, errors, py_type=py_type, name=name):
+            # bool 是 int 的子類別，需排除
+            if not isinstance(value, py_type) or (isinstance(value, bool) and name in ("integer", "number")):
+                errors.append((path, f"{value!r} is not of type '{name}'"))
+                return False
+            return True
+        type_check = check_type
+    else:
+        type_check = None
+
+    if "enum" in schema:
+        allowed = frozenset(schema["enum"])
+        def check_enum(value, path, errors):
+            if value not in allowed:
+                errors.append((path, f"{value!r} is not one of {schema['enum']}"))
+        checks.append(check_enum)
+
+    if "minLength" in schema or "maxLength" in schema:
+        min_len, max_len = schema.get("minLength"), schema.get("maxLength")
+        def check_length(value, path, errors):
+            if isinstance(value, str):
+                if min_len is not None and len(value) < min_len:
+                    errors.append((path, f"{value!r} is shorter than {min_len} characters"))
+                if max_len is not None and len(value) > max_len:
+                    errors.append((path, f"{value!r} is longer than {max_len} characters"))
+        checks.append(check_length)
+
+    if "pattern" in schema:
+        regex = re.compile(schema["pattern"])
+        def check_pattern(value, path, errors):
+            if isinstance(value, str) and not regex.search(value):
+                errors.append((path, f"{value!r} does not match {schema['pattern']!r}"))
+        checks.append(check_pattern)
+
+    if "properties" in schema or "required" in schema or "additionalProperties" in schema:
+        properties = {key: _compile(sub) for key, sub in schema.get("properties", {}).items()}
+        required = schema.get("required", [])
+        additional = schema.get("additionalProperties", True)
+        if additional not in (True, False):
+            raise NotImplementedError("additionalProperties must be a boolean")
+        def check_object(value, path, errors):
+            if not isinstance(value, dict):
+                return
+            for key in required:
+                if key not in value:
+                    errors.append((path, f"{key!r} is a required property"))
+            for key, item in value.items():
+                sub = properties.get(key)
+                if sub is not None:
+                    sub(item, _join(path, key), errors)
+                elif not additional:
+                    errors.append((path, f"Additional properties are not allowed ({key!r} was unexpected)"))
+        checks.append(check_object)
+
+    if "items" in schema or "minItems" in schema or "maxItems" in schema:
+        item_check = _compile(schema["items"]) if "items" in schema else None
+        min_items, max_items = schema.get("minItems"), schema.get("maxItems")
+        def check_array(value, path, errors):
+            if not isinstance(value, list):
+                return
+            if min_items is not None and len(value) < min_items:
+                errors.append((path, f"{value!r} should have at least {min_items} items" if value else "[] should be non-empty"))
+            if max_items is not None and len(value) > max_items:
+                errors.append((path, f"array has more than {max_items} items"))
+            if item_check is not None:
+                for idx, item in enumerate(value):
+                    item_check(item, _join(path, idx), errors)
+        checks.append(check_array)
+
+    def check(value, path, errors):
+        if type_check is not None and not type_check(value, path, errors):
+            return
+        for c in checks:
+            c(value, path, errors)
+    return check
+
+
+def _jsonschema_fallback(schema):
+    from jsonschema.validators import validator_for
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    validator = cls(schema)
+    def check(value, path, errors):
+        for err in validator.iter_errors(value):
+            # 與編譯路徑相同的格式 (items[3].quantity)，呼叫端依此判斷錯誤屬於哪個 item
+            path = ""
+            for key in err.absolute_path:
+                path = _join(path, key)
+            errors.append((path, err.message))
+    return check
+
+
+def build_validator(schema):
+    """回傳 iter_errors(instance) -> [(path, message)]"""
+    try:
+        check = _compile(schema)
+    except NotImplementedError:
+        check = _jsonschema_fallback(schema)
+
+    def iter_errors(instance):
+        errors = []
+        check(instance, "", errors)
+        return errors
+    return iter_errors
+
+
+# import 時編譯一次
+iter_rfq_errors = build_validator(RFQ_SCHEMA)
+
+
+def validate_rfq(instance):
+    """驗證整份 {'items': [...]}；有任何錯誤時一次拋出包含全部錯誤的 RFQValidationError"""
+    errors = iter_rfq_errors(instance)
+    if errors:
+        raise RFQValidationError(errors)
+    return instance
@@ -1,6 +1,12 @@
 import json
 import os
+import threading
+import time
 import google.generativeai as genai
+from core.llm_gateway import gateway
+from core.attachment_store import file_digest
+
+UPLOAD_REUSE_SECONDS = 24 * 3600  # Gemini File API 檔案保留 48 小時；同內容附件在此期間內直接重用
 
 OPTIONS = {
     "material_types": [
@@ -38,11 +44,89 @@ OPTION_TRANSLATIONS = {
     }
 }
 
+def build_system_instruction():
+    """與單筆 RFQ 無關的靜態指示 (規則、Enum、中英對照)"""
+    pure_mat_opts = ", ".join(OPTIONS["material_types"])
+    pure_form_opts = ", ".join(OPTIONS["form_types"])
+    trans_map = OPTION_TRANSLATIONS.get("zh", {})
+    context_hint = "Reference Map (For understanding only): " + ", ".join([f"{m}={trans_map.get(m, m)}" for m in OPTIONS["material_types"]])
+
+    system_instruction = (
+        f"You are a senior procurement analyst. Normalize RFQ text and optionally "
+        f"modify the draft based on user instructions.\n\n"
+        f"*** STRICT RULES ***\n"
+        f"1. **ROOT OBJECT**: Output MUST be a JSON object with two keys: 'items' (list) and 'draft' (string).\n"
+        f"2. **ITEMS MANDATORY FIELDS**: 'material_type', 'material_spec', 'form', 'dimensions', 'quantity', 'qualification', 'notes'.\n"
+        f"3. **QUANTITY**: MUST be a string with unit (e.g. '10 pcs'). NEVER output raw numbers.\n"
+        f"4. **FORM LOGIC**:\n"
+        f"   - **Bar**: 'Ø', 'dia', 'round', or 'D*L'.\n"
+        f"   - **Plate**: 'Block', 'Cuboid' or smallest dim >= 10mm.\n"
+        f"   - **Sheet**: smallest dim < 10mm.\n"
+        f"   - **Tube**: 'Tube', 'Pipe', 'OD/ID'.\n"
+        f"5. **VALID VALUES (Strict Enum)**: \n"
+        f"   - Material_type MUST be one of: [{pure_mat_opts}]\n"
+        f"   - Form MUST be one of: [{pure_form_opts}]\n"
+        f"   - {context_hint}\n"
+        f"   - If unsure, use 'Other' and explain in notes.\n"
+        f"6. **DIMENSIONS**: Keep original string format exactly.\n"
+        f"7. **NOTES**: Extract technical specs or constraints. Do not translate them.\n"
+        f"8. **QUALIFICATION**: Extract the required qualification for each item (must be 'ISO', 'Automotive', or 'Aerospace'). Default to 'ISO'.\n"
+        f"   - **Automotive**: If text mentions '汽車', '車用', 'IATF 16949', or 'IATF'.\n"
+        f"   - **Aerospace**: If text mentions '航太', '航空', 'Aerospace', 'AS9100', or 'NADCAP'.\n"
+        f"9. **DRAFT**: Provide a professional email draft based on the RFQ. If a previous_draft and user_instruction are provided, modify the draft accordingly.\n"
+    )
+    return system_instruction
+
+
 class RFQSkill:
     def __init__(self, api_key):
         self.api_key = api_key
         genai.configure(api_key=self.api_key)
-        self.model = genai.GenerativeModel('gemini-1.5-flash')
+        # 靜態指示放在 system_instruction，作為每次請求相同的可快取前綴
+        self.model = genai.GenerativeModel('gemini-1.5-flash', system_instruction=build_system_instruction())
+        # 已上傳檔案 (依內容 SHA-256)：同一份圖面被多封信轉寄或反覆修改草稿時不重複上傳
+        # 管線的多個 parse worker 會同時呼叫，_uploads / _in_use 皆以 _uploads_lock 保護
+        self._uploads = {}
+        self._in_use = {}  # digest -> 正在使用該檔案的請求數；使用中的檔案即使過期也不刪除
+        self._uploads_lock = threading.Lock()
+
+    def _upload(self, path):
+        """取得 (或上傳) 檔案並標記為使用中；用完須呼叫 _release_uploads"""
+        now = time.time()
+        digest = file_digest(path)
+        with self._uploads_lock:
+            expired = [d for d, (_, uploaded_at) in self._uploads.items()
+                       if now - uploaded_at >= UPLOAD_REUSE_SECONDS and not self._in_use.get(d)]
+            expired = [self._uploads.pop(d)[0] for d in expired]
+            cached = self._uploads.get(digest)
+            if cached is not None:
+                self._in_use[digest] = self._in_use.get(digest, 0) + 1
+        # 刪除與上傳為網路呼叫，不持有鎖
+        for file_obj in expired:
+            try:
+                genai.delete_file(file_obj.name)
+            except Exception:
+                pass
+        if cached is not None:
+            return digest, cached[0]
+        file_obj = genai.upload_file(path=path)
+        with self._uploads_lock:
+            cached = self._uploads.setdefault(digest, (file_obj, now))
+            self._in_use[digest] = self._in_use.get(digest, 0) + 1
+        if cached[0] is not file_obj:
+            # 其他執行緒同時上傳了相同內容：沿用先完成的，刪除多傳的一份
+            try:
+                genai.delete_file(file_obj.name)
+            except Exception:
+                pass
+        return digest, cached[0]
+
+    def _release_uploads(self, digests):
+        with self._uploads_lock:
+            for digest in digests:
+                self._in_use[digest] -= 1
+                if not self._in_use[digest]:
+                    del self._in_use[digest]
 
     def parse_and_draft(self, email_text, pdf_file_paths=None, previous_draft=None, user_instruction=None):
         """
@@ -51,38 +135,8 @@ class RFQSkill:
         3. 若有 user_instruction，則依照指令修改 previous_draft
         4. 回傳 JSON 格式的解析結果與草稿
         """
-        pure_mat_opts = ", ".join(OPTIONS["material_types"])
-        pure_form_opts = ", ".join(OPTIONS["form_types"])
-        trans_map = OPTION_TRANSLATIONS.get("zh", {})
-        context_hint = "Reference Map (For understanding only): " + ", ".join([f"{m}={trans_map.get(m, m)}" for m in OPTIONS["material_types"]])
-
-        system_instruction = (
-            f"You are a senior procurement analyst. Normalize RFQ text and optionally "
-            f"modify the draft based on user instructions.\n\n"
-            f"*** STRICT RULES ***\n"
-            f"1. **ROOT OBJECT**: Output MUST be a JSON object with two keys: 'items' (list) and 'draft' (string).\n"
-            f"2. **ITEMS MANDATORY FIELDS**: 'material_type', 'material_spec', 'form', 'dimensions', 'quantity', 'qualification', 'notes'.\n"
-            f"3. **QUANTITY**: MUST be a string with unit (e.g. '10 pcs'). NEVER output raw numbers.\n"
-            f"4. **FORM LOGIC**:\n"
-            f"   - **Bar**: 'Ø', 'dia', 'round', or 'D*L'.\n"
-            f"   - **Plate**: 'Block', 'Cuboid' or smallest dim >= 10mm.\n"
-            f"   - **Sheet**: smallest dim < 10mm.\n"
-            f"   - **Tube**: 'Tube', 'Pipe', 'OD/ID'.\n"
-            f"5. **VALID VALUES (Strict Enum)**: \n"
-            f"   - Material_type MUST be one of: [{pure_mat_opts}]\n"
-            f"   - Form MUST be one of: [{pure_form_opts}]\n"
-            f"   - {context_hint}\n"
-            f"   - If unsure, use 'Other' and explain in notes.\n"
-            f"6. **DIMENSIONS**: Keep original string format exactly.\n"
-            f"7. **NOTES**: Extract technical specs or constraints. Do not translate them.\n"
-            f"8. **QUALIFICATION**: Extract the required qualification for each item (must be 'ISO', 'Automotive', or 'Aerospace'). Default to 'ISO'.\n"
-            f"   - **Automotive**: If text mentions '汽車', '車用', 'IATF 16949', or 'IATF'.\n"
-            f"   - **Aerospace**: If text mentions '航太', '航空', 'Aerospace', 'AS9100', or 'NADCAP'.\n"
-            f"9. **DRAFT**: Provide a professional email draft based on the RFQ. If a previous_draft and user_instruction are provided, modify the draft accordingly.\n"
-        )
-
-        user_prompt = f"System Instruction:\n{system_instruction}\n\n"
-        user_prompt += f"Analyze this RFQ text:\n\"\"\"{email_text}\"\"\"\n\n"
+        # 每次請求變動的內容放在靜態指示之後；同一封 RFQ 反覆修改草稿時，RFQ 文字也屬於共同前綴
+        user_prompt = f"Analyze this RFQ text:\n\"\"\"{email_text}\"\"\"\n\n"
 
         if previous_draft:
             user_prompt += f"Previous Draft:\n\"\"\"{previous_draft}\"\"\"\n\n"
@@ -91,25 +145,28 @@ class RFQSkill:
             user_prompt += f"User Instruction for modifying the draft:\n\"\"\"{user_instruction}\"\"\"\n\n"
 
         contents = [user_prompt]
-        uploaded_files = []
+        in_use = []
 
         try:
-            # 支援多個 PDF 檔案上傳
+            # 支援多個 PDF 檔案上傳 (相同內容只上傳一次)
             if pdf_file_paths:
                 for pdf_path in pdf_file_paths:
                     if os.path.exists(pdf_path):
-                        file_obj = genai.upload_file(path=pdf_path)
-                        uploaded_files.append(file_obj)
+                        digest, file_obj = self._upload(pdf_path)
+                        in_use.append(digest)
                         contents.insert(0, file_obj)
 
-            response = self.model.generate_content(
-                contents,
-                generation_config=genai.GenerationConfig(
-                    response_mime_type="application/json",
-                )
-            )
+            response = gateway.call("rfq_skill", "gemini_sdk", {
+                "model": self.model,
+                "contents": contents,
+                "options": {
+                    "generation_config": genai.GenerationConfig(
+                        response_mime_type="application/json",
+                    )
+                }
+            })
 
-            content = response.text.strip()
+            content = response.text
 
             try:
                 raw_data = json.loads(content)
@@ -126,9 +183,4 @@ class RFQSkill:
             print(f"[AI 系統錯誤] {e}")
             return {"items": [], "draft": "", "error": str(e)}
         finally:
-            # 清理所有上傳的暫存檔案
-            for f_obj in uploaded_files:
-                try:
-                    genai.delete_file(f_obj.name)
-                except:
-                    pass
+            self._release_uploads(in_use)
@@ -2,9 +2,227 @@ import unittest
 from unittest.mock import patch, MagicMock, mock_open
 import os
 import json
+import queue
+import re
+import select
+import shlex
+import socket
+import socketserver
+import sqlite3
+import tempfile
+import threading
+import time
+from email import policy as email_policy
+from email.message import EmailMessage
 
-from connectors.gmail_client import GmailClient
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+from connectors.gmail_client import GmailClient, AdaptivePoller, uid_set
+from connectors.tg_bot import TGBotHandler, TokenBucket, split_message
 from skills.rfq_parser import RFQSkill
+from core.attachment_store import AttachmentStore, AttachmentTooLarge
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """本機 IMAP 替身：只實作 GmailClient 用到的指令，並記錄登入次數與收到的指令"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _FakeIMAPHandler)
+        self.port = self.server_address[1]
+        self.logins = 0
+        self.commands = []
+        self.messages = []  # [{"uid", "raw", "flags", "labels"}]
+        self.uidvalidity = 1
+        self.capabilities = "IMAP4rev1 IDLE UIDPLUS"
+        self.next_uid = 1
+        self.lock = threading.Lock()
+        self.handlers = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def add_message(self, subject, body="Please quote.", seen=False, attachments=()):
+        msg = EmailMessage()
+        msg["From"], msg["To"], msg["Subject"] = "client@example.com", "rfq@example.com", subject
+        msg["Date"] = "Mon, 02 Oct 2023 09:00:00 +0000"
+        msg.set_content(body)
+        for filename, data in attachments:
+            msg.add_attachment(data, maintype="application", subtype="pdf", filename=filename)
+        raw = msg.as_bytes(policy=email_policy.SMTP)
+        with self.lock:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.messages.append({"uid": uid, "raw": raw, "flags": {"\\Seen"} if seen else set(), "labels": set()})
+            count = len(self.messages)
+        # 正在 IDLE 的連線立即收到推播
+        for handler in list(self.handlers):
+            if handler.idling:
+                handler.pushes.put(f"* {count} EXISTS")
+        return uid
+
+    def drop_connections(self):
+        """模擬伺服器端斷線 (閒置逾時)"""
+        for handler in list(self.handlers):
+            try:
+                handler.connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.drop_connections()
+        self.shutdown()
+        self.server_close()
+
+
+def _fake_bodystructure(raw):
+    """由 email 套件的解析結果產生 BODYSTRUCTURE 與各 section 內容 (只支援單層 multipart)"""
+    from email import message_from_bytes
+    msg = message_from_bytes(raw, policy=email_policy.SMTP)
+    contents = {"HEADER": raw.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n"}
+    structures = []
+    for i, part in enumerate(msg.iter_parts() if msg.is_multipart() else [msg], 1):
+        mime, body = part.as_bytes(policy=email_policy.SMTP).split(b"\r\n\r\n", 1)
+        contents[f"{i}.MIME"], contents[str(i)] = mime + b"\r\n\r\n", body
+        filename = part.get_filename()
+        disposition = f'("ATTACHMENT" ("FILENAME" "{filename}"))' if filename else "NIL"
+        structures.append(f'("{part.get_content_maintype().upper()}" "{part.get_content_subtype().upper()}" NIL NIL NIL '
+                          f'"{part.get("Content-Transfer-Encoding", "7BIT").upper()}" {len(body)} NIL {disposition} NIL)')
+    structure = "(" + "".join(structures) + ' "MIXED")' if msg.is_multipart() else structures[0]
+    return structure, contents
+
+
+class _FakeIMAPHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        self.idling = False
+        self.pushes = queue.Queue()
+        server.handlers.append(self)
+        self.send(f"* OK [CAPABILITY {server.capabilities}] fake ready")
+        try:
+            for raw_line in self.rfile:
+                line = raw_line.decode().rstrip("\r\n")
+                if not line:
+                    continue
+                tag, _, rest = line.partition(" ")
+                command, _, args = rest.partition(" ")
+                command = command.upper()
+                if command == "UID":
+                    command, _, args = args.partition(" ")
+                    command = "UID " + command.upper()
+                server.commands.append(f"{command} {args}".strip())
+                if not self.dispatch(tag, command, args):
+                    break
+        finally:
+            server.handlers.remove(self)
+
+    def dispatch(self, tag, command, args):
+        server = self.server
+        if command == "CAPABILITY":
+            self.send(f"* CAPABILITY {server.capabilities}")
+        elif command == "LOGIN":
+            server.logins += 1
+        elif command in ("SELECT", "EXAMINE"):
+            self.send(f"* {len(server.messages)} EXISTS")
+            self.send(f"* OK [UIDVALIDITY {server.uidvalidity}] UIDs valid")
+            self.send(f"* OK [UIDNEXT {server.next_uid}] Predicted next UID")
+            self.send(f"{tag} OK [READ-WRITE] SELECT completed")
+            return True
+        elif command == "STATUS":
+            self.send(f'* STATUS "INBOX" (UIDVALIDITY {server.uidvalidity} UIDNEXT {server.next_uid})')
+        elif command == "UID SEARCH":
+            uids = [m["uid"] for m in server.messages if self.matches(m, args)]
+            self.send("* SEARCH" + "".join(f" {u}" for u in uids))
+        elif command == "UID FETCH":
+            uid_arg, _, items = args.partition(" ")
+            headers_only = "[HEADER]" in items.upper()
+            sections = re.findall(r"BODY(?:\.PEEK)?\[([^\]]*)\]", items.upper())
+            for seq, m in enumerate(server.messages, 1):
+                if not self.in_uid_set(m["uid"], uid_arg, server.next_uid - 1):
+                    continue
+                if "BODYSTRUCTURE" in items.upper() or sections not in ([""], ["HEADER"]):
+                    structure, contents = _fake_bodystructure(m["raw"])
+                    if "BODYSTRUCTURE" in items.upper():
+                        self.send(f"* {seq} FETCH (UID {m['uid']} BODYSTRUCTURE {structure})")
+                    else:
+                        out = f"* {seq} FETCH (UID {m['uid']}".encode()
+                        for name in sections:
+                            out += f" BODY[{name}] {{{len(contents[name])}}}\r\n".encode() + contents[name]
+                        self.send(out + b")\r\n")
+                else:
+                    payload = m["raw"].split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n" if headers_only else m["raw"]
+                    section = "BODY[HEADER]" if headers_only else "BODY[]"
+                    flags = " ".join(sorted(m["flags"]))
+                    self.send(f"* {seq} FETCH (UID {m['uid']} FLAGS ({flags}) RFC822.SIZE {len(m['raw'])} {section} {{{len(payload)}}}\r\n".encode() + payload + b")\r\n")
+        elif command == "UID STORE":
+            uid_arg, _, rest = args.partition(" ")
+            op, _, value = rest.partition(" ")
+            values = set(value.strip("()").replace('"', "").split())
+            for m in server.messages:
+                if self.in_uid_set(m["uid"], uid_arg, server.next_uid - 1):
+                    target = m["labels"] if "X-GM-LABELS" in op.upper() else m["flags"]
+                    target |= values
+        elif command == "IDLE":
+            self.send("+ idling")
+            self.idling = True
+            try:
+                while True:
+                    try:
+                        self.send(self.pushes.get_nowait())
+                        continue
+                    except queue.Empty:
+                        pass
+                    if select.select([self.connection], [], [], 0.02)[0]:
+                        if not self.rfile.readline():  # DONE 或斷線
+                            return False
+                        break
+            finally:
+                self.idling = False
+        elif command == "LOGOUT":
+            self.send("* BYE logging out")
+            self.send(f"{tag} OK LOGOUT completed")
+            return False
+        elif command not in ("NOOP", "EXPUNGE", "CLOSE"):
+            self.send(f"{tag} BAD unknown command")
+            return True
+        self.send(f"{tag} OK {command} completed")
+        return True
+
+    @staticmethod
+    def in_uid_set(uid, uid_arg, max_uid):
+        for part in uid_arg.split(","):
+            low, _, high = part.partition(":")
+            low = max_uid if low == "*" else int(low)
+            high = low if not high else (max_uid if high == "*" else int(high))
+            if min(low, high) <= uid <= max(low, high):
+                return True
+        return False
+
+    def matches(self, message, criteria):
+        tokens = shlex.split(criteria.replace("(", " ").replace(")", " "))
+        i = 0
+        while i < len(tokens):
+            token = tokens[i].upper()
+            if token == "CHARSET":
+                i += 1
+            elif token == "UNSEEN" and "\\Seen" in message["flags"]:
+                return False
+            elif token == "SEEN" and "\\Seen" not in message["flags"]:
+                return False
+            elif token == "SUBJECT":
+                i += 1
+                subject = message["raw"].split(b"Subject: ", 1)[1].split(b"\r\n", 1)[0].decode()
+                if tokens[i].lower() not in subject.lower():
+                    return False
+            elif token == "UID":
+                i += 1
+                if not self.in_uid_set(message["uid"], tokens[i], self.server.next_uid - 1):
+                    return False
+            i += 1
+        return True
 
 class TestGmailClient(unittest.TestCase):
     def setUp(self):
@@ -15,7 +233,7 @@ class TestGmailClient(unittest.TestCase):
     def test_fetch_unprocessed_rfqs(self, mock_makedirs, mock_mailbox_class):
         # Setup mock mailbox
         mock_mailbox = MagicMock()
-        mock_mailbox_class.return_value.login.return_value.__enter__.return_value = mock_mailbox
+        mock_mailbox_class.return_value = mock_mailbox
 
         # Setup mock message
         mock_msg = MagicMock()
@@ -56,6 +274,456 @@ class TestGmailClient(unittest.TestCase):
         self.assertTrue(mock_server.send_message.called)
 
 
+class TestGmailSession(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeIMAPServer()
+        self.client = GmailClient("test@gmail.com", "password", imap_server="127.0.0.1", imap_port=self.server.port, imap_ssl=False)
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.tmp.cleanup()
+
+    def test_one_login_for_fetch_and_bulk_updates(self):
+        uids = [self.server.add_message(f"RFQ {i}") for i in range(5)]
+        self.server.add_message("Newsletter")
+
+        emails = self.client.fetch_unprocessed_rfqs(self.tmp.name)
+        self.assertEqual([int(m["uid"]) for m in emails], uids)
+        self.client.mark_processed([m["uid"] for m in emails], "RFQ-進行中")
+
+        self.assertEqual(self.server.logins, 1)
+        stores = [c for c in self.server.commands if c.startswith("UID STORE")]
+        self.assertEqual(stores, ["UID STORE 1:5 +FLAGS (\\Seen)", 'UID STORE 1:5 +X-GM-LABELS "RFQ-&kDKITE4t-"'])
+        self.assertEqual(self.client.fetch_unprocessed_rfqs(self.tmp.name), [])
+        self.assertEqual(self.server.logins, 1)
+
+    def test_reconnects_after_server_drops_session(self):
+        self.server.add_message("RFQ 1")
+        self.assertEqual(len(self.client.fetch_unprocessed_rfqs(self.tmp.name)), 1)
+        self.server.drop_connections()
+
+        self.client.mark_as_read("1")
+        self.assertEqual(self.server.logins, 2)
+        self.assertIn("\\Seen", self.server.messages[0]["flags"])
+
+    def _fetches(self):
+        commands = [c for c in self.server.commands if c.startswith("UID FETCH")]
+        self.server.commands.clear()
+        return [c.split()[2] for c in commands if "[HEADER]" in c], [c.split()[2] for c in commands if "[HEADER]" not in c]
+
+    def test_incremental_sync_fetches_bodies_only_for_new_rfqs(self):
+        for i in range(3):
+            self.server.add_message(f"RFQ old {i}")
+        self.server.add_message("Newsletter")
+
+        emails, state = self.client.sync_new_rfqs(self.tmp.name)
+        self.assertEqual([m["subject"] for m in emails], ["RFQ old 0", "RFQ old 1", "RFQ old 2"])
+        self.assertEqual(state, (1, 4))
+        self.assertEqual(self._fetches(), (["1,2,3,4"], ["1", "2", "3"]))
+
+        # 舊的未讀 RFQ 仍未讀，但不在高水位之後，不會再被下載
+        self.server.add_message("FW: rfq new")
+        emails, state = self.client.sync_new_rfqs(self.tmp.name, state)
+        self.assertEqual([m["uid"] for m in emails], ["5"])
+        self.assertEqual(state, (1, 5))
+        self.assertEqual(self._fetches(), (["5"], ["5"]))
+
+        self.assertEqual(self.client.sync_new_rfqs(self.tmp.name, state), ([], (1, 5)))
+        self.assertFalse(any(c.startswith("UID SEARCH") for c in self.server.commands))
+
+    def test_forwarded_attachment_is_stored_once(self):
+        store = AttachmentStore(os.path.join(self.tmp.name, "blobs"))
+        self.client.attachment_store = store
+        drawing = b"%PDF-1.4 drawing" * 1000
+        self.server.add_message("RFQ A", attachments=[("drawing.pdf", drawing)])
+        self.server.add_message("FW: RFQ A", attachments=[("drawing.pdf", drawing)])
+
+        emails, _ = self.client.sync_new_rfqs(os.path.join(self.tmp.name, "inbox"))
+        first, second = emails[0]["attachments"][0], emails[1]["attachments"][0]
+        self.assertNotEqual(first, second)
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertEqual(emails[0]["attachment_digests"], emails[1]["attachment_digests"])
+        self.assertEqual(store.dedup_hits, 1)
+
+    def test_oversized_attachment_is_never_downloaded(self):
+        store = AttachmentStore(os.path.join(self.tmp.name, "blobs"), max_bytes=10 * 1024)
+        self.client.attachment_store = store
+        self.server.add_message("RFQ big", body="請報價，圖面如附件", attachments=[("spec.pdf", b"%PDF small"), ("scan.pdf", b"x" * 50 * 1024)])
+        self.server.add_message("RFQ small", attachments=[("drawing.pdf", b"%PDF drawing")])
+
+        emails, _ = self.client.sync_new_rfqs(os.path.join(self.tmp.name, "inbox"))
+        big, small = emails
+        self.assertEqual((big["subject"], big["text"].strip()), ("RFQ big", "請報價，圖面如附件"))
+        self.assertEqual([os.path.basename(p) for p in big["attachments"]], ["1_spec.pdf"])
+        with open(big["attachments"][0], "rb") as f:
+            self.assertEqual(f.read(), b"%PDF small")
+        self.assertEqual([os.path.basename(p) for p in small["attachments"]], ["2_drawing.pdf"])
+        # 大附件 (section 3) 與含大附件的整封信都沒有被抓取
+        fetches = [c for c in self.server.commands if c.startswith("UID FETCH")]
+        self.assertFalse(any("BODY.PEEK[3]" in c or ("BODY.PEEK[]" in c and c.split()[2] == "1") for c in fetches))
+        self.assertTrue(any(c.startswith("UID FETCH 1:2 (UID BODYSTRUCTURE)") for c in fetches))
+
+    def test_body_parts_from_bodystructure(self):
+        # Gmail 回應的形式：巢狀 multipart、非 ASCII 檔名以 literal 傳回
+        data = [
+            (b'1 (UID 12 BODYSTRUCTURE ((("TEXT" "PLAIN" ("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 120 4 NIL NIL NIL)'
+             b'("TEXT" "HTML" ("CHARSET" "UTF-8") NIL NIL "QUOTED-PRINTABLE" 480 9 NIL NIL NIL) "ALTERNATIVE" ("BOUNDARY" "b1") NIL NIL)'
+             b'("APPLICATION" "PDF" ("NAME" {9}', "圖面.pdf".encode()[:9]),
+            b') "<id1>" NIL "BASE64" 4000 NIL ("ATTACHMENT" ("FILENAME" "x.pdf")) NIL)'
+            b'("MESSAGE" "RFC822" NIL NIL NIL "7BIT" 900 ("date" "subj" NIL NIL NIL NIL NIL NIL NIL "<m>") ("TEXT" "PLAIN" NIL NIL NIL "7BIT" 10 1) 20) "MIXED" ("BOUNDARY" "b0") NIL NIL))',
+        ]
+        from connectors.gmail_client import _imap_lists, body_parts
+        (response,) = _imap_lists(data)
+        self.assertEqual(response[:2], ["UID", "12"])
+        parts = list(body_parts(response[3]))
+        self.assertEqual([(section, size) for section, size, _ in parts], [("1.1", 120), ("1.2", 480), ("2", 3000), ("3", 900)])
+        self.assertEqual(parts[2][2], "圖面.pdf".encode()[:9].decode())
+
+    def test_uidvalidity_change_triggers_full_rescan(self):
+        self.server.add_message("RFQ 1")
+        self.server.add_message("RFQ 2", seen=True)
+        self.server.uidvalidity = 7
+        emails, state = self.client.sync_new_rfqs(self.tmp.name, (1, 2))
+        self.assertEqual([m["uid"] for m in emails], ["1"])
+        self.assertEqual(state, (7, 2))
+
+    def test_sync_state_is_persisted(self):
+        from core.db_manager import DBManager
+        store = DBManager(os.path.join(self.tmp.name, "agent.db"))
+        self.assertIsNone(store.get_mail_sync_state("INBOX"))
+        store.save_mail_sync_state("INBOX", 1, 42)
+        store.save_mail_sync_state("INBOX", 1, 57)
+        self.assertEqual(store.get_mail_sync_state("INBOX"), (1, 57))
+
+    def test_idle_wakes_up_on_new_mail(self):
+        self.assertTrue(self.client.supports_idle())
+        result = {}
+
+        def wait():
+            result["pushed"] = self.client.wait_for_new_mail(timeout=10)
+            result["woke_at"] = time.monotonic()
+
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        while not any(h.idling for h in self.server.handlers):
+            time.sleep(0.01)
+        arrived_at = time.monotonic()
+        self.server.add_message("RFQ urgent")
+        waiter.join(5)
+
+        self.assertTrue(result["pushed"])
+        self.assertLess(result["woke_at"] - arrived_at, 1.0)
+        self.assertEqual(len(self.client.fetch_unprocessed_rfqs(self.tmp.name)), 1)
+        self.assertEqual(self.server.logins, 1)
+
+    def test_wait_without_idle_capability(self):
+        self.server.capabilities = "IMAP4rev1 UIDPLUS"
+        self.assertIsNone(self.client.wait_for_new_mail(timeout=1))
+        self.assertNotIn("IDLE", self.server.commands)
+
+    def test_adaptive_poller_backs_off_when_idle(self):
+        poller = AdaptivePoller(min_interval=5, max_interval=40)
+        self.assertEqual([poller.next_interval(False) for _ in range(4)], [10, 20, 40, 40])
+        self.assertEqual(poller.next_interval(True), 5)
+
+    def test_uid_set(self):
+        self.assertEqual(uid_set(["7", "1", "2", "3", 3]), "1:3,7")
+        self.assertEqual(uid_set("42"), "42")
+
+
+class _SMTPRecorder:
+    """aiosmtpd handler：記錄收到的信；drop_on 指定第幾封信在 DATA 階段直接切斷連線"""
+    def __init__(self, drop_on=(), reject=()):
+        self.received = []
+        self.drop_on = set(drop_on)
+        self.reject = set(reject)
+        self.attempts = 0
+        self.logins = 0
+
+    def authenticate(self, server, session, envelope, mechanism, auth_data):
+        self.logins += 1
+        return AuthResult(success=auth_data.password == b"password", handled=False)
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if address in self.reject:
+            return "550 5.1.1 No such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.attempts += 1
+        if self.attempts in self.drop_on:
+            server.transport.close()
+            return "421 4.4.2 Connection dropped"
+        self.received.append(email_message_from_bytes(envelope.content))
+        return "250 OK"
+
+
+def email_message_from_bytes(data):
+    from email import message_from_bytes
+    return message_from_bytes(data, policy=email_policy.default)
+
+
+class TestSmtpBulk(unittest.TestCase):
+    def setUp(self):
+        self.handler = _SMTPRecorder()
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        self.controller = Controller(self.handler, hostname="127.0.0.1", port=port,
+                                     authenticator=self.handler.authenticate, auth_require_tls=False,
+                                     auth_exclude_mechanism=["LOGIN"])  # 只留 PLAIN：每次登入恰好驗證一次
+        self.controller.start()
+        self.client = GmailClient("test@gmail.com", "password", smtp_server="127.0.0.1", smtp_port=port, smtp_ssl=False)
+
+    def tearDown(self):
+        self.client.close()
+        self.controller.stop()
+
+    def _messages(self, count):
+        messages = []
+        for i in range(count):
+            msg = EmailMessage()
+            msg["Subject"] = f"RFQ {i}"
+            msg["To"] = f"supplier{i}@example.com"
+            msg.set_content("Please quote.")
+            messages.append(msg)
+        return messages
+
+    def test_one_login_for_whole_batch(self):
+        results = self.client.send_bulk(self._messages(40), rate_per_min=0)
+
+        self.assertTrue(all(r["ok"] for r in results))
+        self.assertEqual(len(self.handler.received), 40)
+        self.assertEqual(self.handler.logins, 1)
+        self.assertEqual(self.handler.received[7]["From"], "test@gmail.com")
+        self.assertEqual([r["to"] for r in results], [f"supplier{i}@example.com" for i in range(40)])
+
+    def test_reconnects_after_server_disconnect(self):
+        self.handler.drop_on = {3}
+        results = self.client.send_bulk(self._messages(5), rate_per_min=0)
+
+        self.assertTrue(all(r["ok"] for r in results))
+        self.assertEqual([m["Subject"] for m in self.handler.received], [f"RFQ {i}" for i in range(5)])
+        self.assertEqual(self.handler.logins, 2)
+
+    def test_rejected_recipient_does_not_stop_batch(self):
+        self.handler.reject = {"supplier1@example.com"}
+        results = self.client.send_bulk(self._messages(3), rate_per_min=0)
+
+        self.assertEqual([r["ok"] for r in results], [True, False, True])
+        self.assertIn("supplier1@example.com", results[1]["error"])
+        self.assertEqual(len(self.handler.received), 2)
+
+    def test_bad_credentials_fail_every_message(self):
+        self.client.pwd = "wrong"
+        results = self.client.send_bulk(self._messages(3), rate_per_min=0)
+
+        self.assertEqual([r["ok"] for r in results], [False] * 3)
+        self.assertEqual(self.handler.logins, 1)
+
+    def test_rate_limit_spaces_messages(self):
+        start = time.monotonic()
+        self.client.send_bulk(self._messages(4), rate_per_min=600)
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+
+
+class TestTGNotifications(unittest.TestCase):
+    def setUp(self):
+        self.bot = TGBotHandler("123456:TEST", "42")
+        self.bot.limiter = TokenBucket(rate_per_min=6000, capacity=1)
+        self.sent = []
+
+        async def deliver(text, reply_markup=None):
+            self.sent.append((text, reply_markup))
+        self.bot._deliver = deliver
+
+    def _notify(self, items):
+        import asyncio
+
+        async def drive():
+            start = time.monotonic()
+            for rfq_id, draft in items:
+                await self.bot.send_draft_for_approval(rfq_id, f"料號: Bar\n數量: 1", draft)
+            enqueued = time.monotonic() - start
+            await self.bot.flush()
+            self.bot._sender_task.cancel()
+            return enqueued
+        return asyncio.run(drive())
+
+    def _callback(self, data, text):
+        """模擬按下按鈕 (query.message 為按鈕所在的訊息)"""
+        import asyncio
+        query = MagicMock()
+        query.data = data
+        query.message.chat.id = 42
+        query.message.text = text
+        query.answer = MagicMock(side_effect=lambda *a, **k: asyncio.sleep(0))
+        update = MagicMock(callback_query=query)
+        asyncio.run(self.bot.handle_callback(update, None))
+
+    def test_waiting_caller_sees_delivery_result(self):
+        import asyncio
+
+        async def flaky(text, reply_markup=None):
+            if "RFQ-1" in text:
+                raise ConnectionError("Telegram unreachable")
+            self.sent.append((text, reply_markup))
+        self.bot._deliver = flaky
+
+        async def drive():
+            results = await asyncio.gather(
+                *(self.bot.send_draft_for_approval(rfq_id, "料號: Bar", "Hello", wait=True) for rfq_id in ("RFQ-1", "RFQ-2")),
+                return_exceptions=True)
+            self.bot._sender_task.cancel()
+            return results
+
+        failed, delivered = asyncio.run(drive())
+        self.assertIsInstance(failed, ConnectionError)
+        self.assertIsNone(delivered)
+        self.assertIn("ID: `RFQ-2`", self.sent[0][0])
+
+    def test_bad_entry_does_not_fail_whole_digest(self):
+        import asyncio
+        from telegram.error import BadRequest
+
+        async def strict(text, reply_markup=None):
+            if "RFQ-bad" in text:
+                raise BadRequest("Can't parse entities: can't find end of the entity starting at byte offset 42")
+            self.sent.append((text, reply_markup))
+        self.bot._deliver = strict
+
+        async def drive():
+            ids = ["RFQ-1", "RFQ-2", "RFQ-bad", "RFQ-3", "RFQ-4"]
+            results = await asyncio.gather(
+                *(self.bot.send_draft_for_approval(rfq_id, "料號: SUS_304*\n數量: 1", "Hello", wait=True) for rfq_id in ids),
+                return_exceptions=True)
+            self.bot._sender_task.cancel()
+            return dict(zip(ids, results))
+
+        results = asyncio.run(drive())
+        self.assertIsInstance(results.pop("RFQ-bad"), BadRequest)
+        self.assertEqual(set(results.values()), {None})
+        self.assertEqual(sorted(re.search(r"ID: `(RFQ-\d)`", text).group(1) for text, _ in self.sent),
+                         ["RFQ-1", "RFQ-2", "RFQ-3", "RFQ-4"])
+        self.assertIn("SUS\\_304\\*", self.sent[0][0])
+
+    def test_view_button_reloads_draft_after_restart(self):
+        self.bot.loader = lambda rfq_id: ("料號: Bar\n數量: 3 pcs", "Dear supplier") if rfq_id == "RFQ-7" else None
+        self._callback("view_RFQ-7", "📥 [RFQ 審核彙整] 共 2 筆")
+        self._callback("view_RFQ-8", "📥 [RFQ 審核彙整] 共 2 筆")
+
+        self.assertEqual(len(self.sent), 1)
+        self.assertIn("ID: `RFQ-7`", self.sent[0][0])
+        self.assertIn("Dear supplier", self.sent[0][0])
+
+    def test_pending_is_bounded(self):
+        from connectors import tg_bot
+        with patch.object(tg_bot, "PENDING_MAX", 3):
+            self._notify([(f"RFQ-{i}", "Hello") for i in range(5)])
+        self.assertEqual(list(self.bot.pending), ["RFQ-2", "RFQ-3", "RFQ-4"])
+        self.assertEqual(len(re.findall(r"`(RFQ-\d+)`", "".join(text for text, _ in self.sent))), 5)
+
+    def test_backlog_is_coalesced_into_digests(self):
+        enqueued = self._notify([(f"RFQ-{i}", "Hello") for i in range(25)])
+
+        self.assertLess(enqueued, 0.05)  # 呼叫端不等待送出
+        self.assertLess(len(self.sent), 6)
+        digests = [(text, markup) for text, markup in self.sent if "[RFQ 審核彙整]" in text]
+        self.assertTrue(digests)
+        listed = re.findall(r"`(RFQ-\d+)`", "".join(text for text, _ in self.sent))
+        self.assertEqual(sorted(set(listed)), sorted(f"RFQ-{i}" for i in range(25)))
+        text, markup = digests[0]
+        self.assertEqual(len(markup.inline_keyboard), text.count("`") // 2)
+        self.assertTrue(markup.inline_keyboard[0][0].callback_data.startswith("view_RFQ-"))
+
+    def test_small_batches_are_sent_individually(self):
+        self._notify([("RFQ-1", "Hello"), ("RFQ-2", "Hi")])
+
+        self.assertEqual(len(self.sent), 2)
+        self.assertIn("[RFQ 審核]", self.sent[0][0])
+        self.assertEqual(self.sent[1][1].inline_keyboard[0][0].callback_data, "send_RFQ-2")
+
+    def test_long_draft_is_split(self):
+        self._notify([("RFQ-1", "\n".join("line %d of the drawing notes" % i for i in range(400)))])
+
+        self.assertGreater(len(self.sent), 1)
+        self.assertTrue(all(len(text) <= 4096 and text.count("```") % 2 == 0 for text, _ in self.sent))
+        # 每段都帶標題與 ID：回覆任何一段都能修正草稿
+        self.assertTrue(all(text.startswith("📥 **[RFQ 審核]**\nID: `RFQ-1`") for text, _ in self.sent))
+        self.assertEqual([markup is not None for _, markup in self.sent], [False] * (len(self.sent) - 1) + [True])
+
+        import asyncio
+        update = MagicMock()
+        update.message.reply_to_message.text = self.sent[-1][0].replace("**", "").replace("`", "")
+        update.message.text = "交期改為兩週"
+        update.message.reply_text = MagicMock(side_effect=lambda *a, **k: asyncio.sleep(0))
+        asyncio.run(self.bot.handle_text_reply(update, None))
+        self.assertIn("目標: `RFQ-1`", update.message.reply_text.call_args[0][0])
+
+    def test_split_message_keeps_short_text(self):
+        self.assertEqual(split_message("short"), ["short"])
+        self.assertEqual([len(p) for p in split_message("y" * 2500, 1000)], [995, 995, 510])
+
+    def test_token_bucket_spaces_sends(self):
+        import asyncio
+        bucket = TokenBucket(rate_per_min=600, capacity=1)
+
+        async def drive():
+            for _ in range(4):
+                await bucket.acquire()
+        start = time.monotonic()
+        asyncio.run(drive())
+        self.assertGreaterEqual(time.monotonic() - start, 0.29)
+
+
+class TestAttachmentStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = AttachmentStore(os.path.join(self.tmp.name, "blobs"), max_bytes=1024)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _blobs(self):
+        return [f for _, _, files in os.walk(self.store.base_path) for f in files]
+
+    def test_identical_content_is_stored_once(self):
+        digest, path = self.store.put(b"same bytes")
+        digest2, path2 = self.store.put_stream([b"same ", b"bytes"])
+        self.assertEqual((digest, path), (digest2, path2))
+        self.assertEqual(os.path.basename(path), digest)
+        self.assertEqual(self.store.dedup_hits, 1)
+        self.assertEqual(len(self._blobs()), 1)
+
+    def test_concurrent_puts_count_every_dedup_hit(self):
+        from core.attachment_store import iter_chunks
+        store = AttachmentStore(os.path.join(self.tmp.name, "blobs"))
+        store.put(b"drawing")
+        threads = [threading.Thread(target=lambda: [store.put_stream(iter_chunks(b"drawing", 3)) for _ in range(200)]) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(store.dedup_hits, 1600)
+        self.assertEqual(len([f for _, _, files in os.walk(store.base_path) for f in files]), 1)
+
+    def test_size_cap(self):
+        with self.assertRaises(AttachmentTooLarge):
+            self.store.put(b"x" * 1025)
+        with self.assertRaises(AttachmentTooLarge):
+            self.store.put_stream(b"x" * 100 for _ in range(20))
+        self.assertEqual(self._blobs(), [])
+
+    def test_link_into_rfq_tree(self):
+        _, blob = self.store.put(b"drawing")
+        dest = self.store.link(blob, os.path.join(self.tmp.name, "RFQ-1", "1_原始需求", "a.pdf"))
+        self.assertTrue(os.path.samefile(blob, dest))
+        self.assertEqual(self.store.link(blob, dest), dest)
+
+
 class TestRFQSkill(unittest.TestCase):
     def setUp(self):
         # We don't want to actually hit the Gemini API in tests unless specified.
@@ -78,5 +746,273 @@ class TestRFQSkill(unittest.TestCase):
         self.assertIn("draft", result)
         self.assertEqual(result["items"][0]["material_type"], "Aluminum")
 
+    @patch('skills.rfq_parser.genai')
+    def test_identical_pdfs_are_uploaded_once(self, mock_genai):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for name in ("a.pdf", "b.pdf"):
+                paths.append(os.path.join(tmp, name))
+                with open(paths[-1], "wb") as f:
+                    f.write(b"%PDF same drawing")
+            self.assertIs(self.skill._upload(paths[0])[1], self.skill._upload(paths[1])[1])
+        self.assertEqual(mock_genai.upload_file.call_count, 1)
+
+    @patch('skills.rfq_parser.genai')
+    def test_expired_upload_in_use_is_not_deleted(self, mock_genai):
+        mock_genai.upload_file.side_effect = lambda path: MagicMock(name=path)
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for name in ("a.pdf", "b.pdf", "c.pdf"):
+                paths.append(os.path.join(tmp, name))
+                with open(paths[-1], "wb") as f:
+                    f.write(name.encode())
+            now = time.time()
+            digest, _ = self.skill._upload(paths[0])  # 請求仍在進行中
+            with patch('skills.rfq_parser.time.time', return_value=now + 25 * 3600):
+                self.skill._upload(paths[1])
+                mock_genai.delete_file.assert_not_called()
+                self.skill._release_uploads([digest])
+                self.skill._upload(paths[2])
+            self.assertEqual(mock_genai.delete_file.call_count, 1)
+            self.assertNotIn(digest, self.skill._uploads)
+
+    @patch('skills.rfq_parser.genai')
+    def test_concurrent_uploads_of_same_file_share_one_entry(self, mock_genai):
+        barrier = threading.Barrier(4)
+
+        def upload(path):
+            barrier.wait()  # 四個執行緒都未命中快取後才一起上傳
+            return MagicMock(name=path)
+
+        mock_genai.upload_file.side_effect = lambda path: upload(path)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "a.pdf")
+            with open(path, "wb") as f:
+                f.write(b"%PDF same drawing")
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(self.skill._upload(path))) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join(5)
+        self.assertEqual(len({id(file_obj) for _, file_obj in results}), 1)
+        self.assertEqual(mock_genai.delete_file.call_count, 3)
+        self.assertEqual(self.skill._in_use, {results[0][0]: 4})
+
+
+class _FakeSyncClient:
+    """只提供管線用到的 sync_new_rfqs / mark_processed"""
+    def __init__(self, count):
+        self.emails = [{"uid": str(uid), "subject": f"RFQ {uid}", "text": f"need part {uid}", "attachments": []} for uid in range(1, count + 1)]
+        self.labelled = []
+
+    def sync_new_rfqs(self, base_save_dir, state=None):
+        return self.emails, (7, len(self.emails))
+
+    def mark_processed(self, uids, label):
+        self.labelled.append(list(uids))
+
+
+class _SlowSkill:
+    def __init__(self, delay, fail_on=()):
+        self.delay = delay
+        self.fail_on = set(fail_on)
+        self.active = 0
+        self.peak = 0
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def parse_and_draft(self, text, attachments):
+        with self.lock:
+            self.calls += 1
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(self.delay)  # 模擬阻塞的 Gemini 呼叫
+        with self.lock:
+            self.active -= 1
+        if text in self.fail_on:
+            return {"items": [], "draft": "", "error": "503 overloaded"}  # 與 RFQSkill 失敗時的回傳相同
+        return {"items": [{"item_name": "Bar", "quantity": "1"}], "draft": "Hello"}
+
+
+class _FakeBot:
+    def __init__(self, fail_on=()):
+        self.sent = []
+        self.fail_on = set(fail_on)
+
+    async def send_draft_for_approval(self, rfq_id, summary, draft, wait=False):
+        if rfq_id in self.fail_on:
+            raise ConnectionError("Telegram unreachable")
+        self.sent.append(rfq_id)
+
+
+class TestRFQPipeline(unittest.TestCase):
+    def setUp(self):
+        from core.db_manager import DBManager
+        from core.file_manager import FileManager
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = DBManager(os.path.join(self.tmp.name, "agent.db"))
+        self.files = FileManager(os.path.join(self.tmp.name, "archives"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _run(self, client, skill, bot, **kwargs):
+        import asyncio
+        from agent_main import RFQPipeline
+        pipeline = RFQPipeline(client, skill, bot, temp_dir=self.tmp.name, store=self.store, files=self.files, **kwargs)
+        ticks = []
+
+        async def heartbeat():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def drive():
+            tasks = pipeline.start()
+            beat = asyncio.create_task(heartbeat())
+            try:
+                return await asyncio.wait_for(pipeline.run_once(), 10)  # worker 中止時 drained 永遠不會 set
+            finally:
+                for task in tasks + [beat]:
+                    task.cancel()
+                pipeline.executor.shutdown(wait=False)
+
+        start = time.monotonic()
+        count = asyncio.run(drive())
+        return count, time.monotonic() - start, ticks
+
+    def test_backlog_drains_in_parallel_without_blocking_loop(self):
+        client, skill, bot = _FakeSyncClient(50), _SlowSkill(0.1), _FakeBot()
+        count, elapsed, ticks = self._run(client, skill, bot)
+
+        self.assertEqual(count, 50)
+        self.assertEqual(skill.peak, 4)
+        self.assertLess(elapsed, 50 * 0.1 / 2)
+        self.assertLess(max(b - a for a, b in zip(ticks, ticks[1:])), 0.2)
+        self.assertEqual(sorted(bot.sent), sorted(f"RFQ-{uid}" for uid in range(1, 51)))
+        self.assertEqual(sorted(map(int, sum(client.labelled, []))), list(range(1, 51)))
+        self.assertLess(len(client.labelled), 50)  # 標籤更新有合併
+        self.assertEqual(self.store.get_mail_sync_state("INBOX"), (7, 50))
+        with self.store._get_connection() as conn:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM RFQ_History").fetchone()[0], 50)
+
+    def test_failed_gemini_call_is_retried_instead_of_pushed(self):
+        client, skill, bot = _FakeSyncClient(5), _SlowSkill(0, fail_on=["need part 3"]), _FakeBot()
+        self._run(client, skill, bot, retry_base=0)
+
+        self.assertEqual(sorted(bot.sent), ["RFQ-1", "RFQ-2", "RFQ-4", "RFQ-5"])
+        self.assertNotIn("3", sum(client.labelled, []))
+        job = self.store.get_rfq_job("3")
+        self.assertEqual((job["stage"], job["attempts"], job["last_error"]), ("parse", 1, "503 overloaded"))
+        self.assertEqual(self.store.get_mail_sync_state("INBOX"), (7, 5))
+
+        # 重試成功後才推送；同一批信再次同步到不會重新解析
+        skill.fail_on.clear()
+        count, _, _ = self._run(client, skill, bot, retry_base=0)
+        self.assertEqual(count, 1)
+        self.assertEqual(skill.calls, 6)
+        self.assertEqual(bot.sent[-1], "RFQ-3")
+        self.assertEqual(self.store.get_rfq_job("3")["stage"], "done")
+
+    def test_gives_up_after_max_attempts(self):
+        client, skill, bot = _FakeSyncClient(1), _SlowSkill(0, fail_on=["need part 1"]), _FakeBot()
+        for _ in range(3):
+            self._run(client, skill, bot, retry_base=0, max_attempts=2)
+
+        self.assertEqual(skill.calls, 2)
+        self.assertEqual(self.store.get_rfq_job("1")["stage"], "failed")
+        self.assertEqual(bot.sent, [])
+
+    def test_workers_survive_errors_while_recording_failures(self):
+        client, skill, bot = _FakeSyncClient(3), _SlowSkill(0, fail_on=["need part 1"]), _FakeBot()
+        advance = self.store.advance_rfq_job
+
+        def advance_or_fail(uid, stage, payload):
+            if uid == "2" and stage == "done":
+                raise sqlite3.OperationalError("database is locked")
+            return advance(uid, stage, payload)
+
+        with patch.object(self.store, "fail_rfq_job", side_effect=sqlite3.OperationalError("disk I/O error")), \
+                patch.object(self.store, "advance_rfq_job", side_effect=advance_or_fail):
+            count, _, _ = self._run(client, skill, bot, concurrency={"parse": 1})
+
+        # 單一 parse worker 在記錄失敗出錯後仍繼續處理；label 階段寫回失敗不影響同批其他信
+        self.assertEqual(count, 3)
+        self.assertEqual(sorted(bot.sent), ["RFQ-2", "RFQ-3"])
+        self.assertEqual([job["stage"] for job in map(self.store.get_rfq_job, "123")], ["parse", "label", "done"])
+
+    def test_sync_mark_stops_before_mail_that_failed_to_enqueue(self):
+        client, skill, bot = _FakeSyncClient(4), _SlowSkill(0), _FakeBot()
+        enqueue = self.store.enqueue_rfq_job
+
+        def enqueue_or_fail(uid, payload, stage="parse"):
+            # 與 DB 錯誤時相同：記 log 並回傳 None
+            return None if uid == "3" else enqueue(uid, payload, stage)
+
+        with patch.object(self.store, "enqueue_rfq_job", side_effect=enqueue_or_fail):
+            self._run(client, skill, bot)
+        self.assertEqual(self.store.get_mail_sync_state("INBOX"), (7, 2))
+        self.assertIsNone(self.store.get_rfq_job("3"))
+
+        # 下一輪重新同步到 UID 3；已完成的 1、2、4 不會重跑
+        self._run(client, skill, bot)
+        self.assertEqual(self.store.get_mail_sync_state("INBOX"), (7, 4))
+        self.assertEqual(sorted(bot.sent), ["RFQ-1", "RFQ-2", "RFQ-3", "RFQ-4"])
+        self.assertEqual(skill.calls, 4)
+
+    def test_unrecorded_stage_is_retried_instead_of_passed_on(self):
+        client, skill, bot = _FakeSyncClient(2), _SlowSkill(0), _FakeBot()
+        advance = self.store.advance_rfq_job
+
+        def advance_or_refuse(uid, stage, payload):
+            # 與 DB 錯誤時相同：記 log 並回傳 False
+            return False if (uid, stage) == ("1", "notify") else advance(uid, stage, payload)
+
+        with patch.object(self.store, "advance_rfq_job", side_effect=advance_or_refuse):
+            self._run(client, skill, bot, retry_base=0)
+
+        self.assertEqual(bot.sent, ["RFQ-2"])
+        job = self.store.get_rfq_job("1")
+        self.assertEqual((job["stage"], job["attempts"]), ("persist", 1))
+
+    def test_failed_notification_is_retried(self):
+        client, skill, bot = _FakeSyncClient(2), _SlowSkill(0), _FakeBot(fail_on=["RFQ-1"])
+        self._run(client, skill, bot, retry_base=0)
+
+        self.assertEqual(bot.sent, ["RFQ-2"])
+        self.assertEqual(client.labelled, [["2"]])
+        job = self.store.get_rfq_job("1")
+        self.assertEqual((job["stage"], job["attempts"], job["last_error"]), ("notify", 1, "Telegram unreachable"))
+
+        bot.fail_on.clear()
+        self._run(client, skill, bot, retry_base=0)
+        self.assertEqual(bot.sent, ["RFQ-2", "RFQ-1"])
+        self.assertEqual(skill.calls, 2)
+        self.assertEqual(self.store.get_rfq_job("1")["stage"], "done")
+
+    def test_pending_approval_is_reloaded_from_history(self):
+        from agent_main import load_pending_approval
+        parsed = {"items": [{"item_name": "Bar", "quantity": "3 pcs"}], "draft": "Hello"}
+        self.store.save_rfq_record("RFQ-9", "need part 9", parsed, status="PENDING")
+        self.store.save_rfq_record("RFQ-10", "need part 10", parsed, status="SENT")
+
+        self.assertEqual(load_pending_approval("RFQ-9", self.store), ("料號: Bar\n數量: 3 pcs", "Hello"))
+        self.assertIsNone(load_pending_approval("RFQ-10", self.store))
+        self.assertIsNone(load_pending_approval("RFQ-404", self.store))
+
+    def test_resumes_half_finished_job_without_reparsing(self):
+        # 模擬上次在 persist 之後、通知之前當機
+        parsed = {"items": [{"item_name": "Bar", "quantity": "3 pcs"}], "draft": "Hello"}
+        mail = {"uid": "9", "subject": "RFQ 9", "text": "need part 9", "attachments": []}
+        self.store.enqueue_rfq_job("9", {"mail": mail, "rfq_id": "RFQ-9", "parsed": parsed, "item_name": "Bar"}, stage="notify")
+        client, skill, bot = _FakeSyncClient(0), _SlowSkill(0), _FakeBot()
+
+        self.assertEqual(self._run(client, skill, bot)[0], 1)
+        self.assertEqual(skill.calls, 0)
+        self.assertEqual(bot.sent, ["RFQ-9"])
+        self.assertEqual(client.labelled, [["9"]])
+        self.assertEqual(self.store.get_rfq_job("9")["stage"], "done")
+
 if __name__ == "__main__":
     unittest.main()
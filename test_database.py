@@ -0,0 +1,292 @@
+import unittest
+import json
+import os
+import threading
+import time
+
+import database
+
+
+class TestSupplierSearch(unittest.TestCase):
+    def setUp(self):
+        database.DB_NAME = ":memory:"
+        database.init_db()
+
+    def tearDown(self):
+        database.close_connections()
+
+    def _add(self, name, materials, forms, quals):
+        return database.add_supplier(name, "", "", "", "", json.dumps(materials), json.dumps(forms), json.dumps(quals))
+
+    def test_search_by_material_and_qualification(self):
+        a = self._add("A", ["Aluminum"], ["Bar"], ["ISO"])
+        b = self._add("B", ["Aluminum", "Copper"], ["Plate"], ["ISO", "Aerospace"])
+        self._add("C", ["Copper"], ["Bar"], ["Aerospace"])
+
+        rows = database.search_suppliers(["Aluminum"], [])
+        self.assertEqual([r[0] for r in rows], [a, b])
+
+        rows = database.search_suppliers(["Aluminum"], [], ["Aerospace"])
+        self.assertEqual([r[0] for r in rows], [b])
+
+        self.assertEqual(database.search_suppliers([], []), [])
+
+    def test_index_follows_update_and_delete(self):
+        a = self._add("A", ["Aluminum"], ["Bar"], ["ISO"])
+        self.assertEqual(len(database.search_suppliers(["Aluminum"], [])), 1)
+
+        database.update_supplier(a, "A2", "", "", "", "", json.dumps(["Copper"]), json.dumps(["Bar"]), json.dumps(["ISO"]))
+        self.assertEqual(database.search_suppliers(["Aluminum"], []), [])
+        self.assertEqual(database.search_suppliers(["Copper"], [])[0][1], "A2")
+
+        database.delete_supplier(a)
+        self.assertEqual(database.search_suppliers(["Copper"], ["Bar"]), [])
+
+    def test_keyset_pages(self):
+        ids = [self._add(f"S{i}", ["Aluminum"], [], []) for i in range(5)]
+
+        first = database.get_suppliers_page(limit=2)
+        self.assertEqual([r[0] for r in first], ids[:2])
+        second = database.get_suppliers_page(after_id=first[-1][0], limit=2)
+        self.assertEqual([r[0] for r in second], ids[2:4])
+        self.assertEqual([r[0] for r in database.get_suppliers_page(before_id=second[0][0], limit=2)], ids[:2])
+        self.assertEqual(database.count_suppliers(), 5)
+
+        caps = database.get_supplier_capabilities([ids[0], ids[1]])
+        self.assertEqual(set(caps), {ids[0], ids[1]})
+        self.assertEqual(database.get_supplier(ids[4])[1], "S4")
+        self.assertEqual([r[1] for r in database.get_suppliers_by_ids([ids[3], 999999, ids[0]])], ["S3", "S0"])
+        self.assertEqual(database.get_suppliers_by_ids([]), [])
+
+
+    def test_index_updates_publish_new_snapshot(self):
+        a = self._add("A", ["Aluminum"], ["Bar"], ["ISO"])
+        snapshot = database.get_capability_index()
+        b = self._add("B", ["Aluminum"], [], [])
+        database.delete_supplier(a)
+
+        self.assertEqual(set(snapshot.rows), {a})  # 已取得的索引不會在迭代中被修改
+        self.assertEqual(set(database.get_capability_index().rows), {b})
+        self.assertEqual([r[0] for r in database.search_suppliers(["Aluminum"], [])], [b])
+
+    def test_snapshot_copy_only_touches_changed_bucket(self):
+        rows = [(i, f"S{i}") for i in range(1, 5001)]
+        caps = {i: {"materials": ["Aluminum" if i % 2 else "Copper"], "forms": ["Bar"], "qualifications": []} for i in range(1, 5001)}
+        old = database.SupplierCapabilityIndex.build(rows, caps)
+        new = old.copy()
+        new.add((7, "S7 v2"), ["Copper"], [], [])
+
+        self.assertEqual(old.rows[7], (7, "S7"))
+        self.assertEqual(new.rows[7], (7, "S7 v2"))
+        self.assertEqual((len(old.rows), len(new.rows)), (5000, 5000))
+        # 只有 id 7 所在的 bucket 被複製，其餘與舊快照共用
+        shared = [n for n in old.rows._buckets if old.rows._buckets[n] is new.rows._buckets[n]]
+        self.assertEqual(sorted(set(old.rows._buckets) - set(shared)), [0])
+        self.assertTrue(old.match(["Aluminum"], []) >> 7 & 1)
+        self.assertFalse(new.match(["Aluminum"], []) >> 7 & 1)
+        self.assertFalse(new.match([], ["Bar"]) >> 7 & 1)
+        self.assertTrue(new.match(["Copper"], []) >> 7 & 1)
+        new.remove(7)
+        self.assertNotIn(7, new.rows)
+        self.assertIn(7, old.rows)
+
+class TestRFQPersistence(unittest.TestCase):
+    def setUp(self):
+        database.DB_NAME = ":memory:"
+        database.init_db()
+
+    def tearDown(self):
+        database.close_connections()
+
+    def test_save_rfq_analysis_writes_request_and_items(self):
+        items = [{"material_type": "Aluminum", "form": "Bar"}, {"material_type": "Copper", "form": "Sheet"}]
+        req_id, item_ids = database.save_rfq_analysis("raw", items, [[1, 2], []])
+
+        self.assertEqual(len(item_ids), 2)
+        conn = database.get_connection()
+        self.assertEqual(conn.execute("SELECT raw_text FROM rfq_requests WHERE id = ?", (req_id,)).fetchone()[0], "raw")
+        rows = conn.execute("SELECT id, item_index, material_type, matched_suppliers FROM rfq_items WHERE request_id = ? ORDER BY item_index", (req_id,)).fetchall()
+        self.assertEqual([r[0] for r in rows], item_ids)
+        self.assertEqual([(r[1], r[2], json.loads(r[3])) for r in rows], [(0, "Aluminum", [1, 2]), (1, "Copper", [])])
+
+    def test_save_rfq_analysis_rejects_mismatched_matches(self):
+        with self.assertRaises(ValueError):
+            database.save_rfq_analysis("raw", [{"material_type": "Aluminum"}, {"material_type": "Copper"}], [[1]])
+        conn = database.get_connection()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM rfq_requests").fetchone()[0], 0)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM rfq_items").fetchone()[0], 0)
+
+    def test_history_keyset_pages_and_filters(self):
+        ids = []
+        for i in range(7):
+            material = "Titanium" if i % 3 == 0 else "Aluminum"
+            ids.append(database.save_rfq_analysis(f"rfq {i}", [{"material_type": material}, {"material_type": "Copper"}], [[], []])[0])
+        conn = database.get_connection()
+        conn.execute("UPDATE rfq_requests SET created_at = '2023-05-01 08:00:00' WHERE id <= ?", (ids[2],))
+        conn.execute("UPDATE rfq_requests SET status = 'Sent' WHERE id = ?", (ids[4],))
+        conn.commit()
+
+        first = database.get_rfq_history_page(limit=3)
+        second = database.get_rfq_history_page(before_id=first[-1][0], limit=3)
+        self.assertEqual([r[0] for r in first + second], ids[::-1][:6])
+        self.assertEqual(first[0][3:], ("rfq 6", 2))
+
+        self.assertEqual([r[0] for r in database.get_rfq_history_page(material_type="Titanium")], [ids[6], ids[3], ids[0]])
+        self.assertEqual([r[0] for r in database.get_rfq_history_page(material_type="Titanium", before_id=ids[3])], [ids[0]])
+        self.assertEqual([r[0] for r in database.get_rfq_history_page(status="Sent")], [ids[4]])
+        self.assertEqual([r[0] for r in database.get_rfq_history_page(date_from="2023-05-01", date_to="2023-05-01")], ids[2::-1])
+        self.assertEqual([r[0] for r in database.get_rfq_history_page(date_to="2023-04-30")], [])
+        self.assertEqual(database.get_rfq_statuses(), ["Analyzed", "Sent"])
+        self.assertEqual([(r[1], r[2]) for r in database.get_rfq_items(ids[3])], [(0, "Titanium"), (1, "Copper")])
+
+
+    @unittest.skipUnless(hasattr(time, "tzset"), "needs time.tzset")
+    def test_history_date_filter_uses_local_days(self):
+        old_tz = os.environ.get("TZ")
+        os.environ["TZ"] = "Asia/Taipei"
+        time.tzset()
+        try:
+            a = database.save_rfq_analysis("late", [], [])[0]
+            b = database.save_rfq_analysis("early", [], [])[0]
+            conn = database.get_connection()
+            # UTC 5/1 20:00 是台灣 5/2 04:00；id 較小的反而較晚建立
+            conn.execute("UPDATE rfq_requests SET created_at = '2023-05-01 20:00:00' WHERE id = ?", (a,))
+            conn.execute("UPDATE rfq_requests SET created_at = '2023-05-01 10:00:00' WHERE id = ?", (b,))
+            conn.commit()
+
+            self.assertEqual([r[0] for r in database.get_rfq_history_page(date_from="2023-05-01", date_to="2023-05-01")], [b])
+            self.assertEqual([r[0] for r in database.get_rfq_history_page(date_from="2023-05-02")], [a])
+        finally:
+            if old_tz is None:
+                os.environ.pop("TZ", None)
+            else:
+                os.environ["TZ"] = old_tz
+            time.tzset()
+
+class TestFullTextSearch(unittest.TestCase):
+    def setUp(self):
+        database.DB_NAME = ":memory:"
+        database.init_db()
+
+    def tearDown(self):
+        database.close_connections()
+
+    def test_supplier_search_follows_triggers(self):
+        a = database.add_supplier("大同金屬工業", "王小明", "sales@tatung.example", "", "台中市", "[]", "[]", "[]")
+        database.add_supplier("Alu Works", "Amy", "amy@alu.example", "", "Taipei", "[]", "[]", "[]")
+
+        self.assertEqual([r[0] for r in database.search_suppliers_text("金屬工業")], [a])
+        self.assertEqual([r[1] for r in database.search_suppliers_text("alu")], ["Alu Works"])
+        self.assertEqual([r[0] for r in database.search_suppliers_text("王")], [a])
+
+        database.update_supplier(a, "大同精密", "", "", "", "", "[]", "[]", "[]")
+        self.assertEqual(database.search_suppliers_text("金屬工業"), [])
+        database.delete_supplier(a)
+        self.assertEqual(database.search_suppliers_text("大同精密"), [])
+
+    def test_rfq_history_search_covers_raw_text_and_items(self):
+        r1, _ = database.save_rfq_analysis("Please quote urgent", [{"material_spec": "SUS316L", "dimensions": "Ø50 x 1000"}], [[]])
+        r2, _ = database.save_rfq_analysis("SUS316L bar, 航太件", [{"material_spec": "6061-T6"}], [[]])
+
+        self.assertEqual({r[0] for r in database.search_rfq_history("SUS316L")}, {r1, r2})
+        self.assertEqual([r[0] for r in database.search_rfq_history("6061")], [r2])
+        self.assertEqual([r[0] for r in database.search_rfq_history("航太")], [r2])
+        self.assertEqual(database.search_rfq_history('"unbalanced'), [])
+        self.assertEqual(database.search_rfq_history("   "), [])
+
+
+class TestParseCache(unittest.TestCase):
+    def setUp(self):
+        database.DB_NAME = ":memory:"
+        database.init_db()
+
+    def tearDown(self):
+        database.close_connections()
+
+    def test_lru_eviction_keeps_recently_used(self):
+        database.put_cached_parse("a", "v1", '{"items": [1]}', max_entries=2)
+        database.put_cached_parse("b", "v1", '{"items": [2]}', max_entries=2)
+        self.assertEqual(database.get_cached_parse("a"), '{"items": [1]}')
+        database.put_cached_parse("c", "v1", '{"items": [3]}', max_entries=2)
+
+        self.assertIsNone(database.get_cached_parse("b"))
+        self.assertIsNotNone(database.get_cached_parse("a"))
+        self.assertEqual(database.count_parse_cache(), 2)
+
+    def test_purge_other_prompt_versions(self):
+        database.put_cached_parse("a", "v1", "{}")
+        database.put_cached_parse("b", "v2", "{}")
+        self.assertEqual(database.purge_parse_cache("v2"), 1)
+        self.assertIsNone(database.get_cached_parse("a"))
+        self.assertEqual(database.purge_parse_cache(), 1)
+
+
+class TestCapabilityMigration(unittest.TestCase):
+    def setUp(self):
+        database.DB_NAME = ":memory:"
+
+    def tearDown(self):
+        database.close_connections()
+
+    def test_legacy_json_columns_are_migrated_once(self):
+        conn = database.get_connection()
+        conn.execute("CREATE TABLE suppliers (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, contact_person TEXT, email TEXT, "
+                     "phone TEXT, address TEXT, materials TEXT, forms TEXT, qualifications TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+        conn.execute("INSERT INTO suppliers (name, materials, forms, qualifications) VALUES (?, ?, ?, ?)",
+                     ("Legacy", json.dumps(["Copper", "Aluminum"]), json.dumps(["Bar"]), json.dumps(["ISO"])))
+        conn.commit()
+
+        database.init_db()
+        database.init_db()
+
+        caps = database.get_supplier_capabilities()
+        self.assertEqual(caps[1], {"materials": ["Copper", "Aluminum"], "forms": ["Bar"], "qualifications": ["ISO"]})
+        self.assertEqual(json.loads(database.get_suppliers()[0][6]), ["Copper", "Aluminum"])
+        self.assertEqual(len(database.search_suppliers(["Aluminum"], [], ["ISO"])), 1)
+
+
+class TestConnectionManager(unittest.TestCase):
+    def setUp(self):
+        database.DB_NAME = ":memory:"
+        database.init_db()
+
+    def tearDown(self):
+        database.close_connections()
+
+    def test_memory_transactions_are_not_joined_across_threads(self):
+        entered, release = threading.Event(), threading.Event()
+
+        def failing():
+            try:
+                with database.transaction() as cursor:
+                    cursor.execute("INSERT INTO suppliers (name) VALUES ('rolled back')")
+                    entered.set()
+                    release.wait(2)
+                    raise RuntimeError("boom")
+            except RuntimeError:
+                pass
+
+        first = threading.Thread(target=failing)
+        first.start()
+        entered.wait(2)
+        second = threading.Thread(target=lambda: database.add_supplier("kept", "", "", "", "", "[]", "[]", "[]"))
+        second.start()
+        time.sleep(0.1)
+        release.set()
+        first.join()
+        second.join()
+
+        self.assertEqual([r[1] for r in database.get_suppliers()], ["kept"])
+
+    def test_nested_transaction_joins_outer(self):
+        with self.assertRaises(RuntimeError):
+            with database.transaction() as cursor:
+                cursor.execute("INSERT INTO suppliers (name) VALUES ('outer')")
+                with database.transaction() as inner:
+                    inner.execute("INSERT INTO suppliers (name) VALUES ('inner')")
+                raise RuntimeError("boom")
+        self.assertEqual(database.get_suppliers(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import email
+import os
+import tempfile
+import unittest
+from email import policy
+
+import drafts
+
+
+class TestDrafts(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.items = [{"material_type": "Aluminum", "material_spec": "6061-T6", "form": "Bar", "dimensions": "Ø50 x 1000",
+                       "quantity": "10 pcs", "moq": "", "notes": "<urgent>", "qual": "ISO"}]
+        self.suppliers = [(i, f"Supplier {i}", "Amy", f"s{i}@example.com") for i in range(1, 31)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_eml_sink_writes_one_message_per_supplier(self):
+        template = (1, "T", "Inquiry {date}", "<p>Hi,</p>", "<p>Thanks</p>", "", "", "", "", "", "", "buyer@example.com", 0)
+        batch = drafts.build_drafts(template, self.suppliers, self.items, "Aluminum", "Drawings attached")
+        written, failed = drafts.write_drafts(batch, drafts.EmlSink(self.tmp.name))
+
+        self.assertEqual(failed, [])
+        self.assertEqual(len(written), 30)
+        self.assertEqual(len(os.listdir(self.tmp.name)), 30)
+        with open(written[4], "rb") as f:
+            msg = email.message_from_binary_file(f, policy=policy.default)
+        self.assertEqual(msg["To"], "s5@example.com")
+        self.assertEqual(msg["Cc"], "buyer@example.com")
+        self.assertTrue(msg["Subject"].startswith("Inquiry ") and msg["Subject"].endswith("_Supplier 5"))
+        body = msg.get_body(("html",)).get_content()
+        self.assertIn("6061-T6", body)
+        self.assertIn("&lt;urgent&gt;", body)
+        self.assertIn("Drawings attached", body)
+
+    def test_default_subject_and_compiled_once(self):
+        template = (2, "T", "", "", "", "", "", "", "", "", "", "", 1)
+        batch = drafts.build_drafts(template, self.suppliers[:2], self.items, "Aluminum")
+        self.assertRegex(batch[0].subject, r"^RFQ\d{8}_Aluminum_Supplier 1$")
+        self.assertIs(batch[0].html, batch[1].html)
+        self.assertIs(drafts.compile_template(template), drafts.compile_template(list(template)))
+
+    def test_failures_are_reported_per_draft(self):
+        class FlakySink:
+            thread_safe = False
+
+            def write(self, draft):
+                if draft.supplier_id == 2:
+                    raise OSError("disk full")
+                return draft.to
+
+        batch = drafts.build_drafts(drafts.DEFAULT_TEMPLATE, self.suppliers[:3], self.items, "Aluminum")
+        written, failed = drafts.write_drafts(batch, FlakySink())
+        self.assertEqual(written, ["s1@example.com", "s3@example.com"])
+        self.assertEqual([d.supplier_id for d, _ in failed], [2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import threading
+import unittest
+from email.utils import formatdate
+import time
+
+from core.llm_gateway import LLMGateway, FakeProvider, LLMResponse, RetryableError, LLMGatewayError, parse_retry_after
+
+
+class TestLLMGateway(unittest.TestCase):
+    def setUp(self):
+        self.waits = []
+        self.gateway = LLMGateway(max_retries=2, sleep=self.waits.append)
+
+    def test_retry_after_is_honoured(self):
+        fake = FakeProvider([RetryableError("HTTP 429", retry_after=7), "ok"])
+        self.gateway.register("fake", fake)
+
+        response = self.gateway.call("site", "fake", {"prompt": "x"})
+
+        self.assertEqual(response.text, "ok")
+        self.assertEqual(self.waits, [7])
+        self.assertEqual(len(fake.requests), 2)
+        stats = self.gateway.stats()["site"]
+        self.assertEqual((stats["calls"], stats["retries"], stats["errors"]), (1, 1, 0))
+
+    def test_retries_exhausted(self):
+        self.gateway.register("fake", FakeProvider([RetryableError("HTTP 503")] * 3))
+        with self.assertRaises(LLMGatewayError):
+            self.gateway.call("site", "fake", {})
+        self.assertEqual(len(self.waits), 2)
+        self.assertEqual(self.gateway.stats()["site"]["errors"], 1)
+
+    def test_non_retryable_errors_propagate(self):
+        self.gateway.register("fake", FakeProvider([ValueError("bad request")]))
+        with self.assertRaises(ValueError):
+            self.gateway.call("site", "fake", {})
+        self.assertEqual(self.waits, [])
+
+    def test_concurrency_limit_per_provider(self):
+        lock = threading.Lock()
+        state = {"active": 0, "peak": 0}
+
+        def step(request):
+            with lock:
+                state["active"] += 1
+                state["peak"] = max(state["peak"], state["active"])
+            time.sleep(0.02)
+            with lock:
+                state["active"] -= 1
+            return "ok"
+
+        self.gateway.register("fake", FakeProvider([step] * 8), max_concurrency=2)
+        threads = [threading.Thread(target=self.gateway.call, args=("site", "fake", {})) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(state["peak"], 2)
+        self.assertEqual(self.gateway.stats()["site"]["calls"], 8)
+
+    def test_tokens_and_histogram_per_call_site(self):
+        self.gateway.register("fake", FakeProvider([
+            LLMResponse("a", prompt_tokens=100, completion_tokens=20, cached_tokens=64),
+            LLMResponse("b", prompt_tokens=50, completion_tokens=10),
+            "c",
+        ]))
+        self.gateway.call("analyzer", "fake", {})
+        self.gateway.call("analyzer", "fake", {})
+        self.gateway.call("agent", "fake", {})
+
+        stats = self.gateway.stats()
+        self.assertEqual(set(stats), {"analyzer", "agent"})
+        self.assertEqual((stats["analyzer"]["prompt_tokens"], stats["analyzer"]["completion_tokens"]), (150, 30))
+        self.assertEqual(stats["analyzer"]["cached_tokens"], 64)
+        self.assertEqual(stats["analyzer"]["uncached_prompt_tokens"], 86)
+        self.assertEqual(sum(stats["analyzer"]["latency_histogram"].values()), 2)
+        self.assertEqual(stats["analyzer"]["latency_histogram"]["<=0.25s"], 2)
+
+    def test_stream(self):
+        self.gateway.register("fake", FakeProvider(['{"items": [' + '{"a": 1},' * 10 + '{"a": 2}]}']))
+        text = "".join(self.gateway.stream("site", "fake", {}))
+        self.assertTrue(text.endswith('{"a": 2}]}'))
+        self.assertEqual(self.gateway.stats()["site"]["calls"], 1)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after({"retry-after-ms": "1500"}), 1.5)
+        self.assertEqual(parse_retry_after({"Retry-After": "3"}), 3.0)
+        self.assertAlmostEqual(parse_retry_after({"Retry-After": formatdate(time.time() + 10, usegmt=True)}), 10, delta=1.5)
+        self.assertIsNone(parse_retry_after({}))
+
+
+
+class TestBatchRetry(unittest.TestCase):
+    def test_rate_limit_waits_retry_after_and_refunds_tokens(self):
+        import asyncio
+        from unittest.mock import MagicMock, patch
+        import httpx
+        import openai
+        import analyzer
+
+        request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+        rate_limited = openai.RateLimitError(
+            "rate limited", response=httpx.Response(429, headers={"retry-after-ms": "1500"}, request=request), body=None)
+        outcomes = iter([rate_limited, RuntimeError("stop")])
+
+        async def create(**kwargs):
+            raise next(outcomes)
+
+        client = MagicMock()
+        client.chat.completions.create = create
+        limiter = analyzer.TokenBucketLimiter(500, 30000)
+        waits = []
+
+        async def fake_sleep(seconds):
+            waits.append(seconds)
+
+        async def drive():
+            with patch.object(analyzer.asyncio, "sleep", fake_sleep):
+                return await analyzer._analyze_with_llm_async(client, limiter, "SUS304 D20x100 5pcs", "#0")
+
+        self.assertEqual(asyncio.run(drive()), {"items": []})
+        self.assertEqual(waits, [1.5])
+        # 429 的請求退還預扣額度：只剩第二次請求的預估 token 被扣
+        estimate = analyzer._estimate_tokens(analyzer._build_messages("SUS304 D20x100 5pcs"))
+        self.assertAlmostEqual(limiter.levels["tokens"], 30000 - estimate, delta=50)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import unittest
+
+import rfq_rules
+from rfq_validator import iter_rfq_errors
+
+
+class TestRFQRules(unittest.TestCase):
+    def test_common_line_patterns(self):
+        text = (
+            "Hi,\n"
+            "Please quote, IATF 16949 required:\n"
+            "1. SUS316L Ø50 x 1000 10 pcs\n"
+            "2. 6061-T6 100 x 200 x 5mm 20pcs\n"
+            "3. OD 50 x ID 40 x 2000 C3604 tube 3支\n"
+            "4. SS400 plate t=25 300x400 2 pcs\n"
+            "Thanks\n"
+        )
+        result = rfq_rules.parse_rfq(text)
+
+        self.assertEqual(result["unparsed"], [])
+        summary = [(i["material_type"], i["material_spec"], i["form"], i["dimensions"], i["quantity"]) for i in result["items"]]
+        self.assertEqual(summary, [
+            ("Stainless Steel", "SUS316L", "Bar", "Ø50 x 1000", "10 pcs"),
+            ("Aluminum", "6061-T6", "Sheet", "100 x 200 x 5mm", "20 pcs"),
+            ("Copper", "C3604", "Tube", "OD 50 x ID 40 x 2000", "3 pcs"),
+            ("Carbon Steel", "SS400", "Plate", "t=25 300x400", "2 pcs"),
+        ])
+        for item in result["items"]:
+            self.assertEqual(item["qualification"], "Automotive")
+        self.assertEqual(iter_rfq_errors({"items": result["items"]}), [])
+
+    def test_material_header_applies_to_following_lines(self):
+        result = rfq_rules.parse_rfq("材質: SKD11\n80 x 120 x 30 5 塊\n")
+        self.assertEqual(result["items"][0]["material_type"], "Tool Steel")
+        self.assertEqual(result["items"][0]["form"], "Plate")
+        self.assertEqual(result["context"], ["材質: SKD11"])
+
+    def test_uncertain_lines_are_left_for_llm(self):
+        result = rfq_rules.parse_rfq("SUS304 Ø20 x 300 5 pcs\nsome special part 5 pcs\n交期 2024/06/30\n")
+        self.assertEqual(len(result["items"]), 1)
+        self.assertEqual(result["unparsed"], ["some special part 5 pcs"])
+
+    def test_dates_are_not_grades(self):
+        item, material = rfq_rules.parse_line("need by 2024/06/30 Ø50 x 100 2 pcs")
+        self.assertIsNone(item)
+        self.assertIsNone(material)
+
+    def test_grade_is_preferred_over_material_family(self):
+        item, _ = rfq_rules.parse_line("不鏽鋼 SUS304 Ø50x100 10支")
+        self.assertEqual((item["material_spec"], item["dimensions"], item["quantity"], item["notes"]), ("SUS304", "Ø50x100", "10 pcs", ""))
+
+        item, _ = rfq_rules.parse_line("鋁 6061 板材 100 x 200 x 20 5 片")
+        self.assertEqual((item["material_type"], item["material_spec"], item["form"]), ("Aluminum", "6061", "Plate"))
+
+        item, _ = rfq_rules.parse_line("SUS304 / SUS316L Ø20 x 300 5 pcs")
+        self.assertEqual(item["material_spec"], "SUS304")
+        self.assertIn("SUS316L", item["notes"])
+
+    def test_length_after_space_stays_in_dimensions(self):
+        item, _ = rfq_rules.parse_line("SKD11 D30 L=200 3 支")
+        self.assertEqual((item["dimensions"], item["form"], item["quantity"], item["notes"]), ("D30 L=200", "Bar", "3 pcs", ""))
+
+    def test_rule_and_llm_items_keep_line_order(self):
+        import analyzer
+        text = "SUS304 Ø20 x 300 5 pcs\nspecial bracket 2 pcs\n6061 100 x 200 x 20 4 pcs\n"
+        done, plan = analyzer._plan_analysis(text, lambda message: None, use_cache=False)
+        self.assertIsNone(done)
+        result = analyzer._finish_analysis(plan, {"items": [{"material_type": "Other", "notes": "bracket"}]})
+        self.assertEqual([i["material_type"] for i in result["items"]], ["Stainless Steel", "Other", "Aluminum"])
+
+
+if __name__ == "__main__":
+    unittest.main()
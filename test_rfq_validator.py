@@ -0,0 +1,66 @@
+import unittest
+
+from rfq_validator import build_validator, iter_rfq_errors, validate_rfq, RFQValidationError
+
+
+def _item(**overrides):
+    item = {
+        "material_type": "Stainless Steel",
+        "material_spec": "316L",
+        "form": "Bar",
+        "dimensions": "Ø50 x 1000",
+        "quantity": "10 pcs",
+        "qualification": "ISO",
+        "notes": "",
+    }
+    item.update(overrides)
+    return item
+
+
+class TestRFQValidator(unittest.TestCase):
+    def test_valid_payload(self):
+        payload = {"items": [_item(), _item(form="Plate")]}
+        self.assertEqual(iter_rfq_errors(payload), [])
+        self.assertIs(validate_rfq(payload), payload)
+
+    def test_collects_every_item_error_in_one_pass(self):
+        payload = {"items": [_item(), _item(quantity="2000"), _item(form="Wire", extra=1)]}
+        with self.assertRaises(RFQValidationError) as ctx:
+            validate_rfq(payload)
+
+        paths = [path for path, _ in ctx.exception.errors]
+        self.assertEqual(paths, ["items[1].quantity", "items[2].form", "items[2]"])
+        self.assertIn("items[1].quantity", ctx.exception.message)
+
+    def test_root_errors(self):
+        self.assertEqual(iter_rfq_errors({"items": []}), [("items", "[] should be non-empty")])
+        self.assertEqual(iter_rfq_errors([]), [("", "[] is not of type 'object'")])
+        missing = _item()
+        del missing["notes"]
+        self.assertEqual(iter_rfq_errors({"items": [missing]}), [("items[0]", "'notes' is a required property")])
+
+    def test_non_string_values_report_type_only(self):
+        errors = iter_rfq_errors({"items": [_item(quantity=2000)]})
+        self.assertEqual(errors, [("items[0].quantity", "2000 is not of type 'string'")])
+
+    def test_custom_schema(self):
+        check = build_validator({"type": "object", "properties": {"n": {"type": "integer"}}})
+        self.assertEqual(check({"n": 1}), [])
+        self.assertEqual(len(check({"n": True})), 1)
+
+    def test_fallback_paths_match_compiled_paths(self):
+        # minimum 不在支援清單內，整份 schema 改用 jsonschema
+        schema = {"type": "object", "properties": {"items": {"type": "array", "items": {
+            "type": "object", "properties": {"quantity": {"type": "string"}, "qty": {"type": "integer", "minimum": 1}}}}}}
+        check = build_validator(schema)
+        self.assertEqual(check({"items": [{"quantity": "1"}, {"quantity": 2, "qty": 0}]}),
+                         [("items[1].quantity", "2 is not of type 'string'"), ("items[1].qty", "0 is less than the minimum of 1")])
+
+    def test_unsupported_type_forms_use_fallback(self):
+        check = build_validator({"type": "object", "properties": {"note": {"type": ["string", "null"]}, "gone": {"type": "null"}}})
+        self.assertEqual(check({"note": None, "gone": None}), [])
+        self.assertEqual([path for path, _ in check({"note": 1, "gone": "x"})], ["note", "gone"])
+
+
+if __name__ == "__main__":
+    unittest.main()